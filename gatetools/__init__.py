@@ -4,8 +4,11 @@ from .gate_helpers import *
 from .hausdorff import *
 from .image_uncertainty import *
 from .image_arithm import *
+from .image_expression import *
+from .image_memmap import *
 from .image_convert import *
 from .gamma_index import *
+from .gamma_benchmark import *
 from .roi_utils import *
 from .bounding_box import *
 from .image_crop import *
@@ -18,6 +21,8 @@ from .gauss_filter import *
 from .image_resize import *
 from .dvh import *
 from .merge_root import *
+from .stat_file import *
+from .power_merge import *
 from .pet_helpers import *
 from .morpho_math import *
 from .image_to_dicom_rt_struct import *
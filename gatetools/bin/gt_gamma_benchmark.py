@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+import gatetools as gt
+import click
+import logging
+logger=logging.getLogger(__name__)
+
+backend_options = {"default":{}, "early_stop":{"early_stop":True}, "kdtree":{"kdtree":True}}
+
+# -----------------------------------------------------------------------------
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--kind','-k', multiple=True, type=click.Choice(list(gt.dose_generators.keys())),
+              help='Synthetic dose distribution (can be repeated, default: all)')
+@click.option('--variant','-t', 'variants', multiple=True, type=click.Choice(gt.dose_pair_variants),
+              help='Type of target w.r.t. the reference (can be repeated, default: all)')
+@click.option('--size','-n', multiple=True, type=int,
+              help='Number of reference voxels per axis (can be repeated, default: 20, 40 and 60)')
+@click.option('--criteria','-c', multiple=True,
+              help='Gamma criterion "DD/DTA", DD in percent (can be repeated, default: 3/3 and 2/2)')
+@click.option('--backend','-b', multiple=True, type=click.Choice(list(backend_options.keys())),
+              help='Search method (can be repeated, default: default and early_stop)')
+@click.option('--workers','-j', default=1, type=click.IntRange(min=1), help='Number of worker processes')
+@click.option('--repeat','-r', default=1, type=click.IntRange(min=1), help='Number of repetitions, the fastest time is kept')
+@click.option('--output','-o', required=True,
+              type=click.Path(dir_okay=False, writable=True, resolve_path=True),
+              help='Output filename, JSON (if the name ends with ".json") or CSV')
+@gt.add_options(gt.common_options)
+def gt_gamma_benchmark_main(kind,variants,size,criteria,backend,workers,repeat,output,**kwargs):
+    '''
+    Benchmark the gamma index implementations with reproducible synthetic dose
+    distributions: gaussian blobs and proton SOBP-like fields, with targets that
+    are noisy, shifted, rescaled or sampled on a different grid.
+
+    For every combination of dose distribution, target variant, size, criterion
+    and search method, the computation time, the number of evaluated voxels, the
+    pass rate and the mean gamma value are written to the output file.
+
+    eg:
+
+    gt_gamma_benchmark -n 40 -n 80 -c 3/3 -c 1/1 -b default -b kdtree -o benchmark.json
+    '''
+
+    # logger
+    gt.logging_conf(**kwargs)
+
+    try:
+        criteria = [tuple(float(v) for v in c.split('/')) for c in criteria] or [(3.,3.),(2.,2.)]
+        assert all(len(c)==2 for c in criteria)
+    except (ValueError,AssertionError):
+        raise click.BadParameter(f"criteria should be given as DD/DTA, got {criteria}")
+    options = [dict(backend_options[b]) for b in (backend or ("default","early_stop"))]
+    if workers > 1:
+        for opts in options:
+            opts["workers"] = workers
+    results = gt.benchmark_gamma_index(kinds=kind or tuple(gt.dose_generators.keys()),
+                                       variants=variants or gt.dose_pair_variants,
+                                       sizes=size or (20,40,60),criteria=criteria,
+                                       options=options,repeat=repeat)
+    gt.write_benchmark_results(results,output)
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    gt_gamma_benchmark_main()
@@ -8,10 +8,18 @@
 
 import gatetools as gt
 import itk
+import numpy as np
+import os
 import click
 import logging
 logger=logging.getLogger(__name__)
 
+# -----------------------------------------------------------------------------
+def _number_of_labels(roi_img):
+    # number of nonzero labels of a mask or label image
+    alabels = itk.array_view_from_image(roi_img)
+    return len(np.unique(alabels[alabels!=0]))
+
 # -----------------------------------------------------------------------------
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.command(context_settings=CONTEXT_SETTINGS)
@@ -34,14 +42,31 @@ value in the same units as the reference and target images.''',
 @click.option('--dta','-r', help='"Distance To Agreement" [same unit as used for the voxel spacing]', default=3.)
 @click.option('--threshold','-T', help='Threshold dose value (exclusive) [same unit as ref/target input files].', default=0.)
 @click.option('--defvalue','-D', help='Default value for voxels that are outside of the overlap region with the reference image, or that have dose less than the th.', default=-1.)
+@click.option('--early-stop','-E', 'early_stop', is_flag=True, default=False,
+              help='Search the reference voxels in order of increasing distance and stop as soon as the distance alone exceeds the best gamma value found so far.')
+@click.option('--kdtree','-K', is_flag=True, default=False,
+              help='Find the minimum gamma value with a KD-tree nearest neighbour query in (x/dta,y/dta,z/dta,dose/dd) space.')
+@click.option('--refine','-R', default=0, type=click.IntRange(min=0),
+              help='Sub-voxel refinement: number of trilinear interpolation steps per reference voxel around the best voxel (default 0: no refinement).')
+@click.option('--workers','-j', default=1, type=click.IntRange(min=1),
+              help='Number of worker processes; the target image is split in tiles that are processed in parallel.')
+@click.option('--roi','-m', default=None,
+              type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True),
+              help='Mask or label image with the geometry of the target image. Only voxels with a nonzero label are evaluated, and the pass rate of every label is printed.')
+@click.option('--criteria','-c', multiple=True,
+              help='Gamma criterion "DD/DTA" (e.g. "3/2" for 3%/2mm with the default dd unit). Can be repeated; all criteria are computed in a single pass, and the --dd and --dta options are ignored.')
+@click.option('--pass-rate-only','-P','pass_rate_only', is_flag=True, default=False,
+              help='Do not compute the gamma image, only print the pass rate and gamma statistics; the target image is processed slab by slab with bounded memory.')
+@click.option('--slab', default=8, type=click.IntRange(min=1),
+              help='Number of z planes per slab for --pass-rate-only.')
 @click.option('--output','-o',
-              help='Output filename',
-              required=True,
+              help='Output filename (required, unless --pass-rate-only is given)',
+              required=False,
               type=click.Path(exists=False, file_okay=False, dir_okay=False,
                               writable=True, readable=False, resolve_path=True,
                               allow_dash=False, path_type=None))
 @gt.add_options(gt.common_options)
-def gt_gamma_index_main(reference,target,dd,ddunit,dta,threshold,defvalue,output,**kwargs):
+def gt_gamma_index_main(reference,target,dd,ddunit,dta,threshold,defvalue,early_stop,kdtree,refine,workers,roi,criteria,pass_rate_only,slab,output,**kwargs):
     '''
     Compute the gamma index [Daniel Low, 1998] between a reference image and a
     target image.  For every voxel i in the target image, determine the gamma
@@ -64,7 +89,21 @@ def gt_gamma_index_main(reference,target,dd,ddunit,dta,threshold,defvalue,output
     For finding the minimum, we do not loop over the entire reference image:
     for each voxel i in the target image we need to search only within a radius
     of dta*abs(dose(i)-dose(jc))/dref, where jc is the index of the voxel in
-    the reference image that is closest to i.
+    the reference image that is closest to i. With the --early-stop option the
+    reference voxels are visited in order of increasing distance, and the search
+    for voxel i ends as soon as the distance term alone exceeds the best gamma
+    value found so far. This is usually faster for high gradient dose distributions.
+    With the --kdtree option the gamma index is computed as a nearest neighbour
+    query: a KD-tree is built over all reference voxels in the scaled space
+    (x/dta,y/dta,z/dta,dose/dd) and queried for all target voxels in one go. This
+    is fast for images with different grid spacings and large dose differences.
+    With --refine/-R N (N>1) the gamma value is refined with sub-voxel accuracy:
+    the reference dose is trilinearly interpolated in N steps on the segments
+    between the best reference voxel and its 26 neighbours. This reduces the
+    overestimation of gamma for coarse reference grids, without upsampling the
+    reference image.
+    With --workers/-j N the target image is split in N tiles along the z axis which
+    are processed in parallel; the result does not depend on the number of workers.
 
     The output image has the same geometry as the input target image. Voxels
     that are located outside of the overlap region of reference and target
@@ -78,9 +117,29 @@ def gt_gamma_index_main(reference,target,dd,ddunit,dta,threshold,defvalue,output
 
     TARGET: File path to target dose image. Dose is assumed to be given in the same units as the reference image.
 
+    With the --roi/-m option only the target voxels inside the given mask or
+    label image are evaluated, and the pass rate for every label is printed.
+
+    With the --criteria/-c option several criteria are computed in one pass. For
+    each criterion the gamma image is written to the output filename with the
+    suffix "_DD-DTA" (before the file extension), and a table with the pass rates
+    (fraction of checked voxels with gamma<=1) is printed. The --early-stop,
+    --kdtree, --refine and --workers options are not supported with --criteria,
+    and --roi only with a single label mask.
+
+    With the --pass-rate-only/-P option no gamma image is written. The target is
+    processed in slabs of --slab z planes and only the pass rate, mean, maximum and
+    percentiles of the gamma values are accumulated and printed. The --early-stop,
+    --refine, --workers and --criteria options are not supported with
+    --pass-rate-only, and --roi only with a single label mask.
+
     Example (2% 2.5mm gamma index with a threshold of 0.2 in the target image):
     
     gate_gamma_index data/tps_dose.mhd result.XYZ/gate-DoseToWater.mhd -o gamma.mhd --dd 2 --dta 2.5 -u "%" -T 0.2
+
+    Example (pass rates for 1%/1mm, 2%/2mm, 3%/3mm and 3%/2mm):
+
+    gate_gamma_index data/tps_dose.mhd result.XYZ/gate-DoseToWater.mhd -o gamma.mhd -c 1/1 -c 2/2 -c 3/3 -c 3/2 -T 0.2
     '''
 
     # logger
@@ -95,16 +154,73 @@ def gt_gamma_index_main(reference,target,dd,ddunit,dta,threshold,defvalue,output
     logger.debug(f"dta: {dta}")
     logger.debug(f"threshold: {threshold}")
     logger.debug(f"defvalue: {defvalue}")
+    logger.debug(f"early_stop: {early_stop}")
+    logger.debug(f"kdtree: {kdtree}")
+    logger.debug(f"refine: {refine}")
+    logger.debug(f"workers: {workers}")
+    logger.debug(f"roi: {roi}")
+    logger.debug(f"criteria: {criteria}")
+    logger.debug(f"pass_rate_only: {pass_rate_only}")
+    logger.debug(f"slab: {slab}")
     logger.debug(f"output: {output}")
     logger.debug(f"verbose: {verbose}")
     logger.debug(f"debugging_logfile: '{logfile}'")
 
+    if output is None and not pass_rate_only:
+        raise click.UsageError("an output filename is required, unless --pass-rate-only is given")
+
     # compute gamma
     ref_img=itk.imread(reference)
     target_img=itk.imread(target)
+    roi_img = None if roi is None else itk.imread(roi)
     ddpercent = (ddunit.lower()=="percent" or ddunit=="%")
-    o = gt.get_gamma_index(ref_img,target_img,dd=dd,dta=dta,
-                           ddpercent=ddpercent,threshold=threshold,defvalue=defvalue,verbose=verbose)
+    if pass_rate_only:
+        unsupported = [opt for opt,given in (("--early-stop/-E",early_stop),("--workers/-j",workers>1),
+                                             ("--refine/-R",refine>0),("--criteria/-c",criteria)) if given]
+        if unsupported:
+            raise click.UsageError(f"{', '.join(unsupported)} cannot be used with --pass-rate-only")
+        if roi_img is not None and _number_of_labels(roi_img)>1:
+            raise click.UsageError("the pass rates per label are not computed with --pass-rate-only, use a mask with a single label")
+        stats = gt.gamma_index_pass_rate(ref_img,target_img,dd=dd,dta=dta,ddpercent=ddpercent,
+                                         threshold=threshold,slab=slab,kdtree=kdtree,roi=roi_img,verbose=verbose)
+        print(f"checked voxels: {stats['n']}")
+        print(f"pass rate: {stats['pass_rate']:.4f}")
+        print(f"mean gamma: {stats['mean']:.4f}")
+        print(f"max gamma: {stats['max']:.4f}")
+        for p,gp in stats['percentiles'].items():
+            print(f"gamma {p}th percentile: {gp:.3f}")
+        return
+    if criteria:
+        unsupported = [opt for opt,given in (("--early-stop/-E",early_stop),("--kdtree/-K",kdtree),
+                                             ("--workers/-j",workers>1),("--refine/-R",refine>0)) if given]
+        if unsupported:
+            raise click.UsageError(f"{', '.join(unsupported)} cannot be used with --criteria")
+        if roi_img is not None and _number_of_labels(roi_img)>1:
+            raise click.UsageError("the pass rates per label are not computed with --criteria, use a mask with a single label")
+        try:
+            ddta = [tuple(float(v) for v in c.split('/')) for c in criteria]
+            assert all(len(c)==2 for c in ddta)
+        except (ValueError,AssertionError):
+            raise click.BadParameter(f"criteria should be given as DD/DTA, got {criteria}")
+        gimgs,pass_rates = gt.gamma_index_3d_sweep(ref_img,target_img,ddta,ddpercent=ddpercent,
+                                                   threshold=threshold,defvalue=defvalue,verbose=verbose,roi=roi_img)
+        base,ext = os.path.splitext(output)
+        print("dd dta pass_rate")
+        for (dd,dta),o,pass_rate in zip(ddta,gimgs,pass_rates):
+            itk.imwrite(o, f"{base}_{dd:g}-{dta:g}{ext}")
+            print(f"{dd:g} {dta:g} {pass_rate:.4f}")
+        return
+    if roi_img is not None:
+        o,pass_rates = gt.get_gamma_index_by_roi(ref_img,target_img,roi_img,dd=dd,dta=dta,
+                                                 ddpercent=ddpercent,threshold=threshold,defvalue=defvalue,verbose=verbose,
+                                                 early_stop=early_stop,kdtree=kdtree,refine=refine,workers=workers)
+        print("label voxels pass_rate")
+        for label,rate in pass_rates.items():
+            print(f"{label} {rate['n']} {rate['pass_rate']:.4f}")
+    else:
+        o = gt.get_gamma_index(ref_img,target_img,dd=dd,dta=dta,
+                               ddpercent=ddpercent,threshold=threshold,defvalue=defvalue,verbose=verbose,
+                               early_stop=early_stop,kdtree=kdtree,refine=refine,workers=workers)
 
     # write file
     itk.imwrite(o, output)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+import gatetools as gt
+import itk
+import click
+import logging
+logger=logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('reference',
+                type=click.Path(exists=True, file_okay=True, dir_okay=False,
+                                writable=False, readable=True, resolve_path=True,
+                                allow_dash=False, path_type=None))
+@click.argument('target',
+                type=click.Path(exists=True, file_okay=True, dir_okay=False,
+                                writable=False, readable=True, resolve_path=True,
+                                allow_dash=False, path_type=None))
+@click.option('--dd','-d', help=\
+'"Dose distance"; you can choose the unit with the --dd-unit/-u option (default is "percent" of the maximum of each reference frame).', default=3.)
+@click.option('--ddunit','-u', help=\
+'''With "percent" (default), the "Dose distance" value is interpreted as a
+percentage of the maximum dose in each reference frame.  With "absolute", the
+"dose distance" value is taken as an absolute value in the same units as the
+reference and target images.''',
+        default="percent",
+        type=click.Choice(["percent","%","absolute","abs"],case_sensitive=False))
+@click.option('--dta','-r', help='"Distance To Agreement" [same unit as used for the voxel spacing]', default=3.)
+@click.option('--threshold','-T', help='Threshold dose value (exclusive) [same unit as ref/target input files].', default=0.)
+@click.option('--defvalue','-D', help='Default value for voxels that have dose less than the threshold.', default=-1.)
+@click.option('--output','-o',
+              help='Output filename for the stack of gamma frames (optional)',
+              type=click.Path(exists=False, file_okay=True, dir_okay=False,
+                              writable=True, readable=False, resolve_path=True,
+                              allow_dash=False, path_type=None))
+@gt.add_options(gt.common_options)
+def gt_gamma_index_2d_main(reference,target,dd,ddunit,dta,threshold,defvalue,output,**kwargs):
+    '''
+    Compute the 2D gamma index [Daniel Low, 1998] for a stack of frames, e.g.
+    EPID/portal dose images versus the predicted portal dose. The third axis
+    of the REFERENCE and TARGET images is the frame index, and every frame is
+    compared independently (no search across frames). All frames are computed
+    together, in vectorized form.
+
+    The pass rate (fraction of the voxels with dose above the threshold that
+    have gamma<=1) of every frame is printed.
+
+    REFERENCE: File path to the reference stack of frames.
+
+    TARGET: File path to the target stack of frames, with the same geometry as the reference.
+
+    Example (3%/3mm for every frame, with a threshold of 0.1):
+
+    gt_gamma_index_2d predicted_epid.mhd measured_epid.mhd -o gamma.mhd --dd 3 --dta 3 -T 0.1
+    '''
+
+    # logger
+    gt.logging_conf(**kwargs)
+
+    logger.debug(f"reference: {reference}")
+    logger.debug(f"target: {target}")
+    logger.debug(f"dd: {dd}")
+    logger.debug(f"ddunit: {ddunit}")
+    logger.debug(f"dta: {dta}")
+    logger.debug(f"threshold: {threshold}")
+    logger.debug(f"defvalue: {defvalue}")
+    logger.debug(f"output: {output}")
+
+    # compute gamma
+    ref_img=itk.imread(reference)
+    target_img=itk.imread(target)
+    ddpercent = (ddunit.lower()=="percent" or ddunit=="%")
+    o,pass_rates = gt.gamma_index_2d_batch(ref_img,target_img,dd=dd,dta=dta,
+                                           ddpercent=ddpercent,threshold=threshold,defvalue=defvalue)
+    print("frame pass_rate")
+    for i,pass_rate in enumerate(pass_rates):
+        print(f"{i} {pass_rate:.4f}")
+
+    # write file
+    if output is not None:
+        itk.imwrite(o, output)
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    gt_gamma_index_2d_main()
@@ -10,6 +10,7 @@ import gatetools as gt
 import itk
 import click
 import sys
+import os
 import logging
 logger=logging.getLogger(__name__)
 
@@ -20,9 +21,7 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.argument('files',
                 nargs=-1,
                 required=True, # this ensures nargs>=1, but the click docs recommend against it
-                type=click.Path(exists=True, file_okay=True, dir_okay=False,
-                                writable=False, readable=True, resolve_path=True,
-                                allow_dash=False, path_type=None))
+                type=str) # existence is checked below, with --expression the arguments are NAME=FILE
 
 @click.option('--operation','-O', help='Operation',
               type=click.Choice(['sum', 'product', 
@@ -32,13 +31,24 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 @click.option('--scalar','-s', help='scalar for operation', type=float)
 
+@click.option('--expression','-e', help='Voxel-wise expression of the input images, e.g. "(a+b)/(c+d)*2"; the FILES are then given as NAME=FILE (or NAME=NUMBER).')
+
+@click.option('--out-of-core','-M','out_of_core', is_flag=True, default=False,
+              help='Memory-map the uncompressed MHD/RAW (or MHA) input files and compute the operation slab by slab (sum, product, min, max, mean, std, sem).')
+
+@click.option('--accumulator','-a', default=None,
+              help='Sidecar accumulator file for --operation sum (JSON manifest, the float64 sum is stored next to it in a .npz file): the files are added to a previous merge, files that are already included are skipped.')
+
+@click.option('--prefetch','-p', default=0, type=click.IntRange(min=0),
+              help='Number of input files that are read ahead in background threads (default 0: the files are all read before the operation).')
+
 @click.option('--output','-o', help='Output filename', required=True,
               type=click.Path(dir_okay=False,
                               writable=True, readable=False,
                               resolve_path=True, allow_dash=False, path_type=None))
 
 @gt.add_options(gt.common_options)
-def gt_image_arithm_main(files, operation, scalar, output, **kwargs):
+def gt_image_arithm_main(files, operation, scalar, expression, out_of_core, accumulator, prefetch, output, **kwargs):
     '''
     Basic pixel-wise (or voxel-wise) arithmetic operations on one or
     more images of the same type and geometry. Currently :
@@ -62,6 +72,27 @@ def gt_image_arithm_main(files, operation, scalar, output, **kwargs):
     SCALAR: when --scalar option is given, creates a constant image
     with this scalar value for all pixels and perform the operation.
 
+    PREFETCH: with --prefetch/-p K, the input files are read one by one during
+    the operation, with the next K files read in background threads, so that
+    at most K+1 input images are in memory (not for invert and absreldiffmax).
+
+    ACCUMULATOR: with --accumulator/-a FILE, the float64 sum and the list of
+    summed files are kept in a sidecar accumulator. Running the same command
+    when more files are available only adds the new files; a file is never
+    counted twice.
+
+    OUT OF CORE: with --out-of-core/-M, the uncompressed MetaImage input files
+    are memory-mapped and the operation is computed slab by slab, the output is
+    written slab by slab as well. This works for images that do not fit in memory
+    (e.g. 4D or very high resolution images).
+
+    EXPRESSION: with --expression/-e, an arbitrary voxel-wise expression of
+    the input images is computed in one go. The expression can use the
+    operators + - * / **, numbers and the functions abs, sqrt, exp, log,
+    minimum and maximum. The geometry of the input files is checked from their
+    headers first, then the expression is evaluated slab by slab, without
+    writing or allocating full size intermediate images.
+
     OUTPUT: File path to store the result.
 
     \b
@@ -75,13 +106,80 @@ def gt_image_arithm_main(files, operation, scalar, output, **kwargs):
     gt_image_arithm -O min     -o min.mhd  input1.mhd input2.mhd input3.mhd
     gt_image_arithm -O max     -o max.mhd  input1.mhd input2.mhd input3.mhd input4.mhd
     gt_image_arithm -O absreldiffmax -o diff.mhd input1.mhd input2.mhd 
+    gt_image_arithm -O sum -a merged.json -o sum.mhd output_*/dose.mhd
+    gt_image_arithm -O mean -M -o mean.mhd output_*/dose.mhd
+    gt_image_arithm -e "(a+b)/(c+d)*k" -o ratio.mhd a=input1.mhd b=input2.mhd c=input3.mhd d=input4.mhd k=2
     '''
 
     # logger
     gt.logging_conf(**kwargs)
 
+    if expression is not None:
+        if operation is not None or scalar is not None:
+            raise click.UsageError("--expression cannot be combined with --operation or --scalar")
+        inputs = dict()
+        for arg in files:
+            name,sep,value = arg.partition("=")
+            if not sep or not name.strip().isidentifier():
+                raise click.BadParameter("with --expression the inputs should be given as NAME=FILE, got '{}'".format(arg))
+            try:
+                inputs[name.strip()] = float(value)
+            except ValueError:
+                if not os.path.isfile(value):
+                    raise click.BadParameter("file '{}' does not exist".format(value))
+                inputs[name.strip()] = value
+        logger.info("Compute {} with {}".format(expression,inputs))
+        logger.info("Output will be written to: {}".format(output))
+        try:
+            gt.image_expression(expression,inputs,output_file=output)
+        except ValueError as ve:
+            raise click.BadParameter(str(ve))
+        except TypeError as te:
+            logger.error("Looks like the input files had incompatible types and/or geometries.")
+            logger.error("Specifically: '{}'".format(te))
+            sys.exit(2)
+        return
+
+    if operation is None:
+        raise click.UsageError("please give an --operation or an --expression")
+    for fpath in files:
+        if not os.path.isfile(fpath):
+            raise click.BadParameter("file '{}' does not exist".format(fpath))
+    files = [os.path.abspath(fpath) for fpath in files]
+
+    # check the geometry of all files from their headers, before reading any pixel data
+    report = gt.probe_image_geometry(files)
+    if report["incompatible"]:
+        logger.error("{} of {} input files are incompatible with {}:".format(len(report["incompatible"]),len(files),report["reference"]))
+        for r in report["incompatible"]:
+            logger.error("{}: {}".format(r["input"],r["message"]))
+        sys.exit(2)
+
+    if accumulator is not None:
+        if operation != "sum" or scalar is not None:
+            raise click.UsageError("--accumulator only works for the sum of files, without --scalar")
+        try:
+            gt.image_sum(input_list=files,output_file=output,accumulator=accumulator)
+        except ValueError as ve:
+            logger.error("Could not extend the accumulator {}: {}".format(accumulator,ve))
+            sys.exit(2)
+        return
+
+    if out_of_core:
+        if scalar is not None or operation not in ("sum","product","min","max","mean","std","sem"):
+            raise click.UsageError("--out-of-core works for the sum, product, min, max, mean, std and sem of files, without --scalar")
+        logger.info("Compute {} of {} input files out of core".format(operation,len(files)))
+        try:
+            gt.image_reduce_memmap(operation,files,output)
+        except (ValueError,TypeError) as te:
+            logger.error("Looks like the input files had incompatible types and/or geometries, or cannot be memory-mapped.")
+            logger.error("Specifically: '{}'".format(te))
+            sys.exit(2)
+        return
+
+    streaming = prefetch > 0 and operation not in ("invert","absreldiffmax")
     try:
-        input_images = [itk.imread(fpath) for fpath in files]
+        input_images = list(files) if streaming else [itk.imread(fpath) for fpath in files]
     except Exception as ke:
         logger.error("Looks like you are trying to read images of a type that are not supported by the ITK python bindings on your system.")
         logger.error("This Exception was raised by ITK: {}".format(ke))
@@ -95,7 +193,7 @@ def gt_image_arithm_main(files, operation, scalar, output, **kwargs):
     n = len(input_images)    
     if n == 1 and operation != "invert":
         logger.info("Only one input file => output is equal to input !")
-        itk.imwrite(input_images[0], output)
+        itk.imwrite(itk.imread(input_images[0]) if streaming else input_images[0], output)
         return
     
     opdict = dict([("sum",gt.image_sum),
@@ -114,7 +212,10 @@ def gt_image_arithm_main(files, operation, scalar, output, **kwargs):
     logger.info("Compute {} of input files:{}{}".format(operation,prefix,prefix.join(files)))
     logger.info("Output will be written to: {}".format(output))
     try:
-        opdict[operation](input_list=input_images,output_file=output)
+        if streaming:
+            opdict[operation](input_list=input_images,output_file=output,prefetch=prefetch)
+        else:
+            opdict[operation](input_list=input_images,output_file=output)
     except TypeError as te:
         logger.error("Looks like the input files had incompatible types and/or geometries.")
         logger.error("Specifically: '{}'".format(te))
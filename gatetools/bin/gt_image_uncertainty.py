@@ -34,10 +34,25 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 @click.option('--sigma', default=False, is_flag=True, help='By default, uncertainty is normalized, unc = sigma/x. By using this option, the output is *not* normalized, sigma=sqrt(var) is computed.')
 
-@click.option('--label','-l', help='label map filename to compute uncertainty by region')
+@click.option('--label','-l', multiple=True, help='label map filename to compute uncertainty by region (can be repeated)')
+
+@click.option('--workers','-j', default=1, type=click.IntRange(min=1), help='Number of worker processes for the label maps (with several -l)')
+
+@click.option('--watch','-w', default=None, type=click.Path(exists=True, file_okay=False, dir_okay=True),
+              help='Watch mode: follow the run directory of a running job array; FILENAMES is then the name of the dose image in the output* directories (e.g. dose-Edep.mhd)')
+
+@click.option('--interval', default=60., help='Watch mode: number of seconds between two checks of the run directory')
+
+@click.option('--target', default=None, type=float, help='Watch mode: stop when the mean relative uncertainty above the threshold is at most this value')
+
+@click.option('--stop-file', 'stop_file', default=None, help='Watch mode: file that is written when the target uncertainty is reached')
+
+@click.option('--accumulator','-a', default=None, help='Sidecar accumulator file (JSON manifest, the sums are stored next to it in a .npz file): the images are added to the sums of a previous merge, files that are already included are skipped. The number of events (-n) is then the number of events of the new files.')
+
+@click.option('--prefetch','-p', default=0, type=click.IntRange(min=0), help='Number of input files that are read ahead in background threads (default 0: one by one)')
 
 @gt.add_options(gt.common_options)
-def gt_image_uncertainty(filenames, nevents, output, counts, by_slice, threshold, efficiency, sigma, label, verbose, **kwargs):
+def gt_image_uncertainty(filenames, nevents, output, counts, by_slice, threshold, efficiency, sigma, label, workers, watch, interval, target, stop_file, accumulator, prefetch, verbose, **kwargs):
     '''
     Compute relative statistical uncertainty image for a list of
     images. Images are summed before computing the the uncertainty.
@@ -60,7 +75,30 @@ def gt_image_uncertainty(filenames, nevents, output, counts, by_slice, threshold
 
     Option '-l' with the path to a label map will compute the
     uncertainty by region. Each region is represented by one label
-    in the label map.
+    in the label map. The uncertainty of every label is written to
+    the output file (one "label<TAB>uncertainty" line per label).
+
+    With several '-l' options, the images are summed once and the
+    uncertainty of every region of every label map is written as a
+    table (label map, label, voxels, sum, uncertainty) to the output
+    file: CSV if the output ends with .csv, tab separated otherwise.
+    With '-j K' the label maps are processed by K worker processes.
+
+    Option '-p' with a number K reads the next K input files in
+    background threads while the current one is added, which helps
+    when reading the files is slow (e.g. on a network file system).
+
+    Watch mode: with option '-w run.XYZ', the output directories of a
+    running job array are checked every --interval seconds. The dose
+    and squared dose images (the FILENAME and FILENAME-Squared) of
+    each finished job are added once to running sums, which are saved
+    in run.XYZ/uncertainty_watch, and the mean relative uncertainty is
+    reported, for all voxels with dose and for the voxels above the
+    threshold (-t, fraction of the maximum dose). The number of events
+    is read from the stat file of every job, or is -n per job. With
+    --target the watch stops when the uncertainty above the threshold
+    is at most the target, and writes the --stop-file, if given. The
+    uncertainty image is written to the output file after every update.
 
     Example1:
     gt_image_uncertainty run.XYZ/output_*/dose-Edep.mhd -o u.mhd -N 100000000
@@ -71,6 +109,14 @@ def gt_image_uncertainty(filenames, nevents, output, counts, by_slice, threshold
     Example3:
     gt_image_uncertainty output/projection.mhd -c -o u.mhd -s -t 0.1 -e output/stats.txt
 
+    Option '-a merged.json' keeps the sums, the number of events and the
+    list of merged files in a sidecar accumulator. When more jobs have
+    finished, the same command only adds the new files (with -n the
+    number of events of the new jobs); no file is ever counted twice.
+
+    Example4:
+    gt_image_uncertainty -w run.XYZ dose-Edep.mhd -o u.mhd -t 0.2 --target 0.01 --stop-file run.XYZ/STOP
+
     (Not yet implemented: efficiency image)
     
     '''
@@ -86,6 +132,20 @@ def gt_image_uncertainty(filenames, nevents, output, counts, by_slice, threshold
     # ensure that nevents is an int (convert sci notation e.g. 1e5)
     nevents = int(float(nevents))
 
+    # watch a running job array
+    if watch is not None:
+        if len(filenames) != 1:
+            logger.error('In watch mode, provide the name of one dose image')
+            exit()
+        watcher = gt.uncertainty_watcher(watch, os.path.basename(filenames[0]), nevents=nevents,
+                                         threshold=threshold, target=target, stop_file=stop_file)
+        def print_report(report):
+            print("{n} outputs, {events} events: mean uncertainty {mean_uncertainty:.4f}, above threshold {mean_uncertainty_threshold:.4f}".format(**report))
+            if report["n"] > 0 and report["events"] > 1:
+                itk.imwrite(watcher.uncertainty_image(), output)
+        watcher.watch(interval=interval, callback=print_report)
+        return
+
     # verbose
     if verbose:
         logger.info("Found {} file(s)".format(len(filenames)))
@@ -118,18 +178,23 @@ def gt_image_uncertainty(filenames, nevents, output, counts, by_slice, threshold
             sfilenames.append(fs)
         # compute uncertainty history by hitory
         if by_slice:
-            uncertainty, m, nb = gt.image_uncertainty_by_slice(filenames, sfilenames, nevents, sigma_flag, threshold)
-        elif label is not None:
-            label_image = itk.imread(label)
-            uncertainty = gt.image_uncertainty_per_region(filenames, sfilenames, label_image, nevents, sigma_flag, threshold)
+            uncertainty, m, nb = gt.image_uncertainty_by_slice(filenames, sfilenames, nevents, sigma_flag, threshold, prefetch, accumulator=accumulator)
+        elif len(label) > 1:
+            table = gt.image_uncertainty_by_labels(filenames, sfilenames, list(label), nevents, sigma_flag, threshold, workers, prefetch, accumulator)
+            if verbose:
+                logger.info('Write {}'.format(output))
+            gt.write_uncertainty_table(table, output)
+        elif len(label) == 1:
+            label_image = itk.imread(label[0])
+            uncertainty = gt.image_uncertainty_per_region(filenames, sfilenames, label_image, nevents, sigma_flag, threshold, prefetch, accumulator, output)
         else:
-            uncertainty = gt.image_uncertainty(filenames, sfilenames, nevents, sigma_flag, threshold)
+            uncertainty = gt.image_uncertainty(filenames, sfilenames, nevents, sigma_flag, threshold, prefetch, accumulator)
     else:
         # compute uncertainty Poisson
         if by_slice:
-            uncertainty, m, nb = gt.image_uncertainty_Poisson_by_slice(filenames, sigma_flag, threshold)
+            uncertainty, m, nb = gt.image_uncertainty_Poisson_by_slice(filenames, sigma_flag, threshold, prefetch)
         else:
-            uncertainty = gt.image_uncertainty_Poisson(filenames, sigma_flag, threshold)
+            uncertainty = gt.image_uncertainty_Poisson(filenames, sigma_flag, threshold, prefetch)
 
 
     if by_slice:
@@ -145,7 +210,7 @@ def gt_image_uncertainty(filenames, nevents, output, counts, by_slice, threshold
 
 
     # write file
-    if label is None:
+    if len(label) == 0:
         if verbose:
             logger.info('Write {}'.format(output))
         itk.imwrite(uncertainty, output)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+import gatetools as gt
+import click
+import logging
+logger=logging.getLogger(__name__)
+
+
+# -----------------------------------------------------------------------------
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('filenames', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--output','-o', default=None, type=click.Path(dir_okay=False),
+              help='Merged stat file (default: the merged stat file is printed)')
+@click.option('--straggler-factor','-s', 'straggler_factor', default=2.,
+              help='Jobs that took more than this factor times the median elapsed time are reported as stragglers')
+@gt.add_options(gt.common_options)
+def gt_merge_stat_main(filenames, output, straggler_factor, **kwargs):
+    '''
+    Merge the stat files (SimulationStatisticActor) of the jobs of a Gate
+    job array, in one pass: the numbers of events, tracks and steps and
+    the elapsed times are summed, the start and end dates combined, and
+    the mean, min and max elapsed time, the mean number of events per
+    second (PPS) and the speedup are computed. Merged stat files can be
+    merged again with new jobs.
+
+    The distribution of the PPS of the jobs and the stragglers (jobs
+    that took much longer than the median) are printed. The jobs of
+    merged stat files are not in these statistics, because only their
+    summed elapsed time is known.
+
+    eg:
+
+    gt_merge_stat run.XYZ/output*/stat.txt -o results.XYZ/stat.txt
+    '''
+
+    # logger
+    gt.logging_conf(**kwargs)
+
+    keys, jobs = gt.merge_stat_files(filenames)
+    if output is None:
+        print(gt.format_stat_keys(keys))
+    else:
+        gt.write_stat_file(keys, output)
+    if all(job["jobs"] > 1 for job in jobs):
+        return
+    stats = gt.job_statistics(jobs, straggler_factor)
+    if stats["merged_jobs"] > 0:
+        print("{merged_jobs} jobs of merged stat files are not in the statistics".format(**stats))
+    print("{jobs} stat files, PPS min {pps_min:.1f} p05 {pps_p05:.1f} median {pps_median:.1f} p95 {pps_p95:.1f} max {pps_max:.1f}".format(**stats))
+    print("elapsed time min {elapsed_min:.1f} median {elapsed_median:.1f} max {elapsed_max:.1f} s".format(**stats))
+    for job in stats["stragglers"]:
+        print("straggler {filename}: {elapsed:.1f} s, {pps:.1f} PPS, ended {end}".format(**job))
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    gt_merge_stat_main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+import gatetools as gt
+import click
+import logging
+logger=logging.getLogger(__name__)
+
+
+# -----------------------------------------------------------------------------
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('rundir', type=click.Path(exists=True, file_okay=False, dir_okay=True))
+@click.option('--output','-o', default=None, type=click.Path(file_okay=False),
+              help='Output directory (default: results.XYZ for run.XYZ, in the current directory)')
+@click.option('--force','-f', is_flag=True, help='Merge the outputs even if the file is missing in some output directories')
+@click.option('--workers','-j', default=1, type=click.IntRange(min=1), help='Number of worker processes')
+@click.option('--max-reads', 'max_reads', default=None, type=click.IntRange(min=1),
+              help='Maximum number of worker processes that read files at the same time (default: the number of workers)')
+@click.option('--watch','-w', is_flag=True, help='Merge the outputs of a running job array as the jobs finish')
+@click.option('--interval', default=60., help='Watch mode: number of seconds between two checks of the run directory')
+@click.option('--jobs', 'njobs', default=None, type=click.IntRange(min=1),
+              help='Watch mode: stop when this number of jobs is merged (default: when all output directories are merged)')
+@click.option('--settle', default=10., help='Watch mode: a job is finished when its stat file is written and no file of its output directory changed for this number of seconds')
+@gt.add_options(gt.common_options)
+def gt_power_merge_main(rundir, output, force, workers, max_reads, watch, interval, njobs, settle, **kwargs):
+    '''
+    Merge the partial outputs of a Gate job array: for every output
+    filename found in the RUNDIR/output* directories, the partial files
+    are merged in a single process, with one read per partial file:
+
+      - mhd/mha, Analyze and Interfile images are summed
+      - root files are merged (see gt_merge_root)
+      - stat files (SimulationStatisticActor) are combined
+      - dose txt files and txt integral values/profiles are summed
+      - DoseByRegions files are merged, with the uncertainties
+      - other txt files are copied if identical, concatenated otherwise
+
+    The XXX-Uncertainty images are computed from the merged XXX and
+    XXX-Squared images and the merged number of events.
+
+    With '-j K' the outputs are merged in parallel by K processes, and
+    the partial images of an output are split in K blocks that are
+    summed by the K processes, then the block sums are added. On a
+    shared file system, limit the number of processes that read at the
+    same time with --max-reads.
+
+    Watch mode: with '-w' the run directory is checked every --interval
+    seconds while the jobs are running, and the outputs of every finished
+    job (its stat file is written) are merged once into the merged
+    outputs, which are thus available at any time. The images are kept
+    as running sums in RUNDIR/power_merge_watch, with a manifest of the
+    merged jobs and files, so that the watch can be stopped and started
+    again. The watch stops when all jobs are merged (or --jobs jobs).
+    The outputs that are missing for some jobs are always merged, with a
+    warning; -f, -j and --max-reads are not used in watch mode.
+
+    eg:
+
+    gt_power_merge run.XYZ
+
+    gt_power_merge run.XYZ -j 32 --max-reads 8
+
+    gt_power_merge run.XYZ -w --interval 300 --jobs 100
+    '''
+
+    # logger
+    gt.logging_conf(**kwargs)
+
+    if watch:
+        unsupported = [opt for opt,given in (("--force/-f",force),("--workers/-j",workers>1),
+                                             ("--max-reads",max_reads is not None)) if given]
+        if unsupported:
+            raise click.UsageError("{} cannot be used with --watch".format(", ".join(unsupported)))
+        watcher = gt.power_merge_watcher(rundir, output, settle=settle)
+        def print_report(report):
+            print("{jobs} jobs merged ({new_jobs} new), {outputdirs} output dirs".format(**report))
+        watcher.watch(interval=interval, njobs=njobs, callback=print_report)
+        merged, warnings = watcher.flush()
+    else:
+        merged, warnings = gt.power_merge(rundir, output, force, workers, max_reads)
+    print("merged {} outputs, there were {} warning(s)".format(len(merged), warnings))
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    gt_power_merge_main()
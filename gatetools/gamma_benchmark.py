@@ -0,0 +1,202 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+"""
+Benchmark of the gamma index implementations, with reproducible synthetic dose distributions.
+"""
+
+import os
+import csv
+import json
+import time
+import platform
+import itk
+import numpy as np
+import logging
+from scipy.special import erf
+from .gamma_index import gamma_index_3d_equal_geometry, gamma_index_3d_unequal_geometry
+logger=logging.getLogger(__name__)
+
+def _blob(x,y,z,extent):
+    """
+    Gaussian blob in the center of the volume.
+    """
+    sigma = 0.2*extent
+    return np.exp(-(x**2+y**2+z**2)/(2*sigma**2))
+
+def _sobp(x,y,z,extent):
+    """
+    Proton spread-out Bragg peak like field along z: low entrance dose, flat
+    plateau, steep distal fall-off, and a flat lateral profile with penumbra.
+    """
+    half = 0.5*extent
+    zplateau0, zplateau1 = -0.1*half, 0.6*half
+    entrance = 0.5+0.5*np.clip((z+half)/(zplateau0+half),0.,1.)
+    distal = 0.5*(1.-erf((z-zplateau1)/(np.sqrt(2.)*0.03*extent)))
+    lateral = 0.25*(1.-erf((np.abs(x)-0.6*half)/(np.sqrt(2.)*0.05*extent))) * \
+                   (1.-erf((np.abs(y)-0.6*half)/(np.sqrt(2.)*0.05*extent)))
+    return entrance*distal*lateral
+
+dose_generators = {"blob":_blob, "sobp":_sobp}
+
+def synthetic_dose(kind,shape,spacing=(2.,2.,2.),origin=None,extent=None,shift=(0.,0.,0.),scale=1.,noise=0.,seed=None):
+    """
+    Create a synthetic dose image.
+    * `kind` is one of the keys of `dose_generators` ("blob" or "sobp")
+    * `shape` is the number of voxels per axis, `spacing` the voxel size (mm)
+    * `origin` is the center of the first voxel; by default the volume is centered at 0
+    * `extent` is the size (mm) of the dose distribution, by default the size of the volume
+    * the dose distribution is shifted by `shift` (mm) and multiplied by `scale`
+    * `noise` is the relative standard deviation of (multiplicative) gaussian noise,
+      which is drawn with the given `seed`, so that the result is reproducible.
+    Returns an ITK image (float32).
+    """
+    shape = np.array(shape,dtype=int)
+    spacing = np.array(spacing,dtype=float)
+    if origin is None:
+        origin = -0.5*(shape-1)*spacing
+    if extent is None:
+        extent = np.min(shape*spacing)
+    x,y,z = [o+i*s-d for o,i,s,d in zip(origin,np.indices(shape),spacing,shift)]
+    dose = scale*dose_generators[kind](x,y,z,extent)
+    if noise > 0.:
+        dose *= np.random.default_rng(seed).normal(1.,noise,dose.shape)
+    img = itk.image_from_array(np.ascontiguousarray(dose.swapaxes(0,2),dtype=np.float32))
+    img.SetSpacing(spacing)
+    img.SetOrigin(origin)
+    return img
+
+dose_pair_variants = ("identical","shift","scale","unequal")
+
+def synthetic_dose_pair(kind,n,variant,spacing=2.,noise=0.005,seed=1):
+    """
+    Create a reproducible (reference,target) pair of synthetic dose images.
+    The reference has n voxels per axis. The target is:
+    * "identical": the same dose distribution, with different noise
+    * "shift": the dose distribution shifted by a fraction of a voxel
+    * "scale": the dose distribution multiplied by 1.03
+    * "unequal": the same dose distribution, sampled on a coarser grid (1.5 times the
+      spacing) with a different origin; this pair needs the unequal geometry implementation.
+    """
+    shape = (n,n,n)
+    extent = n*spacing
+    ref = synthetic_dose(kind,shape,(spacing,)*3,extent=extent,noise=noise,seed=seed)
+    if variant == "identical":
+        target = synthetic_dose(kind,shape,(spacing,)*3,extent=extent,noise=noise,seed=seed+1)
+    elif variant == "shift":
+        target = synthetic_dose(kind,shape,(spacing,)*3,extent=extent,shift=(0.5*spacing,0.25*spacing,0.),noise=noise,seed=seed+1)
+    elif variant == "scale":
+        target = synthetic_dose(kind,shape,(spacing,)*3,extent=extent,scale=1.03,noise=noise,seed=seed+1)
+    elif variant == "unequal":
+        m = max(int(n/1.5)-1,1)
+        tspacing = 1.5*spacing
+        origin = -0.5*(m-1)*tspacing+np.array([0.3,0.2,0.1])*spacing
+        target = synthetic_dose(kind,(m,m,m),(tspacing,)*3,origin=origin,extent=extent,noise=noise,seed=seed+1)
+    else:
+        raise ValueError(f"unknown dose pair variant '{variant}', choose from {dose_pair_variants}")
+    return ref,target
+
+def benchmark_gamma_index(kinds=("blob","sobp"),variants=dose_pair_variants,sizes=(20,40,60),
+                          criteria=((3.,3.),(2.,2.)),options=({},{"early_stop":True}),repeat=1,threshold=0.1):
+    """
+    Time the gamma index implementations on synthetic dose pairs.
+    * `kinds`, `variants` and `sizes` (number of reference voxels per axis) select the dose pairs
+    * `criteria` is a list of (dd,dta) pairs, dd in percent of the max reference dose
+    * `options` is a list of dictionaries with extra keyword arguments for the
+      gamma functions (e.g. {"early_stop":True}, {"kdtree":True}, {"workers":4})
+    * every computation is repeated `repeat` times, the fastest time is kept
+    * `threshold` is the dose threshold, relative to the max reference dose
+    Pairs with equal geometry are computed with both `gamma_index_3d_equal_geometry` and
+    `gamma_index_3d_unequal_geometry`, the "unequal" pairs only with the latter.
+    Returns a list of dictionaries (one per computation) with the parameters,
+    the time in seconds, the number of evaluated voxels, the pass rate and the mean gamma value.
+    """
+    results = list()
+    for kind in kinds:
+        for variant in variants:
+            for n in sizes:
+                ref,target = synthetic_dose_pair(kind,n,variant)
+                dthreshold = threshold*np.max(itk.array_view_from_image(ref))
+                functions = [gamma_index_3d_unequal_geometry]
+                if variant != "unequal":
+                    functions.insert(0,gamma_index_3d_equal_geometry)
+                for function in functions:
+                    for dd,dta in criteria:
+                        for opts in options:
+                            seconds = np.inf
+                            for i in range(repeat):
+                                t0 = time.perf_counter()
+                                gimg = function(ref,target,dd=dd,dta=dta,threshold=dthreshold,**opts)
+                                seconds = min(seconds,time.perf_counter()-t0)
+                            g = itk.array_view_from_image(gimg)
+                            g = g[g>=0]
+                            row = dict(kind=kind,variant=variant,size=n,
+                                       nref=int(np.prod(ref.GetLargestPossibleRegion().GetSize())),
+                                       ntarget=int(np.prod(target.GetLargestPossibleRegion().GetSize())),
+                                       function=function.__name__,dd=dd,dta=dta,
+                                       options=json.dumps(opts,sort_keys=True),seconds=seconds,
+                                       nevaluated=len(g),
+                                       pass_rate=float(np.mean(g<=1.)) if len(g) else np.nan,
+                                       mean_gamma=float(np.mean(g)) if len(g) else np.nan)
+                            logger.info("{kind} {variant} n={size} {function} {dd}%/{dta}mm {options}: {seconds:.3f} s".format(**row))
+                            results.append(row)
+    return results
+
+def write_benchmark_results(results,filename):
+    """
+    Write the benchmark results to a JSON file (if `filename` ends with ".json"),
+    including some information about the machine, or to a CSV file otherwise.
+    """
+    if filename.endswith(".json"):
+        metadata = dict(date=time.strftime("%Y-%m-%d %H:%M:%S"),platform=platform.platform(),
+                        python=platform.python_version(),numpy=np.__version__,cpus=os.cpu_count())
+        with open(filename,"w") as f:
+            json.dump(dict(metadata=metadata,results=results),f,indent=1)
+    else:
+        with open(filename,"w",newline='') as f:
+            writer = csv.DictWriter(f,fieldnames=list(results[0].keys()) if results else [])
+            writer.writeheader()
+            writer.writerows(results)
+
+#####################################################################################
+import unittest
+import tempfile
+import shutil
+from .logging_conf import LoggedTestCase
+
+class Test_GammaBenchmark(LoggedTestCase):
+    def test_synthetic_dose(self):
+        logger.info('Test_GammaBenchmark test_synthetic_dose')
+        for kind in dose_generators:
+            img1 = synthetic_dose(kind,(10,12,14),noise=0.01,seed=5)
+            img2 = synthetic_dose(kind,(10,12,14),noise=0.01,seed=5)
+            a1 = itk.array_view_from_image(img1)
+            self.assertEqual(a1.shape,(14,12,10))
+            self.assertTrue(np.all(a1>=0))
+            self.assertTrue(np.array_equal(a1,itk.array_view_from_image(img2)))
+        for variant in dose_pair_variants:
+            ref,target = synthetic_dose_pair("sobp",9,variant)
+            self.assertEqual(variant=="unequal",not np.allclose(ref.GetSpacing(),target.GetSpacing()))
+    def test_benchmark(self):
+        logger.info('Test_GammaBenchmark test_benchmark')
+        results = benchmark_gamma_index(kinds=("blob",),variants=("shift","unequal"),sizes=(8,),
+                                        criteria=((3.,3.),),options=({},{"kdtree":True}))
+        # shift: 2 functions x 2 options, unequal: 1 function x 2 options
+        self.assertEqual(len(results),6)
+        for row in results:
+            self.assertGreater(row["nevaluated"],0)
+            self.assertTrue(0.<=row["pass_rate"]<=1.)
+        tmpdirpath = tempfile.mkdtemp()
+        for ext in (".json",".csv"):
+            filename = os.path.join(tmpdirpath,"benchmark"+ext)
+            write_benchmark_results(results,filename)
+            with open(filename) as f:
+                if ext == ".json":
+                    self.assertEqual(len(json.load(f)["results"]),6)
+                else:
+                    self.assertEqual(len(list(csv.DictReader(f))),6)
+        shutil.rmtree(tmpdirpath)
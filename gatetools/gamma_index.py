@@ -10,6 +10,9 @@
 import numpy as np
 import itk
 import logging
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
 from tqdm import tqdm
 logger=logging.getLogger(__name__)
 
@@ -34,34 +37,522 @@ def get_gamma_index(ref,target,**kwargs):
     * dta indicates distance scale ("distance to agreement") in millimeter (e.g. 3mm)
     * threshold indicates minimum dose value (exclusive) for calculating gamma values
     * verbose is a flag, True will result in a progress bar. All other chatter goes to the "debug" level.
+    * early_stop is a flag, True means that each target voxel stops searching as soon as
+      the spatial distance alone yields a larger gamma value than the best one found so far.
+    * workers is the number of worker processes (default 1). With N>1 workers the target
+      volume is split in N tiles, which are computed in parallel, with identical results.
+    * kdtree is a flag, True means that the minimum is found with a nearest neighbour
+      query in (x/dta,y/dta,z/dta,dose/dd) space, using a KD-tree of the reference voxels.
+    * refine is the number of interpolation steps per voxel for the sub-voxel refinement
+      (default 0: no refinement). The reference dose is trilinearly interpolated on the
+      segments between the best reference voxel and its neighbours.
+    * roi restricts the evaluation to the target voxels inside a region of interest, given
+      as an ITK mask/label image with the target geometry, or as a `region_of_interest`.
     Returns an image with the same geometry as the target image.
     For all target voxels in the overlap between ref and target that have d>dmin, a gamma index value is given.
     For all other voxels the "defvalue" is given.
-    TODO: allow 2D images, by creating 3D images with a 1-bin Z dimension. Should be very easy.
-    The 3D gamma image computed using these "fake 3D" images can then be collapsed back to a 2D image.
+    For 2D images, or stacks of 2D frames, use `gamma_index_2d_batch`.
     """
     if (np.allclose(ref.GetOrigin(),target.GetOrigin())) and \
        (np.allclose(ref.GetSpacing(),target.GetSpacing())) and \
        (ref.GetLargestPossibleRegion().GetSize() == ref.GetLargestPossibleRegion().GetSize() ):
-        logger.debug("Images with equal geometry, using the slightly faster implementation.")
+        logger.debug("Images with equal geometry, using the faster implementation.")
         return gamma_index_3d_equal_geometry(ref,target,**kwargs)
     else:
         logger.debug("Images with different geometry, using the slightly slower implementation.")
         return gamma_index_3d_unequal_geometry(ref,target,**kwargs)
 
 
+def get_gamma_index_by_roi(ref,target,rois,defvalue=-1.,**kwargs):
+    """
+    Compute the gamma index only inside a set of regions of interest, and the pass rate per ROI.
+    * `rois` is either a label image with the geometry of the target image (every
+      nonzero label is an ROI), or a dictionary with ROI names as keys and masks as
+      values: ITK mask images with the target geometry or `region_of_interest` objects.
+    * all other keyword arguments are passed on to `get_gamma_index`
+    The gamma index is computed once, for the union of the ROIs.
+    Returns the gamma image and a dictionary with for every ROI (name or label) the
+    number of evaluated voxels "n" and the "pass_rate" (fraction of the evaluated voxels with gamma<=1).
+    """
+    if isinstance(rois,dict):
+        roimasks = {name:_roi_mask(roi,target) for name,roi in rois.items()}
+    else:
+        _roi_mask(rois,target) # geometry check
+        alabels = itk.array_view_from_image(rois).swapaxes(0,2)
+        roimasks = {label.item():alabels==label for label in np.unique(alabels) if label!=0}
+    union = np.zeros(tuple(target.GetLargestPossibleRegion().GetSize()),dtype=bool)
+    for roimask in roimasks.values():
+        union |= roimask
+    aunion = union.swapaxes(0,2).astype(np.uint8)
+    union_img = itk.image_from_array(np.ascontiguousarray(aunion))
+    union_img.CopyInformation(target)
+    # voxels that are not evaluated get NaN, to distinguish them from any default value
+    gimg = get_gamma_index(ref,target,defvalue=np.nan,roi=union_img,**kwargs)
+    agamma = itk.array_view_from_image(gimg).swapaxes(0,2)
+    evaluated = np.logical_not(np.isnan(agamma))
+    pass_rates = dict()
+    for name,roimask in roimasks.items():
+        roieval = roimask & evaluated
+        n = int(np.count_nonzero(roieval))
+        pass_rates[name] = dict(n=n,pass_rate=float(np.count_nonzero(agamma[roieval]<=1.))/n if n>0 else np.nan)
+        logger.debug(f"ROI {name}: {n} voxels evaluated, pass rate {pass_rates[name]['pass_rate']}")
+    agamma[np.logical_not(evaluated)] = defvalue
+    return gimg, pass_rates
+
+def _offset_shell(igmax,relspacing,halfvoxel=False,shape=None,dr2max=None):
+    """
+    Integer voxel offsets within the box [-igmax,+igmax] (per axis), sorted by
+    increasing spatial distance. Returns the offsets as an (n,3) integer array
+    and the squared distances in units of the DTA (`relspacing` is spacing/dta).
+    The first offset is always (0,0,0).
+    With `halfvoxel=True` the distances are reduced by half a voxel per axis,
+    which gives a lower bound of the distance between a point and the voxels
+    at that offset from the voxel that contains the point.
+    The box is limited to the array `shape` (if given) and offsets with a
+    squared distance larger than `dr2max` (if given) are left out.
+    """
+    if shape is not None:
+        igmax = np.minimum(igmax,np.array(shape)-1)
+    ixyz = np.meshgrid(*[np.arange(-i,i+1) for i in igmax],indexing='ij')
+    offsets = np.stack([i.ravel() for i in ixyz],axis=1)
+    if halfvoxel:
+        dr2 = np.sum((np.maximum(np.abs(offsets)-0.5,0.)*relspacing)**2,axis=1)
+    else:
+        dr2 = np.sum((offsets*relspacing)**2,axis=1)
+    if dr2max is not None:
+        offsets,dr2 = offsets[dr2<=dr2max],dr2[dr2<=dr2max]
+    order = np.argsort(dr2,kind='stable')
+    return offsets[order], dr2[order]
+
+def _shifted_slices(offset,shape):
+    """
+    Slices for the target and reference arrays (both with the given `shape`)
+    such that target[tslices] and ref[rslices] are the voxel pairs separated by `offset`.
+    Returns None if the offset is larger than the arrays.
+    """
+    if np.any(np.abs(offset)>=shape):
+        return None
+    tslices = tuple(slice(max(0,-d),min(n,n-d)) for d,n in zip(offset,shape))
+    rslices = tuple(slice(max(0,d),min(n,n+d)) for d,n in zip(offset,shape))
+    return tslices, rslices
+
+def _gamma2_equal_geometry(aref,atarget,mask,dd,relspacing,verbose=False):
+    """
+    Compute the squared gamma index for all target voxels in `mask`, for arrays with equal geometry.
+    Instead of looping over the target voxels, we loop over the voxel offsets
+    within the largest search radius, in order of increasing distance. For each
+    offset the gamma values are computed for the entire volume in one array
+    operation, and the running minimum is updated. As soon as the spatial term
+    of an offset exceeds the largest running minimum, no further improvement is
+    possible and the loop ends.
+    The squared gamma value of voxels outside of the mask is zero.
+    """
+    g2 = np.zeros(atarget.shape,dtype=float)
+    g2[mask] = _reldiff2(aref[mask],atarget[mask],dd)
+    g2max = np.max(g2) if g2.size else 0.
+    igmax = np.round(np.sqrt(g2max)/relspacing).astype(int) # maybe we should use "floor" instead of "round"
+    offsets,dr2 = _offset_shell(igmax,relspacing,shape=atarget.shape,dr2max=g2max)
+    logger.debug("searching {} offsets within {} voxels".format(len(offsets),igmax))
+    if verbose:
+        pbar = tqdm(total=len(offsets)-1, leave=False)
+    shell_dr2 = 0.
+    for offset,offset_dr2 in zip(offsets[1:],dr2[1:]):
+        if offset_dr2 > shell_dr2:
+            # new shell: check whether any voxel can still get a lower gamma value
+            shell_dr2 = offset_dr2
+            g2max = np.max(g2)
+            if offset_dr2 >= g2max:
+                break
+        if verbose:
+            pbar.update(1)
+        slices = _shifted_slices(offset,atarget.shape)
+        if slices is None:
+            continue
+        tslices,rslices = slices
+        g2offset = _reldiff2(aref[rslices],atarget[tslices],dd)
+        g2offset += offset_dr2
+        np.minimum(g2[tslices],g2offset,out=g2[tslices])
+    if verbose:
+        pbar.close()
+    g2[np.logical_not(mask)] = 0.
+    return g2
+
+def _gamma2_ordered_search(aref,irefnear,dtarget,g2near,offsets,dr2,dd,relspacing,delta=None,verbose=False,blocksize=2**18,return_offsets=False):
+    """
+    Distance ordered search with early termination, for a list of n target voxels.
+    * `irefnear` (3,n) indices of the reference voxels that are nearest to the target voxels
+    * `dtarget` (n,) target doses
+    * `g2near` (n,) squared gamma values for the nearest reference voxels
+    * `offsets` and `dr2` as returned by `_offset_shell`: reference voxel offsets
+      (w.r.t. the nearest voxel), sorted by (a lower bound of) the spatial term
+    * `delta` (3,n) position of the target voxels w.r.t. the nearest reference voxel,
+      in units of the DTA. If `delta` is None, the target voxels coincide with the
+      nearest reference voxels and `dr2` is the exact spatial term.
+    Each target voxel drops out of the search as soon as the spatial term of
+    the next offset is larger than its running minimum. The offsets are processed
+    in blocks, such that the number of (offset,voxel) pairs per block stays
+    below `blocksize`; this keeps the loop overhead low for small voxel lists.
+    Returns the squared gamma values of the n target voxels. With `return_offsets`,
+    also the (3,n) offsets of the reference voxels with the minimum gamma value
+    (w.r.t. the nearest reference voxels) are returned.
+    """
+    g2 = np.array(g2near,dtype=float)
+    best = np.zeros((len(g2),3),dtype=int)
+    active = np.flatnonzero(g2>0.)
+    shape = np.array(aref.shape).reshape(1,3,1)
+    if delta is not None:
+        delta = delta.T.reshape(-1,3,1)
+    if verbose:
+        pbar = tqdm(total=len(offsets)-1, leave=False)
+    k = 1
+    while k < len(offsets) and len(active) > 0:
+        # remove the voxels that cannot get a lower gamma value anymore
+        active = active[g2[active]>dr2[k]]
+        if len(active)==0:
+            break
+        kend = min(len(offsets), k + max(1, blocksize//len(active)))
+        # offsets beyond the running minimum of a voxel are skipped for that voxel
+        kend = k + np.searchsorted(dr2[k:kend], np.max(g2[active]), side='left')
+        kend = max(kend,k+1)
+        boffsets = offsets[k:kend].reshape(-1,3,1)
+        iref = irefnear[:,active].reshape(1,3,-1)+boffsets
+        inside = np.all((iref>=0)&(iref<shape),axis=1)
+        inside &= dr2[k:kend].reshape(-1,1) < g2[active].reshape(1,-1)
+        if inside.any():
+            iblock,ivoxel = np.nonzero(inside)
+            iactive = active[ivoxel]
+            g2offset = _reldiff2(aref[tuple(iref[iblock,:,ivoxel].T)],dtarget[iactive],dd)
+            if delta is None:
+                g2offset += dr2[k:kend][iblock]
+            else:
+                g2offset += np.sum((boffsets[iblock,:,0]*relspacing.reshape(1,3)-delta[iactive,:,0])**2,axis=1)
+            g2block = np.full(inside.shape,np.inf)
+            g2block[inside] = g2offset
+            if return_offsets:
+                ibest = np.argmin(g2block,axis=0)
+                improved = g2block[ibest,np.arange(len(active))] < g2[active]
+                best[active[improved]] = offsets[k+ibest[improved]]
+            g2[active] = np.minimum(g2[active],np.min(g2block,axis=0))
+        if verbose:
+            pbar.update(kend-k)
+        k = kend
+    if verbose:
+        pbar.close()
+    if return_offsets:
+        return g2, best.T
+    return g2
+
+def _gamma2_box_search(aref,irefnear,dtarget,g2near,dd,relspacing,delta,verbose=False):
+    """
+    Box search for a list of n target voxels: for each target voxel the
+    reference voxels are searched in a box around the nearest reference voxel,
+    with a half width of floor(gamma_near*dta/spacing) voxels per axis.
+    The arguments have the same meaning as for `_gamma2_ordered_search`.
+    Returns the squared gamma values of the n target voxels.
+    """
+    g2 = np.array(g2near,dtype=float)
+    shape = np.array(aref.shape)
+    dixyz = np.floor(np.sqrt(g2).reshape(1,-1)/relspacing.reshape(3,1)).astype(int) # or round, or ceil?
+    if verbose:
+        pbar = tqdm(total=len(g2), leave=False)
+    for i in range(len(g2)):
+        if verbose:
+            pbar.update(1)
+        imin = np.maximum(irefnear[:,i]-dixyz[:,i],0)
+        imax = np.minimum(irefnear[:,i]+dixyz[:,i]+1,shape)
+        if np.all(imax-imin==1):
+            continue
+        ixnear,iynear,iznear = np.meshgrid(np.arange(imin[0],imax[0]),
+                                           np.arange(imin[1],imax[1]),
+                                           np.arange(imin[2],imax[2]),
+                                           indexing='ij')
+        g2box  = _reldiff2(aref[ixnear,iynear,iznear],dtarget[i],dd)
+        g2box += ((ixnear-irefnear[0,i])*relspacing[0]-delta[0,i])**2
+        g2box += ((iynear-irefnear[1,i])*relspacing[1]-delta[1,i])**2
+        g2box += ((iznear-irefnear[2,i])*relspacing[2]-delta[2,i])**2
+        g2[i] = min(g2[i],np.min(g2box))
+    if verbose:
+        pbar.close()
+    return g2
+
+def _gamma2_kdtree(aref,irefnear,dtarget,g2near,dd,relspacing,delta=None,ngroups=16):
+    """
+    Nearest neighbour search for a list of n target voxels. The gamma value is
+    the euclidean distance in the scaled space (x/dta,y/dta,z/dta,dose/dd), so
+    the minimum over the reference voxels is found with a single KD-tree,
+    which is queried for all target voxels at once. Only the reference voxels
+    within the largest search radius of the target voxels are put in the tree.
+    The target voxels are queried in `ngroups` groups of increasing gamma value
+    of the nearest reference voxel, which bounds the distance of each query.
+    The arguments have the same meaning as for `_gamma2_ordered_search`.
+    Returns the squared gamma values of the n target voxels.
+    """
+    g2 = np.array(g2near,dtype=float)
+    active = np.flatnonzero(g2>0.)
+    if len(active)==0:
+        return g2
+    gmax = np.sqrt(np.max(g2[active]))
+    radius = np.ceil(gmax/relspacing).astype(int)+1
+    imin = np.maximum(np.min(irefnear[:,active],axis=1)-radius,0)
+    imax = np.minimum(np.max(irefnear[:,active],axis=1)+radius+1,aref.shape)
+    iref = np.indices(imax-imin).reshape(3,-1).T
+    refpoints = np.empty((len(iref),4))
+    refpoints[:,:3] = (iref+imin)*relspacing
+    refpoints[:,3] = aref[tuple(slice(i0,i1) for i0,i1 in zip(imin,imax))].ravel()/dd
+    del iref
+    targetpoints = np.empty((len(active),4))
+    targetpoints[:,:3] = irefnear[:,active].T*relspacing
+    if delta is not None:
+        targetpoints[:,:3] += delta[:,active].T
+    targetpoints[:,3] = dtarget[active]/dd
+    logger.debug(f"building KD-tree with {len(refpoints)} reference voxels")
+    tree = cKDTree(refpoints,balanced_tree=False,compact_nodes=False)
+    for group in np.array_split(np.argsort(g2[active]),min(ngroups,len(active))):
+        bound = np.sqrt(np.max(g2[active[group]]))
+        dist,_ = tree.query(targetpoints[group],distance_upper_bound=bound*(1+1e-9))
+        found = np.isfinite(dist)
+        igroup = active[group[found]]
+        g2[igroup] = np.minimum(g2[igroup],dist[found]**2)
+    return g2
+
+def _gamma2_refine(aref,irefnear,dtarget,g2,offsets,dd,relspacing,delta=None,nsub=4,blocksize=2**18):
+    """
+    Sub-voxel refinement of the squared gamma values `g2` of a list of n target voxels.
+    `offsets` (3,n) are the offsets of the reference voxels with the minimum gamma
+    value w.r.t. the nearest reference voxels `irefnear`, as returned by
+    `_gamma2_ordered_search`. The reference dose is trilinearly interpolated
+    at `nsub-1` equidistant points on the segments between that reference voxel
+    and each of its 26 neighbours, and the gamma value is updated if one of these
+    points gives a lower value. The other arguments have the same meaning as for
+    `_gamma2_ordered_search`. Only these few points per target voxel are
+    interpolated, the reference image is not upsampled.
+    Returns the refined squared gamma values of the n target voxels.
+    """
+    g2 = np.array(g2,dtype=float)
+    active = np.flatnonzero(g2>0.)
+    if nsub < 2 or len(active)==0:
+        return g2
+    shape = np.array(aref.shape).reshape(1,3,1)
+    directions = np.array([d for d in np.ndindex(3,3,3) if d!=(1,1,1)])-1
+    steps = (directions.reshape(-1,1,3)*(np.arange(1,nsub)/nsub).reshape(1,-1,1)).reshape(-1,3,1)
+    corners = np.array(list(np.ndindex(2,2,2))).reshape(-1,1,3,1)
+    relspacing = relspacing.reshape(1,3,1)
+    for chunk in np.array_split(active,max(1,len(active)*len(steps)//blocksize)):
+        ibest = irefnear[:,chunk]+offsets[:,chunk]
+        points = ibest.reshape(1,3,-1)+steps
+        inside = np.all((points>=0)&(points<=shape-1),axis=1)
+        # trilinear interpolation, from the 8 voxels around each point
+        ilow = np.clip(np.floor(points).astype(int),0,np.maximum(shape-2,0))
+        w = points-ilow
+        dose = np.zeros(inside.shape)
+        for corner in corners:
+            icorner = np.minimum(ilow+corner,shape-1)
+            weight = np.prod(np.where(corner==1,w,1.-w),axis=1)
+            dose += weight*aref[icorner[:,0],icorner[:,1],icorner[:,2]]
+        g2points = _reldiff2(dose,dtarget[chunk].reshape(1,-1),dd)
+        dpos = (points-irefnear[:,chunk].reshape(1,3,-1))*relspacing
+        if delta is not None:
+            dpos -= delta[:,chunk].reshape(1,3,-1)
+        g2points += np.sum(dpos**2,axis=1)
+        g2points[np.logical_not(inside)] = np.inf
+        g2[chunk] = np.minimum(g2[chunk],np.min(g2points,axis=0))
+    return g2
+
+def _search_offsets(g2near,relspacing,exact,shape):
+    """
+    Offsets for the distance ordered search, covering the largest search radius
+    needed for the given squared gamma values of the nearest reference voxels,
+    within a reference array with the given `shape`.
+    With `exact=True` the target voxels coincide with the reference voxels (equal geometry).
+    """
+    g2max = np.max(g2near,initial=0.)
+    if exact:
+        igmax = np.round(np.sqrt(g2max)/relspacing).astype(int)
+    else:
+        igmax = np.ceil(np.sqrt(g2max)/relspacing+0.5).astype(int)
+    return _offset_shell(igmax,relspacing,halfvoxel=not exact,shape=shape,dr2max=g2max)
+
+def _gamma2_search(aref,irefnear,dtarget,g2near,dd,relspacing,delta=None,early_stop=True,offsets=None,kdtree=False,refine=0,verbose=False):
+    """
+    Squared gamma values for a list of target voxels, see `_gamma2_ordered_search`.
+    With `refine`>1 the ordered search is followed by the sub-voxel refinement
+    with `refine` steps per voxel, see `_gamma2_refine`.
+    With `kdtree` the KD-tree search is used, see `_gamma2_kdtree`.
+    The box search is used for unequal geometries (delta is not None) without `early_stop`.
+    Precomputed (offsets,dr2) for the ordered search may be given with `offsets`.
+    """
+    if refine > 1:
+        if offsets is None:
+            offsets = _search_offsets(g2near,relspacing,exact=delta is None,shape=aref.shape)
+        g2,best = _gamma2_ordered_search(aref,irefnear,dtarget,g2near,*offsets,dd,relspacing,delta,verbose,return_offsets=True)
+        return _gamma2_refine(aref,irefnear,dtarget,g2,best,dd,relspacing,delta,refine)
+    if kdtree:
+        return _gamma2_kdtree(aref,irefnear,dtarget,g2near,dd,relspacing,delta)
+    if delta is not None and not early_stop:
+        return _gamma2_box_search(aref,irefnear,dtarget,g2near,dd,relspacing,delta,verbose)
+    if offsets is None:
+        offsets = _search_offsets(g2near,relspacing,exact=delta is None,shape=aref.shape)
+    return _gamma2_ordered_search(aref,irefnear,dtarget,g2near,*offsets,dd,relspacing,delta,verbose)
+
+class _SharedArray:
+    """
+    Context manager that copies a (swapped) dose array into shared memory,
+    so that worker processes can access it without pickling.
+    Worker processes get the array back with `_attach_shared_array(spec)`.
+    """
+    def __init__(self,a):
+        # store the array in the memory layout of the ITK image
+        self.a = np.ascontiguousarray(a.swapaxes(0,2))
+    def __enter__(self):
+        self.shm = shared_memory.SharedMemory(create=True,size=max(self.a.nbytes,1))
+        np.ndarray(self.a.shape,dtype=self.a.dtype,buffer=self.shm.buf)[...] = self.a
+        self.spec = (self.shm.name,self.a.shape,self.a.dtype.str)
+        del self.a
+        return self
+    def __exit__(self,*args):
+        self.shm.close()
+        self.shm.unlink()
+
+def _attach_shared_array(spec):
+    name,shape,dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape,dtype=dtype,buffer=shm.buf).swapaxes(0,2)
+
+def _gamma2_search_tile(refspec,zrange,args):
+    """
+    Worker function: ordered, box or KD-tree search for a list of target voxels, with a
+    reference sub-volume (in shared memory) covering the z-range `zrange`.
+    """
+    shm,aref = _attach_shared_array(refspec)
+    try:
+        return _gamma2_search(aref[:,:,zrange[0]:zrange[1]],*args)
+    finally:
+        del aref
+        shm.close()
+
+def _gamma2_equal_geometry_tile(refspec,targetspec,zrange,mask,dd,relspacing):
+    """
+    Worker function: offset shell search for the target voxels in `mask`, with
+    reference and target sub-volumes (in shared memory) covering the z-range `zrange`.
+    """
+    shmref,aref = _attach_shared_array(refspec)
+    shmtarget,atarget = _attach_shared_array(targetspec)
+    try:
+        zslice = slice(zrange[0],zrange[1])
+        return _gamma2_equal_geometry(aref[:,:,zslice],atarget[:,:,zslice],mask,dd,relspacing)
+    finally:
+        del aref,atarget
+        shmref.close()
+        shmtarget.close()
+
+def _gamma2_search_parallel(aref,irefnear,dtarget,g2near,dd,relspacing,delta=None,early_stop=True,workers=2,kdtree=False,refine=0):
+    """
+    Parallel version of `_gamma2_search`. The target voxels are split in `workers`
+    tiles along the z axis, each worker gets the reference sub-volume of its tile,
+    padded with the largest search radius. The results are identical to `_gamma2_search`.
+    """
+    g2 = np.array(g2near,dtype=float)
+    offsets = None
+    if kdtree and not refine > 1:
+        halo = np.ceil(np.sqrt(np.max(g2,initial=0.))/relspacing[2]).astype(int)+1
+    elif delta is not None and not early_stop and not refine > 1:
+        halo = np.max(np.floor(np.sqrt(g2)/relspacing[2]),initial=0).astype(int)
+    else:
+        offsets = _search_offsets(g2near,relspacing,exact=delta is None,shape=aref.shape)
+        # the refinement also needs the neighbours of the reference voxels
+        halo = np.max(np.abs(offsets[0][:,2])) + (1 if refine > 1 else 0)
+    order = np.argsort(irefnear[2],kind='stable')
+    with _SharedArray(aref) as shared, ProcessPoolExecutor(workers) as pool:
+        tiles = list()
+        for tile in np.array_split(order,workers):
+            if len(tile)==0:
+                continue
+            z0 = max(np.min(irefnear[2,tile])-halo,0)
+            z1 = min(np.max(irefnear[2,tile])+halo+1,aref.shape[2])
+            irefnear_tile = irefnear[:,tile].copy()
+            irefnear_tile[2] -= z0
+            delta_tile = None if delta is None else delta[:,tile]
+            args = (irefnear_tile,dtarget[tile],g2near[tile],dd,relspacing,delta_tile,early_stop,offsets,kdtree,refine)
+            tiles.append((tile,pool.submit(_gamma2_search_tile,shared.spec,(z0,z1),args)))
+        for tile,future in tiles:
+            g2[tile] = future.result()
+    return g2
+
+def _gamma2_equal_geometry_parallel(aref,atarget,mask,dd,relspacing,workers=2):
+    """
+    Parallel version of `_gamma2_equal_geometry`. The target volume is split in
+    `workers` tiles along the z axis, each worker gets the reference sub-volume
+    of its tile, padded with the largest search radius. The results are
+    identical to `_gamma2_equal_geometry`.
+    """
+    g2near = _reldiff2(aref[mask],atarget[mask],dd)
+    halo = np.round(np.sqrt(np.max(g2near,initial=0.))/relspacing[2]).astype(int)
+    nz = atarget.shape[2]
+    g2 = np.zeros(atarget.shape,dtype=float)
+    bounds = np.linspace(0,nz,min(workers,nz)+1).astype(int)
+    with _SharedArray(aref) as sharedref, _SharedArray(atarget) as sharedtarget, ProcessPoolExecutor(workers) as pool:
+        tiles = list()
+        for z0,z1 in zip(bounds[:-1],bounds[1:]):
+            p0,p1 = max(z0-halo,0),min(z1+halo,nz)
+            tilemask = np.zeros(atarget.shape[:2]+(p1-p0,),dtype=bool)
+            tilemask[:,:,z0-p0:z1-p0] = mask[:,:,z0:z1]
+            future = pool.submit(_gamma2_equal_geometry_tile,sharedref.spec,sharedtarget.spec,(p0,p1),tilemask,dd,relspacing)
+            tiles.append((z0,z1,p0,future))
+        for z0,z1,p0,future in tiles:
+            g2[:,:,z0:z1] = future.result()[:,:,z0-p0:z1-p0]
+    return g2
+
+def _roi_mask(roi,imgtarget):
+    """
+    Boolean (swapped) array with the target voxels that are inside `roi`, which
+    can be an ITK image with the same geometry as the target image (voxels with
+    a nonzero value are inside, e.g. a label image), or a `region_of_interest`
+    (e.g. from a DICOM RT struct), for which the mask is computed on the target image.
+    """
+    if hasattr(roi,"get_mask"):
+        roi = roi.get_mask(imgtarget,corrected=False)
+    aroi = itk.array_view_from_image(roi).swapaxes(0,2)
+    if aroi.shape != tuple(imgtarget.GetLargestPossibleRegion().GetSize()) or \
+       not np.allclose(roi.GetSpacing(),imgtarget.GetSpacing()) or \
+       not np.allclose(roi.GetOrigin(),imgtarget.GetOrigin()):
+        raise ValueError("the ROI mask should have the same geometry as the target image")
+    return aroi!=0
+
+def _mask_box(mask,halo):
+    """
+    Slices of the bounding box of the voxels in `mask`, padded with `halo` voxels per axis.
+    """
+    box = list()
+    for axis,h in enumerate(halo):
+        inside = np.flatnonzero(np.any(mask,axis=tuple(a for a in range(3) if a!=axis)))
+        box.append(slice(max(inside[0]-h,0),inside[-1]+h+1) if len(inside) else slice(0,0))
+    return tuple(box)
+
 # FIXME: Should this function remain public or be made private (by prefixing it with an _underscore)?
-# TODO: Discuss whether to keep this function. It is 30% faster than the
-# "unequal geometry" implementation on the same input images. Is that worth it?
-def gamma_index_3d_equal_geometry(imgref,imgtarget,dta=3.,dd=3., ddpercent=True,threshold=0.,defvalue=-1.,verbose=False):
+def gamma_index_3d_equal_geometry(imgref,imgtarget,dta=3.,dd=3., ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,early_stop=False,workers=1,kdtree=False,roi=None,refine=0):
     """
     Compare two images with equal geometry, using the gamma index formalism as introduced by Daniel Low (1998).
     * ddpercent indicates "dose difference" scale as a relative value, in units percent (the dd value is this percentage of the max dose in the reference image)
     * ddabs indicates "dose difference" scale as an absolute value
     * dta indicates distance scale ("distance to agreement") in millimeter (e.g. 3mm)
     * threshold indicates minimum dose value (exclusive) for calculating gamma values: target voxels with dose<=threshold are skipped and get assigned gamma=defvalue.
+    * early_stop: if True, then each target voxel stops searching as soon as the
+      spatial distance alone gives a larger gamma value than the best one found
+      so far. This is faster when the minimum is usually found close by, e.g.
+      for high gradient dose distributions.
+    * workers: number of worker processes. With more than one worker, the target
+      volume is split in tiles that are computed in parallel; the result is identical.
+    * kdtree: if True, then the minimum gamma value is found with a nearest neighbour
+      query in (x/dta,y/dta,z/dta,dose/dd) space, using a KD-tree of the reference voxels.
+    * roi: ITK mask image (e.g. a label image) with the target geometry, or a
+      `region_of_interest`. If given, only the target voxels inside the ROI are evaluated,
+      and only the part of the reference image around the ROI is searched.
+    * refine: number of interpolation steps per voxel for the sub-voxel refinement. If
+      larger than 1, then the reference dose is trilinearly interpolated on the segments
+      between the reference voxel with the lowest gamma value and its 26 neighbours,
+      in `refine` steps, and the gamma value is updated if an interpolated point gives a lower value.
     Returns an image with the same geometry as the target image.
-    For all target voxels that have d>threshold, a gamma index value is given.
+    For all target voxels that have d>threshold (and are inside the ROI), a gamma index value is given.
     For all other voxels the "defvalue" is given.
     If geometries of the input images are not equal, then a `ValueError` is raised.
     """
@@ -76,45 +567,34 @@ def gamma_index_3d_equal_geometry(imgref,imgtarget,dta=3.,dd=3., ddpercent=True,
     if ddpercent:
         dd *= 0.01*np.max(aref)
     relspacing = np.array(imgref.GetSpacing(),dtype=float)/dta
-    inv_spacing = np.ones(3,dtype=float)/relspacing
-    g00=np.ones(aref.shape,dtype=float)*-1
     mask=atarget>threshold
-    g00[mask]=np.sqrt(_reldiff2(aref[mask],atarget[mask],dd))
+    if roi is not None:
+        mask &= _roi_mask(roi,imgtarget)
     nx,ny,nz = atarget.shape
     ntot = nx*ny*nz
     nmask = np.sum(mask)
     logger.debug("Both images have {} x {} x {} = {} voxels.".format(nx,ny,nz,ntot))
     logger.debug("{} target voxels have a dose > {}.".format(nmask,threshold))
-    g2 = np.zeros((nx,ny,nz),dtype=float)
-    if verbose:
-        pbar = tqdm(total=nmask, leave=False)
-    for x in range(nx):
-        for y in range(ny):
-            for z in range(nz):
-                if g00[x,y,z] < 0:
-                    continue
-                igmax=np.round(g00[x,y,z]*inv_spacing).astype(int) # maybe we should use "floor" instead of "round"
-                if (igmax==0).all():
-                    g2[x,y,z]=g00[x,y,z]**2
-                else:
-                    ixmin = max(x-igmax[0],0)
-                    ixmax = min(x+igmax[0]+1,nx)
-                    iymin = max(y-igmax[1],0)
-                    iymax = min(y+igmax[1]+1,ny)
-                    izmin = max(z-igmax[2],0)
-                    izmax = min(z+igmax[2]+1,nz)
-                    ix,iy,iz = np.meshgrid(np.arange(ixmin,ixmax),
-                                           np.arange(iymin,iymax),
-                                           np.arange(izmin,izmax),indexing='ij')
-                    g2mesh = _reldiff2(aref[ix,iy,iz],atarget[x,y,z],dd)
-                    g2mesh += ((relspacing[0]*(ix-x)))**2
-                    g2mesh += ((relspacing[1]*(iy-y)))**2
-                    g2mesh += ((relspacing[2]*(iz-z)))**2
-                    g2[x,y,z] = np.min(g2mesh)
-                if verbose:
-                    pbar.update(1)
-    if verbose:
-        pbar.close()
+    if early_stop or kdtree or refine > 1:
+        itarget = np.array(np.nonzero(mask))
+        dtarget = atarget[mask]
+        g2near = _reldiff2(aref[mask],dtarget,dd)
+        g2 = np.zeros(atarget.shape,dtype=float)
+        if workers > 1:
+            g2[mask] = _gamma2_search_parallel(aref,itarget,dtarget,g2near,dd,relspacing,workers=workers,kdtree=kdtree,refine=refine)
+        else:
+            g2[mask] = _gamma2_search(aref,itarget,dtarget,g2near,dd,relspacing,kdtree=kdtree,refine=refine,verbose=verbose)
+    else:
+        # only the bounding box of the mask, padded with the search radius, is needed
+        box = (slice(None),)*3
+        if roi is not None:
+            g2max = np.max(_reldiff2(aref[mask],atarget[mask],dd),initial=0.)
+            box = _mask_box(mask,np.round(np.sqrt(g2max)/relspacing).astype(int))
+        g2 = np.zeros(atarget.shape,dtype=float)
+        if workers > 1:
+            g2[box] = _gamma2_equal_geometry_parallel(aref[box],atarget[box],mask[box],dd,relspacing,workers)
+        else:
+            g2[box] = _gamma2_equal_geometry(aref[box],atarget[box],mask[box],dd,relspacing,verbose)
     g=np.sqrt(g2)
     g[np.logical_not(mask)]=defvalue
     # ITK does not support double precision images by default => cast down to float32.
@@ -125,7 +605,7 @@ def gamma_index_3d_equal_geometry(imgref,imgtarget,dta=3.,dd=3., ddpercent=True,
     return gimg
 
 # FIXME: should this function remain public or be made private (by prefixing it with an _underscore)?
-def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False):
+def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,early_stop=False,workers=1,kdtree=False,roi=None,refine=0):
     """
     Compare 3-dimensional arrays with possibly different spacing and different origin, using the
     gamma index formalism, popular in medical physics.
@@ -135,6 +615,22 @@ def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True
     * If `ddpercent` is False, then dd is taken as an absolute value.
     * `dta` indicates distance scale ("distance to agreement") in millimeter (e.g. 3mm)
     * `threshold` indicates minimum dose value (exclusive) for calculating gamma values
+    * If `early_stop` is True, then the reference voxels are visited in order of
+      increasing distance, for all target voxels at once, and each target voxel
+      stops searching as soon as the spatial distance alone gives a larger gamma
+      value than the best one found so far.
+    * `workers` is the number of worker processes. With more than one worker, the
+      target voxels are split in tiles that are computed in parallel; the result is identical.
+    * If `kdtree` is True, then gamma is computed as a nearest neighbour query in the
+      scaled (x/dta,y/dta,z/dta,dose/dd) space: a KD-tree is built once over the
+      reference voxels and all target voxels are queried in one batch.
+    * `roi` is an ITK mask image (e.g. a label image) with the geometry of the target
+      image, or a `region_of_interest`. If given, only the target voxels inside the ROI are evaluated.
+    * If `refine` is larger than 1, then the gamma values are refined with sub-voxel
+      accuracy: the reference dose is trilinearly interpolated in `refine` steps on the
+      segments between the reference voxel with the lowest gamma value and its 26
+      neighbours. The reference image is not upsampled. The minimum is found with the
+      distance ordered search in this case (`early_stop` and `kdtree` are ignored).
     Returns an image with the same geometry as the target image.
     For all target voxels that are in the overlap region with the refernce image and that have d>threshold,
     a gamma index value is given. For all other voxels the "defvalue" is given.
@@ -158,11 +654,12 @@ def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True
     mx,my,mz = aref.shape
     ntot = nx*ny*nz
     mtot = mx*my*mz
-    dta2  = dta**2
     mask  = atarget>threshold
+    if roi is not None:
+        mask &= _roi_mask(roi,imgtarget)
     nmask=np.sum(mask)
     if nmask==0:
-        logger.error("target has no dose over threshold.")
+        logger.error("target has no dose over threshold (inside the ROI).")
         dummy = itk.image_from_array((np.ones(atarget.shape)*defvalue).swapaxes(0,2).copy())
         dummy.CopyInformation(imgtarget)
         return dummy
@@ -189,44 +686,22 @@ def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True
     logger.debug("Target image has {} x {} x {} = {} voxels.".format(nx,ny,nz,ntot))
     logger.debug("{} target voxels are in the intersection of target and reference image.".format(noverlap))
     logger.debug("{} of these have dose > {}.".format(nmask,threshold))
-    if verbose:
-        pbar = tqdm(total=nmask, leave=False)
     # grid of "close points" in reference image
     xref = areforigin[0]+ixref*arefspacing[0]
     yref = areforigin[1]+iyref*arefspacing[1]
     zref = areforigin[2]+izref*arefspacing[2]
+    # indices of the closest points and relative positions of the target voxels (in units of dta)
+    irefnear = np.array((ixref[mask],iyref[mask],izref[mask]))
+    delta = np.array((xtarget[mask]-xref[mask],ytarget[mask]-yref[mask],ztarget[mask]-zref[mask]))/dta
+    dtarget = atarget[mask]
     # get a gamma value on this closest point
-    gclose2 = np.zeros([nx,ny,nz],dtype=float)
-    gclose2[mask] = _reldiff2(aref[ixref[mask],iyref[mask],izref[mask]],atarget[mask],dd) + \
-                                              ((xtarget[mask]-xref[mask])**2 + \
-                                               (ytarget[mask]-yref[mask])**2 + \
-                                               (ztarget[mask]-zref[mask])**2)/dta2
-    gclose = np.array(np.sqrt(gclose2))
-    #igclose = np.array(np.ceil(np.sqrt(gclose2)),dtype=int)
+    g2near = _reldiff2(aref[tuple(irefnear)],dtarget,dd) + np.sum(delta**2,axis=0)
+    relspacing = arefspacing/dta
     g2=np.zeros([nx,ny,nz],dtype=float)
-    #print("going to loop over {} voxels with large enough dose in reference image".format(np.sum(mask)))
-    for mixref,miyref,mizref,mixtarget,miytarget,miztarget,mgclose in zip(ixref[mask], iyref[mask], izref[mask],
-                                                                    ixtarget[mask],iytarget[mask],iztarget[mask],gclose[mask]):
-        #dtarget = atarget[mixtarget,miytarget,miztarget]
-        #dref = aref[mixref,miyref,mizref]
-        ixyztarget = np.array((mixtarget,miytarget,miztarget))
-        ixyzref = np.array((mixref,miyref,mizref))
-        targetpos = atargetorigin + ixyztarget*atargetspacing
-        refpos = areforigin  + ixyzref*arefspacing
-        dixyz = np.floor(mgclose*dta/arefspacing).astype(int) # or round, or ceil?
-        imax = np.minimum(ixyzref+dixyz+1,(mx,my,mz))
-        imin = np.maximum(ixyzref-dixyz  ,( 0, 0, 0))
-        mixnear,miynear,miznear = np.meshgrid(np.arange(imin[0],imax[0]),
-                                              np.arange(imin[1],imax[1]),
-                                              np.arange(imin[2],imax[2]),
-                                              indexing='ij')
-        g2near  = _reldiff2(aref[mixnear,miynear,miznear],atarget[mixtarget,miytarget,miztarget],dd)
-        g2near += (areforigin[0]+mixnear*arefspacing[0]-targetpos[0])**2/dta2
-        g2near += (areforigin[1]+miynear*arefspacing[1]-targetpos[1])**2/dta2
-        g2near += (areforigin[2]+miznear*arefspacing[2]-targetpos[2])**2/dta2
-        g2[mixtarget,miytarget,miztarget] = np.min(g2near)
-        if verbose:
-            pbar.update(1)
+    if workers > 1:
+        g2[mask] = _gamma2_search_parallel(aref,irefnear,dtarget,g2near,dd,relspacing,delta,early_stop,workers,kdtree,refine)
+    else:
+        g2[mask] = _gamma2_search(aref,irefnear,dtarget,g2near,dd,relspacing,delta,early_stop,kdtree=kdtree,refine=refine,verbose=verbose)
     g=np.sqrt(g2)
     g[np.logical_not(mask)]=defvalue
     # ITK does not support double precision images by default => cast down to float32.
@@ -236,6 +711,289 @@ def gamma_index_3d_unequal_geometry(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True
     logger.debug(f"Computed {nmask} gamma values assuming UNEQUAL geometry in target and reference")
     return gimg
 
+def _nearest_reference_voxels(imgref,imgtarget,zrange=None):
+    """
+    For all target voxels: the (3,nx,ny,nz) indices of the reference voxels that are
+    nearest to the target voxel centers, the (3,nx,ny,nz) positions of the target
+    voxel centers w.r.t. these reference voxel centers (in mm), and the mask of the
+    target voxels for which the nearest reference voxel is inside the reference image.
+    With `zrange=(z0,z1)` only the target slab z0<=iz<z1 is considered.
+    """
+    reforigin = np.array(imgref.GetOrigin()).reshape(3,1,1,1)
+    refspacing = np.array(imgref.GetSpacing()).reshape(3,1,1,1)
+    targetorigin = np.array(imgtarget.GetOrigin()).reshape(3,1,1,1)
+    targetspacing = np.array(imgtarget.GetSpacing()).reshape(3,1,1,1)
+    refshape = np.array(imgref.GetLargestPossibleRegion().GetSize()).reshape(3,1,1,1)
+    nx,ny,nz = imgtarget.GetLargestPossibleRegion().GetSize()
+    z0,z1 = (0,nz) if zrange is None else zrange
+    itarget = np.indices((nx,ny,z1-z0))
+    itarget[2] += z0
+    xtarget = targetorigin+itarget*targetspacing
+    iref = np.round((xtarget-reforigin)/refspacing).astype(int)
+    overlap = np.all((iref>=0)&(iref<refshape),axis=0)
+    delta = xtarget-(reforigin+iref*refspacing)
+    return iref, delta, overlap
+
+def _gamma2_sweep(aref,irefnear,dtarget,dds,dtas,spacing,delta=None,verbose=False):
+    """
+    Distance ordered search with early termination for several criteria at once.
+    * `dds` and `dtas` (m,) absolute dose difference and DTA scales of the m criteria
+    * `spacing` the reference voxel spacing in mm
+    * `delta` (3,n) position of the target voxels w.r.t. the nearest reference voxel
+      in mm, or None if the target voxels coincide with the reference voxels.
+    The other arguments have the same meaning as for `_gamma2_ordered_search`.
+    The reference voxels are visited once, in order of increasing distance, for
+    all criteria; the dose differences and distances are computed only once.
+    Each target voxel drops out of the search as soon as the spatial term of
+    the next offset is larger than its running minimum, for all criteria.
+    Returns the (m,n) squared gamma values of the n target voxels.
+    """
+    dds = np.array(dds,dtype=float).reshape(-1,1)
+    dta2 = np.array(dtas,dtype=float).reshape(-1,1)**2
+    ddiff = dtarget-aref[tuple(irefnear)]
+    dr2near = 0. if delta is None else np.sum(delta**2,axis=0)
+    g2 = (ddiff/dds)**2 + dr2near/dta2
+    active = np.flatnonzero(np.any(g2>0.,axis=0))
+    dr2max = np.max(g2*dta2,initial=0.)
+    offsets,dr2 = _search_offsets(np.array([dr2max]),spacing,exact=delta is None,shape=aref.shape)
+    shape = np.array(aref.shape).reshape(3,1)
+    if verbose:
+        pbar = tqdm(total=len(offsets)-1, leave=False)
+    shell_dr2 = 0.
+    for offset,offset_dr2 in zip(offsets[1:],dr2[1:]):
+        if verbose:
+            pbar.update(1)
+        if offset_dr2 > shell_dr2:
+            # new shell: remove the voxels that cannot get a lower gamma value anymore
+            shell_dr2 = offset_dr2
+            active = active[np.any(g2[:,active]>offset_dr2/dta2,axis=0)]
+            if len(active)==0:
+                break
+        iref = irefnear[:,active]+offset.reshape(3,1)
+        inside = np.all((iref>=0)&(iref<shape),axis=0)
+        if not inside.any():
+            continue
+        iactive = active[inside]
+        ddiff = dtarget[iactive]-aref[tuple(iref[:,inside])]
+        if delta is None:
+            offset_r2 = offset_dr2
+        else:
+            offset_r2 = np.sum((offset.reshape(3,1)*spacing.reshape(3,1)-delta[:,iactive])**2,axis=0)
+        g2[:,iactive] = np.minimum(g2[:,iactive],(ddiff/dds)**2+offset_r2/dta2)
+    if verbose:
+        pbar.close()
+    return g2
+
+def gamma_index_3d_sweep(imgref,imgtarget,criteria,ddpercent=True,threshold=0.,defvalue=-1.,verbose=False,roi=None):
+    """
+    Compute the gamma index for several criteria in a single pass over the reference image.
+    * `criteria` is a list of (dd,dta) pairs, e.g. [(1.,1.),(2.,2.),(3.,3.),(3.,2.)]
+    * `dd` is by default the "dose difference" scale as a relative value, in units percent
+      of the max dose in the reference image. If `ddpercent` is False, then dd is absolute.
+    * `dta` is the distance scale ("distance to agreement") in millimeter.
+    * `threshold` indicates minimum dose value (exclusive) for calculating gamma values
+    * `roi` restricts the evaluation to a region of interest, see `gamma_index_3d_unequal_geometry`
+    The geometries of the images may be different (but not rotated w.r.t. each other).
+    The reference voxels are searched only once, within the largest search radius
+    needed for any of the criteria, and the dose differences are shared between them.
+    Returns a list of gamma images (with the geometry of the target image) and a list
+    of pass rates (fraction of the evaluated target voxels with gamma<=1), in the
+    order of the criteria.
+    """
+    aref = itk.array_view_from_image(imgref).swapaxes(0,2)
+    atarget = itk.array_view_from_image(imgtarget).swapaxes(0,2)
+    dds = np.array([dd for dd,dta in criteria],dtype=float)
+    dtas = np.array([dta for dd,dta in criteria],dtype=float)
+    if ddpercent:
+        dds *= 0.01*np.max(aref)
+    spacing = np.array(imgref.GetSpacing(),dtype=float)
+    mask = atarget>threshold
+    if roi is not None:
+        mask &= _roi_mask(roi,imgtarget)
+    if aref.shape == atarget.shape and \
+       np.allclose(imgref.GetSpacing(),imgtarget.GetSpacing()) and \
+       np.allclose(imgref.GetOrigin(),imgtarget.GetOrigin()):
+        irefnear = np.array(np.nonzero(mask))
+        delta = None
+    else:
+        iref,delta,overlap = _nearest_reference_voxels(imgref,imgtarget)
+        mask &= overlap
+        irefnear = iref[:,mask]
+        delta = delta[:,mask]
+    nmask = int(np.count_nonzero(mask))
+    logger.debug(f"{nmask} target voxels overlap with the reference image and have dose > {threshold}.")
+    g = np.full((len(criteria),)+atarget.shape,defvalue,dtype=float)
+    if nmask==0:
+        logger.error("target has no dose over threshold in the overlap with the reference image.")
+        pass_rates = [np.nan]*len(criteria)
+    else:
+        g[:,mask] = np.sqrt(_gamma2_sweep(aref,irefnear,atarget[mask],dds,dtas,spacing,delta,verbose))
+        pass_rates = [float(np.count_nonzero(gc[mask]<=1.))/nmask for gc in g]
+    gimgs = list()
+    for gc in g:
+        # ITK does not support double precision images by default => cast down to float32.
+        gimg = itk.image_from_array(gc.swapaxes(0,2).astype(np.float32).copy())
+        gimg.CopyInformation(imgtarget)
+        gimgs.append(gimg)
+    return gimgs, pass_rates
+
+def gamma_index_pass_rate(imgref,imgtarget,dta=3.,dd=3.,ddpercent=True,threshold=0.,slab=8,
+                          bins=np.linspace(0.,3.,301),percentiles=(50,90,95,99),kdtree=False,roi=None,verbose=False):
+    """
+    Streaming computation of the gamma pass rate and histogram, without gamma image.
+    The target image is processed in slabs of `slab` planes along z; only the
+    statistics are accumulated, so the memory use for the gamma computation is a
+    few slabs, regardless of the image size. The geometries of the images may be
+    different (but not rotated w.r.t. each other).
+    * `dd`, `ddpercent`, `dta`, `threshold`, `kdtree` and `roi` as for `gamma_index_3d_unequal_geometry`
+    * `bins` are the bin edges of the gamma histogram, gamma values beyond the last
+      edge are counted in the last bin.
+    * `percentiles` of the gamma distribution are estimated by linear interpolation
+      in the histogram, so their precision is limited by the bin width.
+    Returns a dictionary with the number of checked target voxels ("n"), the pass
+    rate ("pass_rate", fraction of the checked voxels with gamma<=1), the mean and
+    maximum gamma value, the histogram ("histogram" and "bin_edges") and the
+    "percentiles" (a dictionary with percentile:gamma items).
+    """
+    aref = itk.array_view_from_image(imgref).swapaxes(0,2)
+    atarget = itk.array_view_from_image(imgtarget).swapaxes(0,2)
+    if ddpercent:
+        dd *= 0.01*np.max(aref)
+    relspacing = np.array(imgref.GetSpacing(),dtype=float)/dta
+    equal = aref.shape == atarget.shape and \
+            np.allclose(imgref.GetSpacing(),imgtarget.GetSpacing()) and \
+            np.allclose(imgref.GetOrigin(),imgtarget.GetOrigin())
+    aroi = None if roi is None else _roi_mask(roi,imgtarget)
+    bins = np.asarray(bins,dtype=float)
+    histogram = np.zeros(len(bins)-1,dtype=np.int64)
+    n,npass,gsum,gmax = 0,0,0.,0.
+    nz = atarget.shape[2]
+    zslabs = range(0,nz,slab)
+    if verbose:
+        zslabs = tqdm(zslabs, leave=False)
+    for z0 in zslabs:
+        z1 = min(z0+slab,nz)
+        mask = atarget[:,:,z0:z1]>threshold
+        if aroi is not None:
+            mask &= aroi[:,:,z0:z1]
+        if equal:
+            irefnear = np.array(np.nonzero(mask))
+            irefnear[2] += z0
+            delta = None
+        else:
+            iref,delta,overlap = _nearest_reference_voxels(imgref,imgtarget,(z0,z1))
+            mask &= overlap
+            irefnear = iref[:,mask]
+            delta = delta[:,mask]/dta
+        if not mask.any():
+            continue
+        dtarget = atarget[:,:,z0:z1][mask]
+        g2near = _reldiff2(aref[tuple(irefnear)],dtarget,dd)
+        if delta is not None:
+            g2near += np.sum(delta**2,axis=0)
+        g = np.sqrt(_gamma2_search(aref,irefnear,dtarget,g2near,dd,relspacing,delta,early_stop=True,kdtree=kdtree))
+        n += len(g)
+        npass += np.sum(g<=1.)
+        gsum += np.sum(g)
+        gmax = max(gmax,np.max(g))
+        histogram += np.histogram(np.clip(g,bins[0],bins[-1]),bins)[0]
+    logger.debug(f"Computed {n} gamma values in slabs of {slab} planes")
+    if n==0:
+        logger.error("target has no dose over threshold in the overlap with the reference image.")
+        return dict(n=0,pass_rate=np.nan,mean=np.nan,max=np.nan,histogram=histogram,bin_edges=bins,
+                    percentiles={p:np.nan for p in percentiles})
+    cumulative = np.concatenate([[0.],np.cumsum(histogram)/n])
+    return dict(n=n,pass_rate=npass/n,mean=gsum/n,max=gmax,histogram=histogram,bin_edges=bins,
+                percentiles={p:np.interp(0.01*p,cumulative,bins) for p in percentiles})
+
+def _frame_stack(frames):
+    """
+    Convenience function for `gamma_index_2d_batch`: returns a 3D image with the
+    frames along the third axis, given either such a 3D image or a list of 2D images.
+    """
+    if not isinstance(frames,(list,tuple)):
+        return frames
+    aframes = np.stack([itk.array_view_from_image(frame) for frame in frames])
+    img = itk.image_from_array(aframes)
+    img.SetSpacing(tuple(frames[0].GetSpacing())+(1.,))
+    img.SetOrigin(tuple(frames[0].GetOrigin())+(0.,))
+    return img
+
+def _gamma2_frames(aref,atarget,mask,dd,relspacing):
+    """
+    Squared gamma values for a stack of 2D frames (axis 2 is the frame index),
+    with a dose difference scale `dd` per frame (array of length nframes).
+    This is the offset shell search of `_gamma2_equal_geometry`, with offsets in
+    the frame plane only, such that all frames are computed in each array operation.
+    The squared gamma value of voxels outside of the mask is zero.
+    """
+    dd = np.asarray(dd,dtype=float).reshape(1,1,-1)
+    g2 = np.where(mask,_reldiff2(aref,atarget,dd),0.)
+    g2max = np.max(g2,initial=0.)
+    igmax = np.round(np.sqrt(g2max)/relspacing).astype(int)
+    igmax[2] = 0
+    offsets,dr2 = _offset_shell(igmax,relspacing,shape=atarget.shape,dr2max=g2max)
+    logger.debug("searching {} in-frame offsets within {} voxels".format(len(offsets),igmax[:2]))
+    shell_dr2 = 0.
+    for offset,offset_dr2 in zip(offsets[1:],dr2[1:]):
+        if offset_dr2 > shell_dr2:
+            shell_dr2 = offset_dr2
+            if offset_dr2 >= np.max(g2):
+                break
+        slices = _shifted_slices(offset,atarget.shape)
+        if slices is None:
+            continue
+        tslices,rslices = slices
+        g2offset = _reldiff2(aref[rslices],atarget[tslices],dd)
+        g2offset += offset_dr2
+        np.minimum(g2[tslices],g2offset,out=g2[tslices])
+    g2[np.logical_not(mask)] = 0.
+    return g2
+
+def gamma_index_2d_batch(ref,target,dta=3.,dd=3.,ddpercent=True,threshold=0.,defvalue=-1.):
+    """
+    Compute the 2D gamma index for a stack of frames (e.g. EPID or portal dose images),
+    every frame independently, with all frames computed in the same array operations.
+    * `ref` and `target` are either 3D images, of which the third axis is the frame index,
+      or lists of 2D images. Reference and target should have the same geometry.
+    * `dd` is by default the "dose difference" scale as a relative value, in units percent
+      of the max dose in the reference frame (so every frame gets its own normalization).
+      If `ddpercent` is False, then dd is an absolute value.
+    * `dta` is the distance scale ("distance to agreement") in millimeter.
+    * `threshold` indicates minimum dose value (exclusive) for calculating gamma values
+    Returns a 3D gamma image with the geometry of the (stacked) target image and an
+    array with the pass rate of every frame (fraction of the voxels with dose>threshold
+    with gamma<=1, NaN for frames without such voxels).
+    """
+    imgref = _frame_stack(ref)
+    imgtarget = _frame_stack(target)
+    aref = itk.array_view_from_image(imgref).swapaxes(0,2)
+    atarget = itk.array_view_from_image(imgtarget).swapaxes(0,2)
+    if aref.shape != atarget.shape:
+        raise ValueError("input frames have different geometries ({} vs {} voxels)".format(aref.shape,atarget.shape))
+    if not np.allclose(tuple(imgref.GetSpacing())[:2],tuple(imgtarget.GetSpacing())[:2]) or \
+       not np.allclose(tuple(imgref.GetOrigin())[:2],tuple(imgtarget.GetOrigin())[:2]):
+        raise ValueError("input frames have different geometries")
+    nframes = aref.shape[2]
+    dds = np.full(nframes,dd,dtype=float)
+    if ddpercent:
+        dds *= 0.01*np.max(aref,axis=(0,1))
+    mask = atarget>threshold
+    # frames without reference dose cannot be normalized
+    mask[:,:,dds<=0.] = False
+    dds[dds<=0.] = 1.
+    relspacing = np.array(tuple(imgref.GetSpacing())[:2]+(1.,),dtype=float)/dta
+    g = np.sqrt(_gamma2_frames(aref,atarget,mask,dds,relspacing))
+    nmask = np.sum(mask,axis=(0,1))
+    npass = np.sum(mask&(g<=1.),axis=(0,1))
+    with np.errstate(invalid='ignore',divide='ignore'):
+        pass_rates = np.where(nmask>0,npass/nmask,np.nan)
+    g[np.logical_not(mask)] = defvalue
+    gimg = itk.image_from_array(g.swapaxes(0,2).astype(np.float32).copy())
+    gimg.CopyInformation(imgtarget)
+    logger.debug(f"Computed {np.sum(nmask)} gamma values in {nframes} frames")
+    return gimg, pass_rates
+
 #####################################################################################
 # TODO: include the unit test in implementation (like here), or have it in a separate test directory?
 #####################################################################################
@@ -283,6 +1041,57 @@ class Test_GammaIndex3dIdenticalMesh(LoggedTestCase):
         self.assertTrue(np.allclose(itk.array_view_from_image(img_gamma_odd_even),itk.array_view_from_image(img_gamma_even_odd)))
         self.assertTrue(np.allclose(itk.array_view_from_image(img_gamma_odd_even),0.5))
         logger.debug("DONE test checkerboards")
+    def test_brute_force(self):
+        # compare with the minimum over *all* reference voxels, computed by brute force
+        logger.debug('Test_GammaIndex3dIdenticalMesh test_brute_force')
+        np.random.seed(1234570)
+        nxyz = (5,6,7)
+        sxyz = np.array((1.,1.5,2.))
+        dta,ddp = 2.,3.
+        a_ref = np.random.uniform(0.,10.,nxyz)
+        a_target = a_ref*np.random.normal(1.,0.1,nxyz)
+        img_ref = itk.image_from_array(a_ref.swapaxes(0,2).copy())
+        img_ref.SetSpacing(sxyz)
+        img_target = itk.image_from_array(a_target.swapaxes(0,2).copy())
+        img_target.SetSpacing(sxyz)
+        img_gamma = gamma_index_3d_equal_geometry(img_ref,img_target,dd=ddp,dta=dta)
+        agamma = itk.array_view_from_image(img_gamma).swapaxes(0,2)
+        pos = np.stack(np.meshgrid(*[np.arange(n)*s for n,s in zip(nxyz,sxyz)],indexing='ij'),axis=-1).reshape(-1,3)
+        dr2 = np.sum((pos[:,np.newaxis,:]-pos[np.newaxis,:,:])**2,axis=2)/dta**2
+        dd2 = (a_target.reshape(-1,1)-a_ref.reshape(1,-1))**2/(0.01*ddp*np.max(a_ref))**2
+        gamma_expected = np.sqrt(np.min(dr2+dd2,axis=1)).reshape(nxyz)
+        self.assertTrue( np.allclose(agamma,gamma_expected,atol=1e-6) )
+    def test_early_stop(self):
+        # the distance ordered search with early termination should give the same result
+        logger.debug('Test_GammaIndex3dIdenticalMesh test_early_stop')
+        np.random.seed(1234571)
+        for i in range(3):
+            nxyz = np.random.randint(6,12,3)
+            sxyz = np.random.uniform(0.5,2.5,3)
+            a_ref = np.random.uniform(0.,10.,nxyz)
+            a_target = a_ref*np.random.normal(1.,0.1,nxyz)
+            img_ref = itk.image_from_array(a_ref.swapaxes(0,2).copy())
+            img_ref.SetSpacing(sxyz)
+            img_target = itk.image_from_array(a_target.swapaxes(0,2).copy())
+            img_target.SetSpacing(sxyz)
+            img_gamma = gamma_index_3d_equal_geometry(img_ref,img_target,dd=2.,dta=2.,threshold=1.)
+            img_gamma_es = gamma_index_3d_equal_geometry(img_ref,img_target,dd=2.,dta=2.,threshold=1.,early_stop=True)
+            self.assertTrue( np.allclose(itk.array_view_from_image(img_gamma),itk.array_view_from_image(img_gamma_es)) )
+            img_gamma_kd = gamma_index_3d_equal_geometry(img_ref,img_target,dd=2.,dta=2.,threshold=1.,kdtree=True)
+            self.assertTrue( np.allclose(itk.array_view_from_image(img_gamma),itk.array_view_from_image(img_gamma_kd)) )
+    def test_workers(self):
+        # the tiled multi-process computation should give bit-identical results
+        logger.debug('Test_GammaIndex3dIdenticalMesh test_workers')
+        np.random.seed(1234572)
+        nxyz = (12,11,17)
+        a_ref = np.random.uniform(0.,10.,nxyz)
+        a_target = a_ref*np.random.normal(1.,0.05,nxyz)
+        img_ref = itk.image_from_array(a_ref.swapaxes(0,2).copy())
+        img_target = itk.image_from_array(a_target.swapaxes(0,2).copy())
+        for early_stop in (False,True):
+            img_gamma = gamma_index_3d_equal_geometry(img_ref,img_target,dd=3.,dta=2.,threshold=1.,early_stop=early_stop)
+            img_gamma_mp = gamma_index_3d_equal_geometry(img_ref,img_target,dd=3.,dta=2.,threshold=1.,early_stop=early_stop,workers=3)
+            self.assertTrue( np.array_equal(itk.array_view_from_image(img_gamma),itk.array_view_from_image(img_gamma_mp)) )
     def test_large_image(self):
         logger.debug('Test_GammaIndex3dIdenticalMesh test_large_image')
         for N in [1,2,5,10,20]:
@@ -332,6 +1141,33 @@ class Test_GammaIndex3dUnequalMesh(LoggedTestCase):
             logger.debug("uneq last 2x2x2: {}".format(auneq[-2:,-2:,-2:]))
             self.assertTrue( np.allclose(aeq,auneq) )
             logger.debug("Yay!")
+    def test_workers(self):
+        # the tiled multi-process computation should give bit-identical results
+        logger.debug('Test_GammaIndex3dUnequalMesh test_workers')
+        np.random.seed(1234573)
+        img_ref = itk.image_from_array(np.random.normal(1.,0.1,(20,14,12)))
+        img_ref.SetSpacing((1.,1.5,2.))
+        img_target = itk.image_from_array(np.random.normal(1.,0.1,(9,7,6)))
+        img_target.SetSpacing((2.,3.,4.))
+        img_target.SetOrigin((1.1,0.7,-0.4))
+        for early_stop in (False,True):
+            img_gamma = gamma_index_3d_unequal_geometry(img_ref,img_target,dd=5.,dta=3.,early_stop=early_stop)
+            img_gamma_mp = gamma_index_3d_unequal_geometry(img_ref,img_target,dd=5.,dta=3.,early_stop=early_stop,workers=2)
+            self.assertTrue( np.array_equal(itk.array_view_from_image(img_gamma),itk.array_view_from_image(img_gamma_mp)) )
+    def test_kdtree(self):
+        # the KD-tree search finds the same minimum as the (exhaustive) distance ordered search
+        logger.debug('Test_GammaIndex3dUnequalMesh test_kdtree')
+        np.random.seed(1234577)
+        for i in range(3):
+            img_ref = itk.image_from_array(np.random.uniform(0.5,1.5,(16,18,20)))
+            img_ref.SetSpacing(np.random.uniform(0.5,1.5,3))
+            img_target = itk.image_from_array(np.random.uniform(0.5,1.5,(6,7,8)))
+            img_target.SetSpacing(np.random.uniform(1.5,2.5,3))
+            img_target.SetOrigin(np.random.uniform(0.,2.,3))
+            img_gamma = gamma_index_3d_unequal_geometry(img_ref,img_target,dd=10.,dta=2.,threshold=0.7,early_stop=True)
+            for workers in (1,2):
+                img_gamma_kd = gamma_index_3d_unequal_geometry(img_ref,img_target,dd=10.,dta=2.,threshold=0.7,kdtree=True,workers=workers)
+                self.assertTrue( np.allclose(itk.array_view_from_image(img_gamma),itk.array_view_from_image(img_gamma_kd)) )
     def test_Shift(self):
         # two images identical up to a translation less than half the spacing should yield a gamma index 
         # equal to the ratio of the length of the translation vector and the DTA.
@@ -352,10 +1188,11 @@ class Test_GammaIndex3dUnequalMesh(LoggedTestCase):
             img_target.SetOrigin(oxyz+txyz) # translated!
             ddp = 3.0 # %
             dta = 2.0 # mm
-            img_gamma = gamma_index_3d_unequal_geometry(img_ref,img_target,dd=ddp,dta=dta)
-            agamma = itk.array_view_from_image(img_gamma).swapaxes(0,2)
             gval_expected = np.sqrt( np.sum( (txyz/dta)**2 ) )
-            self.assertTrue( np.allclose(agamma,gval_expected) )
+            for early_stop in (False,True):
+                img_gamma = gamma_index_3d_unequal_geometry(img_ref,img_target,dd=ddp,dta=dta,early_stop=early_stop)
+                agamma = itk.array_view_from_image(img_gamma).swapaxes(0,2)
+                self.assertTrue( np.allclose(agamma,gval_expected) )
             logger.debug("ok #voxels={} gval_exp={}".format(np.prod(nxyz),gval_expected) )
     def test_Gradient(self):
         # Let ref and target be two 3D images that are effectively 1D images (only vary in X)
@@ -427,11 +1264,163 @@ class Test_GammaIndex3dUnequalMesh(LoggedTestCase):
                     #################################################
                     # calculate gamma gamma_index_3d_unequal_geometry
                     #################################################
-                    img_gamma = gamma_index_3d_unequal_geometry(img_ref,img_target,dd=ddp,dta=dta)
-                    logger.debug(type(img_gamma))
-                    agamma = itk.array_view_from_image(img_gamma).swapaxes(0,2)
-                    self.assertTrue( np.allclose(agamma,gamma_all) )
+                    for early_stop in (False,True):
+                        img_gamma = gamma_index_3d_unequal_geometry(img_ref,img_target,dd=ddp,dta=dta,early_stop=early_stop)
+                        logger.debug(type(img_gamma))
+                        agamma = itk.array_view_from_image(img_gamma).swapaxes(0,2)
+                        self.assertTrue( np.allclose(agamma,gamma_all) )
                     logger.debug("ok ddp={} dta={} refGRAD={} targetGRAD={}".format(ddp,dta,refGRAD,targetGRAD))
             logger.debug("{}th gradient test finished".format(i))
 
 # vim: set et ts=4 ai sw=4:
+
+class Test_GammaIndexSweep(LoggedTestCase):
+    def test_sweep(self):
+        # the single pass sweep should give the same gamma values as separate computations
+        logger.debug('Test_GammaIndexSweep test_sweep')
+        np.random.seed(1234583)
+        criteria = [(1.,1.),(2.,2.),(3.,3.),(3.,2.)]
+        img_ref = itk.image_from_array(np.random.uniform(0.5,1.5,(12,14,16)))
+        img_ref.SetSpacing((1.,1.2,1.5))
+        for equal in (True,False):
+            img_target = itk.image_from_array(np.random.uniform(0.5,1.5,(12,14,16) if equal else (5,6,7)))
+            if equal:
+                img_target.CopyInformation(img_ref)
+            else:
+                img_target.SetSpacing((2.5,2.,3.))
+                img_target.SetOrigin((0.7,1.1,1.3))
+            gimgs,pass_rates = gamma_index_3d_sweep(img_ref,img_target,criteria,threshold=0.7)
+            self.assertEqual(len(gimgs),len(criteria))
+            for (dd,dta),gimg,pass_rate in zip(criteria,gimgs,pass_rates):
+                self.assertIsInstance(pass_rate,float)
+                img_gamma = get_gamma_index(img_ref,img_target,dd=dd,dta=dta,threshold=0.7,early_stop=True)
+                agamma = itk.array_view_from_image(img_gamma)
+                self.assertTrue( np.allclose(agamma,itk.array_view_from_image(gimg)) )
+                self.assertAlmostEqual(pass_rate,np.sum((agamma>=0)&(agamma<=1))/np.sum(agamma>=0))
+
+class Test_GammaIndexPassRate(LoggedTestCase):
+    def test_pass_rate(self):
+        # the streaming statistics should agree with the full gamma image
+        logger.debug('Test_GammaIndexPassRate test_pass_rate')
+        np.random.seed(1234589)
+        img_ref = itk.image_from_array(np.random.uniform(0.5,1.5,(17,14,12)))
+        img_ref.SetSpacing((1.,1.2,1.5))
+        for equal in (True,False):
+            img_target = itk.image_from_array(np.random.uniform(0.5,1.5,(17,14,12) if equal else (7,6,5)))
+            if equal:
+                img_target.CopyInformation(img_ref)
+            else:
+                img_target.SetSpacing((2.5,2.,3.))
+                img_target.SetOrigin((0.7,1.1,1.3))
+            agamma = itk.array_view_from_image(get_gamma_index(img_ref,img_target,dd=5.,dta=2.,threshold=0.7,early_stop=True))
+            g = np.asarray(agamma[agamma>=0])
+            for slab in (1,3,100):
+                stats = gamma_index_pass_rate(img_ref,img_target,dd=5.,dta=2.,threshold=0.7,slab=slab)
+                self.assertEqual(stats["n"],len(g))
+                self.assertAlmostEqual(stats["pass_rate"],np.sum(g<=1.)/len(g))
+                self.assertAlmostEqual(stats["mean"],np.mean(g),places=5)
+                self.assertAlmostEqual(stats["max"],np.max(g),places=5)
+                self.assertEqual(np.sum(stats["histogram"]),len(g))
+                self.assertLess(abs(stats["percentiles"][50]-np.median(g)),0.02)
+
+class Test_GammaIndexROI(LoggedTestCase):
+    def test_roi(self):
+        # only voxels inside the ROI are evaluated, with the same values as without ROI
+        logger.debug('Test_GammaIndexROI test_roi')
+        np.random.seed(1234591)
+        img_ref = itk.image_from_array(np.random.uniform(0.5,1.5,(20,18,16)))
+        img_ref.SetSpacing((1.,1.2,1.5))
+        for equal in (True,False):
+            img_target = itk.image_from_array(np.random.uniform(0.5,1.5,(20,18,16) if equal else (9,8,7)))
+            if equal:
+                img_target.CopyInformation(img_ref)
+            else:
+                img_target.SetSpacing((2.5,2.,3.))
+                img_target.SetOrigin((0.7,1.1,1.3))
+            alabels = np.zeros(itk.array_view_from_image(img_target).shape,dtype=np.uint8)
+            alabels[1:4,2:5,3:6] = 1
+            alabels[4:6,1:3,2:8] = 2
+            img_labels = itk.image_from_array(alabels)
+            img_labels.CopyInformation(img_target)
+            agamma = itk.array_view_from_image(get_gamma_index(img_ref,img_target,dd=5.,dta=2.,threshold=0.7))
+            for early_stop in (False,True):
+                agamma_roi = itk.array_view_from_image(get_gamma_index(img_ref,img_target,dd=5.,dta=2.,threshold=0.7,
+                                                                       early_stop=early_stop,roi=img_labels))
+                self.assertTrue( np.allclose(agamma_roi[alabels>0],agamma[alabels>0]) )
+                self.assertTrue( np.all(agamma_roi[alabels==0]==-1.) )
+            img_gamma,pass_rates = get_gamma_index_by_roi(img_ref,img_target,img_labels,dd=5.,dta=2.,threshold=0.7)
+            self.assertEqual(sorted(pass_rates.keys()),[1,2])
+            for label in (1,2):
+                g = agamma[(alabels==label)&(agamma>=0)]
+                self.assertEqual(pass_rates[label]["n"],len(g))
+                self.assertIsInstance(pass_rates[label]["n"],int)
+                self.assertIsInstance(pass_rates[label]["pass_rate"],float)
+                self.assertAlmostEqual(pass_rates[label]["pass_rate"],np.sum(g<=1.)/len(g))
+            agamma_roi = itk.array_view_from_image(img_gamma)
+            self.assertTrue( np.all(agamma_roi[alabels==0]==-1.) )
+
+class Test_GammaIndexRefine(LoggedTestCase):
+    def test_refine(self):
+        # a linear dose gradient on a coarse reference grid, compared with the same
+        # gradient on a fine target grid: with sub-voxel interpolation gamma vanishes
+        logger.debug('Test_GammaIndexRefine test_refine')
+        refN,refS = (20,5,5),(2.,2.,2.)
+        tN,tS,tO = (36,4,4),(1.,1.,1.),(1.,2.,2.)
+        aref = np.fromfunction(lambda ix,iy,iz: 1.+0.1*ix*refS[0],refN)
+        atarget = np.fromfunction(lambda ix,iy,iz: 1.+0.1*(tO[0]+ix*tS[0]),tN)
+        img_ref = itk.image_from_array(aref.swapaxes(0,2).copy())
+        img_ref.SetSpacing(refS)
+        img_target = itk.image_from_array(atarget.swapaxes(0,2).copy())
+        img_target.SetSpacing(tS)
+        img_target.SetOrigin(tO)
+        agamma = itk.array_view_from_image(gamma_index_3d_unequal_geometry(img_ref,img_target,dd=1.,dta=1.,early_stop=True)).copy()
+        self.assertGreater(np.max(agamma),0.1)
+        for workers in (1,2):
+            agamma_refined = itk.array_view_from_image(gamma_index_3d_unequal_geometry(img_ref,img_target,dd=1.,dta=1.,refine=2,workers=workers))
+            self.assertTrue( np.all(agamma_refined<=agamma+1e-6) )
+            self.assertLess(np.max(agamma_refined),1e-3)
+        # random images: refinement never increases gamma, and it is consistent between implementations
+        np.random.seed(1234597)
+        img_ref = itk.image_from_array(np.random.uniform(0.5,1.5,(10,12,14)))
+        img_target = itk.image_from_array(np.random.uniform(0.5,1.5,(10,12,14)))
+        agamma = itk.array_view_from_image(gamma_index_3d_equal_geometry(img_ref,img_target,dd=5.,dta=2.,early_stop=True))
+        agamma_eq = itk.array_view_from_image(gamma_index_3d_equal_geometry(img_ref,img_target,dd=5.,dta=2.,refine=4))
+        agamma_uneq = itk.array_view_from_image(gamma_index_3d_unequal_geometry(img_ref,img_target,dd=5.,dta=2.,refine=4))
+        self.assertTrue( np.all(agamma_eq<=agamma+1e-6) )
+        self.assertLess(np.mean(agamma_eq),np.mean(agamma))
+        self.assertTrue( np.allclose(agamma_eq,agamma_uneq) )
+
+class Test_GammaIndex2dBatch(LoggedTestCase):
+    def test_batch(self):
+        # every frame should give the same result as a single 2D frame, computed as a 3D image with one slice
+        logger.debug('Test_GammaIndex2dBatch test_batch')
+        np.random.seed(1234601)
+        nframes = 6
+        aref = np.random.uniform(0.5,1.5,(nframes,15,17))*np.arange(1,nframes+1).reshape(-1,1,1)
+        atarget = aref*np.random.normal(1.,0.05,aref.shape)
+        atarget[2] = 0. # empty frame
+        img_ref = itk.image_from_array(aref)
+        img_ref.SetSpacing((1.,1.5,10.))
+        img_target = itk.image_from_array(atarget)
+        img_target.SetSpacing((1.,1.5,10.))
+        img_gamma,pass_rates = gamma_index_2d_batch(img_ref,img_target,dd=3.,dta=2.,threshold=0.6)
+        agamma = itk.array_view_from_image(img_gamma)
+        self.assertEqual(len(pass_rates),nframes)
+        self.assertTrue(np.isnan(pass_rates[2]))
+        for i in range(nframes):
+            img_ref_i = itk.image_from_array(aref[i:i+1].copy())
+            img_ref_i.SetSpacing((1.,1.5,10.))
+            img_target_i = itk.image_from_array(atarget[i:i+1].copy())
+            img_target_i.SetSpacing((1.,1.5,10.))
+            agamma_i = itk.array_view_from_image(gamma_index_3d_equal_geometry(img_ref_i,img_target_i,dd=3.,dta=2.,threshold=0.6))
+            self.assertTrue( np.allclose(agamma[i],agamma_i[0]) )
+            if i != 2:
+                self.assertAlmostEqual(pass_rates[i],np.sum((agamma_i>=0)&(agamma_i<=1))/np.sum(agamma_i>=0))
+        # list of 2D frames
+        frames_ref = [itk.image_from_array(a.copy()) for a in aref]
+        frames_target = [itk.image_from_array(a.copy()) for a in atarget]
+        for f in frames_ref+frames_target:
+            f.SetSpacing((1.,1.5))
+        img_gamma_list,pass_rates_list = gamma_index_2d_batch(frames_ref,frames_target,dd=3.,dta=2.,threshold=0.6)
+        self.assertTrue( np.array_equal(itk.array_view_from_image(img_gamma_list),agamma) )
+        self.assertTrue( np.allclose(pass_rates_list,pass_rates,equal_nan=True) )
@@ -49,9 +49,12 @@ This module provides basic arithmatic image operations for ITK images, e.g. dose
 
 
 import os
+import json
 import itk
+import xxhash
 import numpy as np
-from functools import reduce
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 import operator
 import ctypes # needed for definition of "unsigned long", as np.uint32 is not recognized as such
 import logging
@@ -65,61 +68,283 @@ def _image_size(img):
     # TODO: the numpy array shape is a tuple. Would it be useful to convert that tuple to a numpy array?
     return img.GetLargestPossibleRegion().GetSize()
 
-def _image_list(input_list):
+def _image_list(input_list,prefetch=0):
     """
     Helper function to turn a list of  filenames and/or image objects into a list of image objects.
 
     Image objects are used as they are, without creating a copy.
     For each valid image filename an image object is created.
-    All images with the same size, spacing and origin as the first image are returned as a list.
-    Images with incompatible geometry are silently ignored.
-    TODO: should we sound the alarm (warnings/errors, raise exceptions) in case of incompatible geometries?
+    Scalars are turned into (float) images with the geometry of the first image.
+    All images must have the same size, spacing and origin as the first image,
+    otherwise a TypeError is raised (see `_image_stream`).
     TODO: discuss policy in case of empty/erroneous input
     TODO: is a 'TypeError' the correct exception to raise in case of incompatible image types, or should it be InputError?
+    With `prefetch`>0 the image files are read by `_prefetch_images`.
     """
-    input_images=list()
-    for img in input_list:
-        if hasattr(img,"GetSpacing") and hasattr(img,"GetOrigin"):
-            # semi-duck-typing
-            input_images.append(img)
-        elif isinstance(img, str) and os.path.exists(img):
-            input_images.append(itk.imread(img))
-        elif (not hasattr(img, 'len')) and (not isinstance(img, str)):
-            if not input_images:
-              raise RuntimeError("Pass an image before a scalar to have a model")
-            duplicator = itk.ImageDuplicator.New(input_images[0])
-            duplicator.Update()
-            InputType = type(input_images[0])
-            input_dimension = input_images[0].GetImageDimension()
-            OutputType = itk.Image[itk.F, input_dimension]
-            castFilter = itk.CastImageFilter[InputType, OutputType].New()
-            castFilter.SetInput(duplicator.GetOutput())
-            castFilter.Update()
-            scalarImage = castFilter.GetOutput()
-            scalarImage.FillBuffer(img)
-            input_images += [scalarImage]
+    return list(_image_stream(input_list,prefetch))
+
+def _image_information(img):
+    """
+    Helper function: copy of the size, origin, spacing and direction of an image,
+    so that the geometry can be checked and reproduced without keeping the image itself.
+    """
+    return dict(size=tuple(_image_size(img)),origin=tuple(img.GetOrigin()),spacing=tuple(img.GetSpacing()),
+                direction=itk.array_from_matrix(img.GetDirection()))
+
+def _image_header(filename):
+    """
+    Helper function: the geometry of an image file (see `_image_information`),
+    read from the header only, without reading the pixel data. Also gives the
+    pixel component type (as an ITK string, e.g. "float"), the number of
+    components and whether the file can be read region by region ("streamable").
+    """
+    io = itk.ImageIOFactory.CreateImageIO(filename, itk.CommonEnums.IOFileMode_ReadMode)
+    if io is None:
+        raise TypeError("ERROR: {} is not an image file that can be read by ITK".format(filename))
+    io.SetFileName(filename)
+    io.ReadImageInformation()
+    ndim = io.GetNumberOfDimensions()
+    return dict(size=tuple(io.GetDimensions(i) for i in range(ndim)),
+                origin=tuple(io.GetOrigin(i) for i in range(ndim)),
+                spacing=tuple(io.GetSpacing(i) for i in range(ndim)),
+                direction=np.array([io.GetDirection(i) for i in range(ndim)]).T,
+                component=io.GetComponentTypeAsString(io.GetComponentType()),
+                components=io.GetNumberOfComponents(),
+                streamable=bool(io.CanStreamRead()))
+
+def _geometry_mismatch(img,info0):
+    """
+    Helper function: compare the geometry of `img` (an image, or the geometry
+    information of an image) with the geometry given by `info0` (as returned by
+    `_image_information` or `_image_header`). Returns None if they match, and
+    otherwise a dictionary with the first mismatching "field" (size, origin or
+    spacing), the "expected" and "found" values and an error "message".
+    """
+    if isinstance(img,dict):
+        img_size,img_origin,img_spacing = img["size"],img["origin"],img["spacing"]
+    else:
+        img_size,img_origin,img_spacing = _image_size(img),img.GetOrigin(),img.GetSpacing()
+    size0,origin0,spacing0 = info0["size"],info0["origin"],info0["spacing"]
+    if len(img_size) != len(size0) or not np.allclose(img_size, size0):
+        field,expected,found = "size",tuple(size0),tuple(img_size)
+        message = "images have incompatible size: {} versus {}".format(size0,img_size)
+    elif not np.allclose(img_origin,origin0):
+        field,expected,found = "origin",tuple(origin0),tuple(img_origin)
+        message = "images have incompatible origins: {} versus {}".format(origin0,img_origin)
+    elif not np.allclose(img_spacing,spacing0):
+        field,expected,found = "spacing",tuple(spacing0),tuple(img_spacing)
+        message = "images have incompatible {} spacing: {} versus {}".format(
+            "pixel" if len(spacing0)==2 else "voxel",spacing0,img_spacing)
+    else:
+        return None
+    return dict(field=field,expected=expected,found=found,message=message)
+
+def _check_geometry(img,info0):
+    """
+    Helper function: raise a TypeError if the geometry of `img` (an image, or
+    the geometry information of an image) differs from the geometry given by
+    `info0` (as returned by `_image_information` or `_image_header`).
+    """
+    mismatch = _geometry_mismatch(img,info0)
+    if mismatch is not None:
+        raise TypeError(mismatch["message"])
+
+def probe_image_geometry(input_list):
+    """
+    Check that all images in `input_list` (image filenames and/or image objects,
+    numbers are skipped) have the same size, origin and spacing, without reading
+    any pixel data: for files only the header is read (MHD, MHA, NRRD, NIfTI and
+    the other formats for which ITK can read the image information separately).
+    Returns a report (dictionary) with:
+    * "reference": the first readable input, to which the others are compared
+    * "geometry": the size, origin, spacing and direction of the reference
+    * "compatible": the list of inputs with the same geometry (including the reference)
+    * "incompatible": a list with one dictionary per incompatible input, with the
+      "input", the mismatching "field" ("size", "origin", "spacing", or "file" for
+      inputs that are not readable images), the "expected" and "found" values, and
+      an error "message".
+    """
+    report = dict(reference=None,geometry=None,compatible=list(),incompatible=list())
+    for item in input_list:
+        info = None
+        if hasattr(item,"GetSpacing") and hasattr(item,"GetOrigin"):
+            info = _image_information(item)
+        elif isinstance(item, str) and os.path.exists(item):
+            try:
+                info = _image_header(item)
+            except (TypeError,RuntimeError) as e:
+                message = "ERROR: {} is not an image file that can be read by ITK".format(item)
+        elif (not hasattr(item, 'len')) and (not isinstance(item, str)) and np.isscalar(item):
+            continue
+        else:
+            message = "ERROR: {} is not an ITK image object nor a path to an existing image file".format(item)
+        if info is None:
+            report["incompatible"].append(dict(input=item,field="file",expected=None,found=None,message=message))
+            continue
+        if report["geometry"] is None:
+            report["reference"],report["geometry"] = item,info
+            report["compatible"].append(item)
+            continue
+        mismatch = _geometry_mismatch(info,report["geometry"])
+        if mismatch is None:
+            report["compatible"].append(item)
+        else:
+            mismatch["input"] = item
+            report["incompatible"].append(mismatch)
+    return report
+
+def _validate_image_list(input_list):
+    """
+    Helper function: check the geometry of all inputs from their headers (see
+    `probe_image_geometry`) before any pixel data is read, and raise a TypeError
+    for the first incompatible input, with the number of incompatible inputs.
+    Only lists and tuples are checked, other iterables are read only once.
+    """
+    if not isinstance(input_list,(list,tuple)) or not any(isinstance(item,str) for item in input_list):
+        return
+    report = probe_image_geometry(input_list)
+    incompatible = report["incompatible"]
+    if incompatible:
+        message = incompatible[0]["message"]
+        if len(incompatible) > 1:
+            message += " ({} of {} inputs are incompatible, first: {})".format(
+                len(incompatible),len(input_list),incompatible[0]["input"])
+        raise TypeError(message)
+
+def _image_from_array(np_array,info):
+    """
+    Helper function: create an image from a numpy array, with the geometry given
+    by `info` (as returned by `_image_information`).
+    """
+    img = itk.image_from_array(np_array)
+    img.SetOrigin(info["origin"])
+    img.SetSpacing(info["spacing"])
+    img.SetDirection(itk.matrix_from_array(info["direction"]))
+    return img
+
+# MetaImage pixel types that `_read_image` decodes itself, with the same ITK pixel type as `itk.imread`
+_decoded_element_types = ("MET_UCHAR","MET_SHORT","MET_USHORT","MET_INT","MET_UINT","MET_FLOAT","MET_DOUBLE")
+
+def _read_image(filename):
+    """
+    Helper function: read an image file. ITK holds the GIL while it reads and
+    decodes a file, Python file reads do not. The pixel data of uncompressed
+    scalar MetaImage files (.mhd/.raw or .mha) is therefore read once, with a
+    plain Python read into a numpy array, and the image is made from that array,
+    so that several threads can wait for a slow (network) file system at the
+    same time. Other files are read with `itk.imread`.
+    """
+    if not filename.lower().endswith((".mhd",".mha")):
+        return itk.imread(filename)
+    from .image_memmap import _mhd_layout
+    try:
+        layout = _mhd_layout(filename)
+    except ValueError:
+        return itk.imread(filename)
+    if layout["header"]["ElementType"] not in _decoded_element_types or len(layout["shape"]) != len(layout["size"]):
+        return itk.imread(filename)
+    np_data = np.empty(layout["shape"],dtype=layout["dtype"])
+    with open(layout["datafile"],"rb") as f:
+        f.seek(layout["offset"])
+        if f.readinto(memoryview(np_data).cast("B")) != np_data.nbytes:
+            raise RuntimeError("ERROR: the data file of {} is too short".format(filename))
+    if not np_data.dtype.isnative:
+        np_data = np_data.astype(np_data.dtype.newbyteorder("="))
+    return _image_from_array(np_data,layout)
+
+def _prefetch_images(input_list,prefetch=0):
+    """
+    Generator that yields the items of `input_list` in the same order, with the
+    image filenames replaced by the images, which are read by a pool of `prefetch`
+    threads while the previous images are being used. At most `prefetch` files are
+    read ahead, so at most prefetch+1 images are in memory at the same time.
+    With `prefetch`=0 the items are yielded unchanged (the files are read later,
+    one by one, by the caller).
+    """
+    if prefetch < 1:
+        yield from input_list
+        return
+    pool = ThreadPoolExecutor(max_workers=prefetch)
+    queue = deque()
+    nfiles = 0
+    try:
+        for item in input_list:
+            if isinstance(item, str) and os.path.exists(item):
+                item = pool.submit(_read_image,item)
+                nfiles += 1
+            queue.append(item)
+            while nfiles > prefetch:
+                item = queue.popleft()
+                if isinstance(item,Future):
+                    nfiles -= 1
+                    item = item.result()
+                yield item
+                item = None
+        while queue:
+            item = queue.popleft()
+            yield item.result() if isinstance(item,Future) else item
+            item = None
+    finally:
+        queue.clear()
+        pool.shutdown(wait=True,cancel_futures=True)
+
+def _image_stream(input_list,prefetch=0):
+    """
+    Generator version of `_image_list`: the images are yielded one by one.
+    Image files are read only when they are needed and the generator does not
+    keep a reference to the images it has yielded, so that a reduction over a
+    long list of image files only needs to keep a few images in memory.
+    Scalars are turned into (float) images with the geometry of the first image.
+    All images must have the same size, spacing and origin as the first image,
+    otherwise a TypeError is raised. For lists with image files this is checked
+    from the file headers before any pixel data is read (see `probe_image_geometry`),
+    for other iterables possibly after some images were yielded.
+    With `prefetch`>0 the next `prefetch` image files are read in background
+    threads (see `_prefetch_images`) while the current image is being used.
+    """
+    _validate_image_list(input_list)
+    info0 = None
+    for item in _prefetch_images(input_list,prefetch):
+        if hasattr(item,"GetSpacing") and hasattr(item,"GetOrigin"):
+            img = item
+        elif isinstance(item, str) and os.path.exists(item):
+            img = itk.imread(item)
+        elif (not hasattr(item, 'len')) and (not isinstance(item, str)):
+            if info0 is None:
+                raise RuntimeError("Pass an image before a scalar to have a model")
+            img = _image_from_array(np.full(info0["size"][::-1],item,dtype=np.float32),info0)
         else:
-            raise TypeError("ERROR: {} is not an ITK image object nor a path to an existing image file".format(img))
-    if not input_images:
+            raise TypeError("ERROR: {} is not an ITK image object nor a path to an existing image file".format(item))
+        if info0 is None:
+            info0 = _image_information(img)
+        else:
+            _check_geometry(img,info0)
+        yield img
+        img = None
+    if info0 is None:
         raise RuntimeError("got no images")
-    # check that they have the same geometry
-    checked_images=list()
-    origin0 = input_images[0].GetOrigin()
-    spacing0 = input_images[0].GetSpacing()
-    size0 = _image_size(input_images[0])
-    for img in input_images:
-        img_size = _image_size(img)
-        if not np.allclose(img_size, size0):
-            raise TypeError("images have incompatible size: {} versus {}".format(size0,img_size))
-        elif not np.allclose(img.GetOrigin(),origin0):
-            raise TypeError("images have incompatible origins: {} versus {}".format(origin0,img.GetOrigin()))
-        elif not np.allclose(img.GetSpacing(),spacing0):
-            raise TypeError("images have incompatible {} spacing: {} versus {}".format(
-                "pixel" if len(spacing0)==2 else "voxel",spacing0,img.GetSpacing()))
+
+def _image_stream_sum(input_list,dtype=np.float64,prefetch=0):
+    """
+    Running sum of the images in `input_list`, accumulated in `dtype` (float64 by
+    default), reading and releasing one image at a time (or reading `prefetch`
+    files ahead, see `_image_stream`).
+    Returns the sum array, the number of images, the geometry information of the
+    images (see `_image_information`) and the numpy type of the input images.
+    """
+    np_sum,n,info,input_dtype = None,0,None,None
+    for img in _image_stream(input_list,prefetch):
+        np_img = itk.array_view_from_image(img)
+        if np_sum is None:
+            np_sum = np.array(np_img,dtype=dtype)
+            info = _image_information(img)
+            input_dtype = np_img.dtype
         else:
-            # TODO: maybe we should also check pixel types?
-            checked_images.append(img)
-    return checked_images
+            np_sum += np_img
+            input_dtype = np.result_type(input_dtype,np_img.dtype)
+        n += 1
+        del np_img,img
+    return np_sum,n,info,input_dtype
 
 def _image_output(img,filename=None):
     """
@@ -129,91 +354,388 @@ def _image_output(img,filename=None):
         itk.imwrite(img,filename)
     return img
 
-def _apply_operation_to_image_list(op, input_list, output_file=None):
-    img_list = _image_list(input_list)
-    if len(img_list) == 1:
-        return _image_output(img_list[0], output_file)
-    np_list = [ itk.array_view_from_image(img) for img in img_list]
-    np_result = reduce(op, np_list)
-    img = itk.image_from_array(np_result)
-    img.CopyInformation(img_list[0])
+def _apply_operation_to_image_list(op, input_list, output_file=None, prefetch=0):
+    # left fold over the image stream, equivalent to reduce(op, arrays),
+    # but with only the running result and the current image in memory
+    first, info, np_result = None, None, None
+    for i,img in enumerate(_image_stream(input_list,prefetch)):
+        if i == 0:
+            first, info = img, _image_information(img)
+            np_result = itk.array_view_from_image(img)
+            continue
+        np_result = op(np_result, itk.array_view_from_image(img))
+        first = None
+    if first is not None:
+        # just one image
+        return _image_output(first, output_file)
+    img = _image_from_array(np_result, info)
     return _image_output(img, output_file)
 
 
-def image_sum(input_list=[],output_file=None):
+def image_sum(input_list=[],output_file=None,prefetch=0,accumulator=None):
     """
     Computes element-wise sum of a list of image with equal geometry.
+    With `accumulator` (the filename of an `image_accumulator` manifest), the images
+    are added to the float64 sum of a previous merge (files that are already included
+    are skipped), the accumulator is saved and the total sum is returned.
     """
-    return _apply_operation_to_image_list(operator.add,input_list,output_file)
+    if accumulator is not None:
+        acc = image_accumulator(accumulator)
+        for img in input_list:
+            acc.add(img)
+        acc.save()
+        return _image_output(acc.sum_image(), output_file)
+    return _apply_operation_to_image_list(operator.add,input_list,output_file,prefetch)
+
 
+class running_statistics(object):
+    """
+    Element-wise mean, variance, standard deviation and standard error of the mean
+    of a stream of images (or numpy arrays) with equal geometry, computed in a
+    single pass with Welford's online algorithm in float64. Only the running mean
+    and the sum of squared deviations are kept in memory, however many images are
+    added, and the result is numerically stable also for large N or for images
+    with a large mean compared to their spread.
+    Usage:
+    * `add(img)` adds one ITK image, image filename or numpy array
+    * `add_images(input_list,prefetch=0)` adds a list of images/filenames/scalars (see `_image_stream`)
+    * `merge(other)` adds all images of another `running_statistics` object,
+      e.g. one that was filled in another process
+    * `n`, `mean`, `variance`, `std` and `sem` give the results as numpy arrays, and
+      `mean_image()`, `std_image()` and `sem_image()` as ITK images with the geometry of the first image.
+    The variance is the population variance (ddof=0), as with `np.std`, unless another `ddof` is given.
+    """
+    def __init__(self,ddof=0):
+        self.ddof = ddof
+        self.reset()
+    def reset(self):
+        self.n = 0
+        self._mean = None
+        self._m2 = None
+        self.info = None
+        self.input_dtype = None
+    def add(self,img):
+        """
+        Add one image: an ITK image, the filename of an image or a numpy array.
+        The geometry of ITK images is checked against the geometry of the first image.
+        """
+        if isinstance(img,str):
+            img = itk.imread(img)
+        if hasattr(img,"GetSpacing"):
+            if self.info is None and self.n == 0:
+                self.info = _image_information(img)
+            elif self.info is not None:
+                _check_geometry(img,self.info)
+            x = itk.array_view_from_image(img)
+        else:
+            x = np.asarray(img)
+        if self.n == 0:
+            self._mean = np.array(x,dtype=np.float64)
+            self._m2 = np.zeros_like(self._mean)
+            self.input_dtype = x.dtype
+            self.n = 1
+            return self
+        if x.shape != self._mean.shape:
+            raise TypeError("images have incompatible size: {} versus {}".format(self._mean.shape[::-1],x.shape[::-1]))
+        self.n += 1
+        self.input_dtype = np.result_type(self.input_dtype,x.dtype)
+        delta = np.subtract(x,self._mean,dtype=np.float64)
+        # m2 += delta*(x-new_mean) = delta**2*(n-1)/n
+        tmp = np.square(delta)
+        tmp *= (self.n-1)/self.n
+        self._m2 += tmp
+        del tmp
+        delta /= self.n
+        self._mean += delta
+        return self
+    def add_images(self,input_list,prefetch=0):
+        """
+        Add all images of a list of images, image filenames and/or scalars, reading
+        the files one by one (or `prefetch` files ahead, see `_prefetch_images`).
+        """
+        for img in _image_stream(input_list,prefetch):
+            self.add(img)
+        return self
+    def merge(self,other):
+        """
+        Add the statistics of another `running_statistics` object (Chan et al. pairwise update).
+        """
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self._mean, self._m2 = np.copy(other._mean), np.copy(other._m2)
+            self.n, self.info, self.input_dtype = other.n, other.info, other.input_dtype
+            return self
+        if other._mean.shape != self._mean.shape:
+            raise TypeError("images have incompatible size: {} versus {}".format(self._mean.shape[::-1],other._mean.shape[::-1]))
+        n = self.n+other.n
+        delta = other._mean-self._mean
+        self._m2 += other._m2
+        self._m2 += np.square(delta)*(self.n*other.n/n)
+        delta *= other.n/n
+        self._mean += delta
+        self.n = n
+        self.input_dtype = np.result_type(self.input_dtype,other.input_dtype)
+        return self
+    @property
+    def mean(self):
+        return self._mean
+    @property
+    def variance(self):
+        if self.n <= self.ddof:
+            return np.full_like(self._m2,np.nan)
+        return self._m2/(self.n-self.ddof)
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+    @property
+    def sem(self):
+        return self.std/np.sqrt(self.n)
+    def _image(self,np_result):
+        if self.info is None:
+            raise RuntimeError("no ITK image was added, the geometry of the result is unknown")
+        # float input images give an output image of the same type, like np.mean and np.std
+        dtype = self.input_dtype if np.issubdtype(self.input_dtype,np.floating) else np.float64
+        return _image_from_array(np.ascontiguousarray(np_result,dtype=dtype),self.info)
+    def mean_image(self):
+        return self._image(self.mean)
+    def std_image(self):
+        return self._image(self.std)
+    def sem_image(self):
+        return self._image(self.sem)
 
-def image_mean(input_list=[],output_file=None):
+class image_accumulator(object):
+    """
+    Running sums of images (and optionally of squared images) in float64, with the
+    number of events and a manifest of the files that were added, which can be saved
+    next to a merged result and extended later with only the new files, e.g. when a
+    late batch of jobs of a Gate run is finished:
+    * `filename` is the manifest (JSON) of the accumulator, the sums are stored in the
+      .npz file with the same name; an existing accumulator is loaded, a new one is
+      saved there by `save()`
+    * `add(img,squared=None,events=None)` adds an image (filename or image object), with
+      its squared image for uncertainty computations and its number of events
+    * `add_files(filenames,squared_filenames=None,events=0)` adds lists of files
+    Files are never counted twice: a file that is already in the manifest is skipped if
+    it did not change (same size and modification time), and a ValueError is raised if it
+    changed or if a new file has the same pixel data as a file already in the manifest.
+    """
+    def __init__(self,filename=None):
+        self.filename = filename
+        self.sum, self.squared_sum = None, None
+        self.info, self.input_dtype = None, None
+        self.events = 0
+        self.files = list()
+        if filename is not None and os.path.isfile(filename):
+            self.load(filename)
+    @property
+    def n(self):
+        return len(self.files)
+    def _arrays_filename(self,filename):
+        return os.path.splitext(filename)[0]+".npz"
+    def load(self,filename):
+        with open(filename) as f:
+            manifest = json.load(f)
+        self.events = manifest["events"]
+        self.files = manifest["files"]
+        self.input_dtype = None if manifest["dtype"] is None else np.dtype(manifest["dtype"])
+        self.info = None
+        if manifest["geometry"] is not None:
+            self.info = dict(manifest["geometry"])
+            self.info["direction"] = np.array(self.info["direction"])
+            for key in ("size","origin","spacing"):
+                self.info[key] = tuple(self.info[key])
+        self.sum, self.squared_sum = None, None
+        if self.files:
+            with np.load(self._arrays_filename(filename)) as arrays:
+                self.sum = arrays["sum"]
+                self.squared_sum = arrays["squared_sum"] if "squared_sum" in arrays else None
+        logger.info("loaded accumulator {} with {} files and {} events".format(filename,self.n,self.events))
+    def save(self,filename=None):
+        """
+        Save the sums (.npz) and the manifest (JSON). The files are replaced atomically,
+        the manifest last, so that an interrupted save keeps the previous state.
+        """
+        filename = self.filename if filename is None else filename
+        arrays = dict()
+        if self.sum is not None:
+            arrays["sum"] = self.sum
+        if self.squared_sum is not None:
+            arrays["squared_sum"] = self.squared_sum
+        npzfile = self._arrays_filename(filename)
+        with open(npzfile+".tmp","wb") as f:
+            np.savez(f,**arrays)
+        os.replace(npzfile+".tmp",npzfile)
+        geometry = None
+        if self.info is not None:
+            geometry = dict((key,list(self.info[key])) for key in ("size","origin","spacing"))
+            geometry["direction"] = np.asarray(self.info["direction"]).tolist()
+        manifest = dict(version=1,events=self.events,dtype=None if self.input_dtype is None else self.input_dtype.str,
+                        geometry=geometry,files=self.files)
+        with open(filename+".tmp","w") as f:
+            json.dump(manifest,f,indent=1)
+        os.replace(filename+".tmp",filename)
+    def _file_entry(self,filename):
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        return dict(path=path,size=stat.st_size,mtime=stat.st_mtime)
+    def included(self,filename):
+        """
+        True if the file is in the manifest and did not change since it was added;
+        raises a ValueError if it is in the manifest but has been modified.
+        """
+        entry = self._file_entry(filename)
+        for f in self.files:
+            for key in ("image","squared"):
+                if f[key] is not None and f[key]["path"] == entry["path"]:
+                    if (f[key]["size"],f[key]["mtime"]) != (entry["size"],entry["mtime"]):
+                        raise ValueError("{} was already added to the accumulator, but has been modified since".format(filename))
+                    return True
+        return False
+    def _add_array(self,name,img):
+        np_img = itk.array_view_from_image(img)
+        if not np.any(np_img):
+            # empty images (e.g. of jobs without any hit) are not duplicates of each other
+            return np_img, None
+        digest = xxhash.xxh64(np.ascontiguousarray(np_img).view(np.uint8)).hexdigest()
+        for f in self.files:
+            for key in ("image","squared"):
+                if f[key] is not None and f[key]["digest"] == digest and digest is not None:
+                    raise ValueError("the pixel data of {} was already added to the accumulator (as {})".format(name,f[key]["path"]))
+        return np_img, digest
+    def add(self,img,squared=None,events=None):
+        """
+        Add an image (and its squared image), given as filenames or image objects, with
+        its number of events (or None if unknown). Returns False if the files were
+        already added (and are skipped), True otherwise.
+        """
+        names = [x for x in (img,squared) if isinstance(x,str)]
+        if names and all(self.included(name) for name in names):
+            logger.info("skipping {}, already in the accumulator".format(", ".join(names)))
+            return False
+        for name in names:
+            if self.included(name):
+                raise ValueError("{} was already added to the accumulator, with another (squared) image".format(name))
+        if squared is None and self.squared_sum is not None:
+            raise ValueError("the accumulator has squared sums, a squared image is needed for {}".format(img))
+        if squared is not None and self.sum is not None and self.squared_sum is None:
+            raise ValueError("the accumulator has no squared sums, cannot add the squared image of {}".format(img))
+        entry = dict(events=events)
+        arrays = dict()
+        for key,item in (("image",img),("squared",squared)):
+            if item is None:
+                entry[key] = None
+                continue
+            image = itk.imread(item) if isinstance(item,str) else item
+            if self.info is None:
+                self.info = _image_information(image)
+            _check_geometry(image,self.info)
+            arrays[key],digest = self._add_array(item if isinstance(item,str) else key,image)
+            entry[key] = dict(self._file_entry(item),digest=digest) if isinstance(item,str) else dict(path=None,size=None,mtime=None,digest=digest)
+            if key == "image":
+                self.input_dtype = arrays[key].dtype if self.input_dtype is None else np.result_type(self.input_dtype,arrays[key].dtype)
+        if self.sum is None:
+            self.sum = np.zeros(arrays["image"].shape)
+            if squared is not None:
+                self.squared_sum = np.zeros(arrays["image"].shape)
+        self.sum += arrays["image"]
+        if squared is not None:
+            self.squared_sum += arrays["squared"]
+        self.files.append(entry)
+        self.events += 0 if events is None else events
+        return True
+    def add_files(self,filenames,squared_filenames=None,events=0):
+        """
+        Add lists of image files (and squared image files). Files that are already in
+        the manifest are skipped. `events` is the total number of events of the new files.
+        Returns the number of added images.
+        """
+        if squared_filenames is not None and len(squared_filenames) != len(filenames):
+            raise ValueError("got {} images and {} squared images".format(len(filenames),len(squared_filenames)))
+        nadded = 0
+        for i,filename in enumerate(filenames):
+            nadded += self.add(filename,None if squared_filenames is None else squared_filenames[i])
+        if nadded > 0:
+            self.events += events
+        elif events:
+            logger.warning("no new files, the {} events are not added".format(events))
+        return nadded
+    def sum_image(self,dtype=None):
+        """
+        The sum as an image, with pixel type `dtype`, by default the type of the input images.
+        """
+        dtype = self.input_dtype if dtype is None else dtype
+        return _image_from_array(self.sum.astype(dtype),self.info)
+
+def _running_statistics(input_list,prefetch=0):
+    """
+    Helper function for image_mean, image_std and image_sem: returns the
+    statistics of the images in the list, and the first image if it was the only one.
+    """
+    stats = running_statistics()
+    first = None
+    for img in _image_stream(input_list,prefetch):
+        first = img if stats.n == 0 else None
+        stats.add(img)
+    return stats, first
+
+def image_mean(input_list=[],output_file=None,prefetch=0):
     """
     Computes element-wise mean of a list of image with equal geometry.
+    The images are read one by one, see `running_statistics`.
     """
-    img_list = _image_list(input_list)
-    if len(img_list) == 1:
-        return _image_output(img_list[0], output_file)
-    np_list = [ itk.array_view_from_image(img) for img in img_list]
-    np_result = np.mean(np_list, axis=0)
-    img = itk.image_from_array(np_result)
-    img.CopyInformation(img_list[0])
-    return _image_output(img, output_file)
+    stats, first = _running_statistics(input_list,prefetch)
+    if first is not None:
+        return _image_output(first, output_file)
+    return _image_output(stats.mean_image(), output_file)
     
 
-def image_std(input_list=[],output_file=None):
+def image_std(input_list=[],output_file=None,prefetch=0):
     """
     Computes element-wise standard deviation of a list of image with equal geometry.
+    The images are read one by one, see `running_statistics`.
     """
-    img_list = _image_list(input_list)
-    if len(img_list) == 1:
-        return _image_output(img_list[0], output_file)
-    np_list = [ itk.array_view_from_image(img) for img in img_list]
-    np_result = np.std(np_list, axis=0)
-    img = itk.image_from_array(np_result)
-    img.CopyInformation(img_list[0])
-    return _image_output(img, output_file)
+    stats, first = _running_statistics(input_list,prefetch)
+    if first is not None:
+        return _image_output(first, output_file)
+    return _image_output(stats.std_image(), output_file)
 
-def image_sem(input_list=[],output_file=None):
+def image_sem(input_list=[],output_file=None,prefetch=0):
     """
-    Computes element-wise standard deviation of a list of image with equal geometry.
+    Computes element-wise standard error of the mean (std/sqrt(N)) of a list of image with equal geometry.
+    The images are read one by one, see `running_statistics`.
     """
-    img_list = _image_list(input_list)
-    if len(img_list) == 1:
-        return _image_output(img_list[0], output_file)
-    np_list = [ itk.array_view_from_image(img) for img in img_list]
-    N = len(img_list)
-    np_result = np.std(np_list, axis=0)/np.sqrt(N)
-    img = itk.image_from_array(np_result)
-    img.CopyInformation(img_list[0])
-    return _image_output(img, output_file)
+    stats, first = _running_statistics(input_list,prefetch)
+    if first is not None:
+        return _image_output(first, output_file)
+    return _image_output(stats.sem_image(), output_file)
     
 
-def image_product(input_list=[],output_file=None):
+def image_product(input_list=[],output_file=None,prefetch=0):
     """
     Computes element-wise product of a list of image with equal geometry.
     """
-    return _apply_operation_to_image_list(operator.mul,input_list,output_file)
+    return _apply_operation_to_image_list(operator.mul,input_list,output_file,prefetch)
 
-def image_min(input_list=[],output_file=None):
+def image_min(input_list=[],output_file=None,prefetch=0):
     """
     Computes element-wise minimum of a list of image with equal geometry.
     """
-    return _apply_operation_to_image_list(np.minimum,input_list,output_file)
+    return _apply_operation_to_image_list(np.minimum,input_list,output_file,prefetch)
 
-def image_max(input_list=[],output_file=None):
+def image_max(input_list=[],output_file=None,prefetch=0):
     """
     Computes element-wise maximum of a list of image with equal geometry.
     """
-    return _apply_operation_to_image_list(np.maximum,input_list,output_file)
+    return _apply_operation_to_image_list(np.maximum,input_list,output_file,prefetch)
 
-def image_divide(input_list=[], defval=0.,output_file=None):
+def image_divide(input_list=[], defval=0.,output_file=None,prefetch=0):
     """
     Computes element-wise ratio of two images with equal geometry.
     Non-finite values are replaced with defvalue (unless it's None).
     """
     np.seterr(divide='ignore', invalid='ignore')
-    raw_result = _apply_operation_to_image_list(operator.truediv,input_list=input_list)
+    raw_result = _apply_operation_to_image_list(operator.truediv,input_list=input_list,prefetch=prefetch)
     # FIXME: where do numpy/ITK store the value of the "maximum value that can be respresented with a 32bit float"?
     # FIXME: maybe we should/wish to support integer division as well?
     mask = itk.array_view_from_image(raw_result)>1e38
@@ -267,6 +789,8 @@ def image_invert(input_list=[],output_file=None):
 #####################################################################################
 import unittest
 import sys
+import shutil
+import tempfile
 from datetime import datetime
 from .logging_conf import LoggedTestCase
 
@@ -469,5 +993,168 @@ class Test_Invert(LoggedTestCase):
         self.assertTrue(np.allclose(imginvert.GetSpacing(), spacing))
         self.assertTrue(np.allclose(imginvert.GetOrigin(), origin))
 
+class Test_RunningStatistics(LoggedTestCase):
+    def test_mean_std_sem(self):
+        logger.info('Test_RunningStatistics test_mean_std_sem')
+        nx,ny,nz = 6,7,8
+        spacing = (3.,2.,1.)
+        # large offset compared to the spread: the naive sum of squares would lose all precision in float32
+        alist = [ (1e4+np.random.normal(0.,1e-2,(nz,ny,nx))).astype(np.float32) for i in range(20) ]
+        imglist = list()
+        for a in alist:
+            img = itk.image_from_array(a)
+            img.SetSpacing(spacing)
+            imglist.append(img)
+        stack = np.array(alist,dtype=np.float64)
+        imgmean, imgstd, imgsem = image_mean(imglist), image_std(imglist), image_sem(imglist)
+        for img in (imgmean,imgstd,imgsem):
+            self.assertTrue( type(img) == itk.Image[itk.F,3])
+            self.assertTrue( np.allclose(img.GetSpacing(),spacing))
+        self.assertTrue( np.allclose(itk.array_view_from_image(imgmean),np.mean(stack,axis=0)))
+        self.assertTrue( np.allclose(itk.array_view_from_image(imgstd),np.std(stack,axis=0),rtol=1e-4))
+        self.assertTrue( np.allclose(itk.array_view_from_image(imgsem),np.std(stack,axis=0)/np.sqrt(20),rtol=1e-4))
+        # one image: the input is returned
+        self.assertTrue( image_std(imglist[:1]) is imglist[0])
+        # sample variance, and merging of partial statistics
+        stats = running_statistics(ddof=1).add_images(imglist[:7])
+        stats2 = running_statistics(ddof=1)
+        for a in alist[7:]:
+            stats2.add(a)
+        stats.merge(stats2)
+        self.assertEqual(stats.n,20)
+        self.assertTrue( np.allclose(stats.mean,np.mean(stack,axis=0)))
+        self.assertTrue( np.allclose(stats.variance,np.var(stack,axis=0,ddof=1),rtol=1e-6))
+        with self.assertRaises(TypeError):
+            stats.add(np.zeros((2,3,4)))
+        with self.assertRaises(RuntimeError):
+            stats2.mean_image()
+    def test_int_images(self):
+        logger.info('Test_RunningStatistics test_int_images')
+        imglist = [ itk.image_from_array(np.full((4,5),i,dtype=np.uint16)) for i in range(5) ]
+        imgmean = image_mean(imglist)
+        self.assertTrue( np.allclose(itk.array_view_from_image(imgmean),2.))
+        self.assertTrue( np.allclose(itk.array_view_from_image(image_std(imglist)),np.sqrt(2.)))
+
+class Test_ProbeImageGeometry(LoggedTestCase):
+    def test_report(self):
+        logger.info('Test_ProbeImageGeometry test_report')
+        tmpdirpath = tempfile.mkdtemp()
+        filenames = list()
+        for i,ext in enumerate((".mhd",".mha",".nrrd",".nii",".mhd",".nrrd",".mhd")):
+            img = itk.image_from_array(np.ones((5,6,7),dtype=np.float32))
+            img.SetSpacing((2.,3.,4.) if i != 4 else (2.,3.,5.))
+            img.SetOrigin((1.,2.,3.))
+            if i == 5:
+                img = itk.image_from_array(np.ones((5,6,8),dtype=np.float32))
+                img.SetSpacing((2.,3.,4.))
+                img.SetOrigin((1.,2.,3.))
+            filenames.append(os.path.join(tmpdirpath,f"img{i}{ext}"))
+            itk.imwrite(img,filenames[-1])
+        # a corrupted pixel data file: the headers are checked before any pixel data is read
+        with open(filenames[6][:-4]+".raw","wb") as f:
+            f.write(b"short")
+        report = probe_image_geometry(filenames[:6]+[3.,"no_such_file.mhd"])
+        self.assertEqual(report["reference"],filenames[0])
+        self.assertEqual(report["geometry"]["size"],(7,6,5))
+        self.assertEqual(report["compatible"],filenames[:4])
+        self.assertEqual([(r["input"],r["field"]) for r in report["incompatible"]],
+                         [(filenames[4],"spacing"),(filenames[5],"size"),("no_such_file.mhd","file")])
+        self.assertEqual(report["incompatible"][1]["found"],(8,6,5))
+        with self.assertRaises(TypeError) as cm:
+            image_sum(filenames)
+        self.assertIn("2 of 7 inputs are incompatible",str(cm.exception))
+        with self.assertRaises(TypeError):
+            image_mean(filenames[4:])
+        shutil.rmtree(tmpdirpath)
+
+class Test_ImageAccumulator(LoggedTestCase):
+    def test_extend(self):
+        logger.info('Test_ImageAccumulator test_extend')
+        tmpdirpath = tempfile.mkdtemp()
+        filenames, arrays = list(), list()
+        for i in range(6):
+            arrays.append(np.random.uniform(0.,1.,(4,5,6)).astype(np.float32))
+            img = itk.image_from_array(arrays[-1])
+            img.SetSpacing((2.,2.,3.))
+            filenames.append(os.path.join(tmpdirpath,f"output.{i}","dose.mhd"))
+            os.makedirs(os.path.dirname(filenames[-1]))
+            itk.imwrite(img,filenames[-1])
+        sidecar = os.path.join(tmpdirpath,"merged.json")
+        image_sum(filenames[:4],accumulator=sidecar)
+        self.assertTrue(os.path.isfile(os.path.join(tmpdirpath,"merged.npz")))
+        # late batch: all files are given again, only the new ones are added
+        total = image_sum(filenames,accumulator=sidecar)
+        self.assertTrue(type(total) == itk.Image[itk.F,3])
+        self.assertTrue(np.allclose(total.GetSpacing(),(2.,2.,3.)))
+        self.assertTrue(np.allclose(itk.array_view_from_image(total),np.sum(np.array(arrays,dtype=np.float64),axis=0)))
+        acc = image_accumulator(sidecar)
+        self.assertEqual(acc.n,6)
+        # a copy of an included file, or a modified included file, is never counted
+        copy = os.path.join(tmpdirpath,"copy.mhd")
+        itk.imwrite(itk.imread(filenames[0]),copy)
+        with self.assertRaises(ValueError):
+            acc.add(copy)
+        os.utime(filenames[1],(0,0))
+        os.utime(filenames[1][:-4]+".raw",(0,0))
+        with self.assertRaises(ValueError):
+            image_sum(filenames,accumulator=sidecar)
+        self.assertEqual(image_accumulator(sidecar).n,6)
+        shutil.rmtree(tmpdirpath)
+
+class Test_Prefetch(LoggedTestCase):
+    def test_files(self):
+        logger.info('Test_Prefetch test_files')
+        tmpdirpath = tempfile.mkdtemp()
+        filenames = list()
+        for i in range(7):
+            img = itk.image_from_array(np.random.uniform(1.,2.,(5,6,7)).astype(np.float32))
+            img.SetSpacing((2.,3.,4.))
+            filenames.append(os.path.join(tmpdirpath,f"img{i}.mhd"))
+            itk.imwrite(img,filenames[-1])
+        # the order of the images is kept, also with a scalar in the list
+        items = filenames[:3]+[2.0]+filenames[3:]
+        prefetched = list(_prefetch_images(items,prefetch=2))
+        self.assertEqual(len(prefetched),len(items))
+        self.assertEqual(prefetched[3],2.0)
+        for fname,img in zip(filenames,prefetched[:3]+prefetched[4:]):
+            self.assertTrue(np.array_equal(itk.array_view_from_image(img),itk.array_view_from_image(itk.imread(fname))))
+        for function in (image_sum,image_divide,image_max,image_std):
+            expected = itk.array_view_from_image(function(input_list=items))
+            for prefetch in (1,3,10):
+                result = function(input_list=items,prefetch=prefetch)
+                self.assertTrue(np.array_equal(itk.array_view_from_image(result),expected))
+                self.assertTrue(np.allclose(result.GetSpacing(),(2.,3.,4.)))
+        with self.assertRaises(TypeError):
+            image_sum(input_list=filenames+["no_such_file.mhd"],prefetch=2)
+        shutil.rmtree(tmpdirpath)
+
+    def test_read_image(self):
+        logger.info('Test_Prefetch test_read_image')
+        tmpdirpath = tempfile.mkdtemp()
+        for dtype in (np.uint8,np.int16,np.int32,np.float32,np.float64):
+            for ext in (".mhd",".mha",".nii"):
+                img = itk.image_from_array((10*np.random.uniform(1.,2.,(5,6,7))).astype(dtype))
+                img.SetSpacing((2.,3.,4.))
+                img.SetOrigin((-1.,0.5,7.))
+                img.SetDirection(itk.matrix_from_array(np.array([[0.,1.,0.],[-1.,0.,0.],[0.,0.,1.]])))
+                fname = os.path.join(tmpdirpath,"img"+ext)
+                itk.imwrite(img,fname)
+                expected,result = itk.imread(fname),_read_image(fname)
+                self.assertEqual(type(result),type(expected))
+                self.assertTrue(np.array_equal(itk.array_view_from_image(result),itk.array_view_from_image(expected)))
+                self.assertTrue(np.allclose(result.GetOrigin(),expected.GetOrigin()))
+                self.assertTrue(np.allclose(result.GetSpacing(),expected.GetSpacing()))
+                self.assertTrue(np.allclose(itk.array_from_matrix(result.GetDirection()),
+                                            itk.array_from_matrix(expected.GetDirection())))
+        # big endian data
+        with open(os.path.join(tmpdirpath,"img.mhd")) as f:
+            header = f.read().replace("ByteOrderMSB = False","ByteOrderMSB = True")
+        with open(os.path.join(tmpdirpath,"img.mhd"),"w") as f:
+            f.write(header)
+        araw = np.fromfile(os.path.join(tmpdirpath,"img.raw"),dtype="<f8")
+        araw.astype(">f8").tofile(os.path.join(tmpdirpath,"img.raw"))
+        self.assertTrue(np.array_equal(itk.array_view_from_image(_read_image(os.path.join(tmpdirpath,"img.mhd"))).ravel(),araw))
+        self.assertTrue(np.array_equal(itk.array_view_from_image(itk.imread(os.path.join(tmpdirpath,"img.mhd"))).ravel(),araw))
+        shutil.rmtree(tmpdirpath)
 
 # TODO: test division
@@ -0,0 +1,261 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+"""
+This module evaluates voxel-wise arithmetic expressions of several images,
+e.g. "(a+b)/(c+d)*2", without writing intermediate images to disk:
+    * the expression is parsed into a tree (with the python `ast` module), only
+      numbers, image names, the operators + - * / ** and a few functions
+      (see `image_expression_functions`) are allowed
+    * the geometry of the input files is checked from their headers, before any
+      pixel data is read
+    * the input images are read slab by slab (planes along the last image axis),
+      and within a slab the expression is evaluated on small chunks of voxels, with
+      one pass over the chunk per operation in a few reused buffers, so that the
+      intermediate results stay in the CPU cache and are never allocated at full size.
+"""
+
+import ast
+import itk
+import numpy as np
+import logging
+from .image_arithm import _image_header, _image_information, _check_geometry, _image_from_array, _image_output
+logger=logging.getLogger(__name__)
+
+image_expression_functions = {
+    "abs":(np.abs,1),
+    "sqrt":(np.sqrt,1),
+    "exp":(np.exp,1),
+    "log":(np.log,1),
+    "minimum":(np.minimum,2),
+    "maximum":(np.maximum,2),
+}
+
+_binary_operators = {ast.Add:np.add, ast.Sub:np.subtract, ast.Mult:np.multiply,
+                     ast.Div:np.true_divide, ast.Pow:np.power}
+_unary_operators = {ast.USub:np.negative, ast.UAdd:np.positive}
+
+def parse_image_expression(expression):
+    """
+    Parse an image expression such as "(a+b)/(c+d)*2" into a tree of python `ast` nodes.
+    Raises a ValueError if the expression is not valid or uses anything else than
+    numbers, names, the operators + - * / ** and the functions in `image_expression_functions`.
+    Returns the tree and the set of names (the images) used in the expression.
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode="eval").body
+    except SyntaxError as se:
+        raise ValueError("invalid image expression '{}': {}".format(expression,se.msg))
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node,(ast.BinOp,ast.UnaryOp,ast.operator,ast.unaryop,ast.Load)):
+            if isinstance(node,ast.BinOp) and type(node.op) not in _binary_operators:
+                raise ValueError("unsupported operator in image expression '{}'".format(expression))
+            if isinstance(node,ast.UnaryOp) and type(node.op) not in _unary_operators:
+                raise ValueError("unsupported operator in image expression '{}'".format(expression))
+        elif isinstance(node,ast.Constant):
+            if isinstance(node.value,bool) or not isinstance(node.value,(int,float)):
+                raise ValueError("unsupported constant {} in image expression '{}'".format(node.value,expression))
+        elif isinstance(node,ast.Call):
+            if not isinstance(node.func,ast.Name) or node.func.id not in image_expression_functions or node.keywords:
+                raise ValueError("unsupported function call in image expression '{}', available functions: {}".format(
+                    expression,", ".join(image_expression_functions)))
+            nargs = image_expression_functions[node.func.id][1]
+            if len(node.args) != nargs:
+                raise ValueError("function {} takes {} argument(s) in image expression '{}'".format(node.func.id,nargs,expression))
+        elif isinstance(node,ast.Name):
+            if not (node.id in image_expression_functions and any(
+                    isinstance(call,ast.Call) and call.func is node for call in ast.walk(tree))):
+                names.add(node.id)
+        else:
+            raise ValueError("unsupported syntax '{}' in image expression '{}'".format(type(node).__name__,expression))
+    return tree, names
+
+def _compile_image_expression(tree, constants={}):
+    """
+    Turn the expression tree into a list of instructions (ufunc, operands, output register),
+    in evaluation order. Operands are ("input",name), ("const",value) or ("reg",index).
+    The registers of the operands are released after each instruction and reused for later
+    results, so the number of registers is the depth of the tree, not the number of nodes.
+    Returns the instructions, the number of registers and the operand with the final result.
+    """
+    program = list()
+    free = list()
+    nreg = [0]
+    def allocate():
+        if free:
+            return free.pop()
+        nreg[0] += 1
+        return nreg[0]-1
+    def release(*operands):
+        for kind,value in operands:
+            if kind == "reg":
+                free.append(value)
+    def emit(ufunc,*operands):
+        release(*operands)
+        out = allocate()
+        program.append((ufunc,operands,out))
+        return ("reg",out)
+    def visit(node):
+        if isinstance(node,ast.Constant):
+            return ("const",float(node.value))
+        if isinstance(node,ast.Name):
+            if node.id in constants:
+                return ("const",float(constants[node.id]))
+            return ("input",node.id)
+        if isinstance(node,ast.BinOp):
+            a,b = visit(node.left),visit(node.right)
+            if a[0] == b[0] == "const":
+                return ("const",float(_binary_operators[type(node.op)](a[1],b[1])))
+            return emit(_binary_operators[type(node.op)],a,b)
+        if isinstance(node,ast.UnaryOp):
+            a = visit(node.operand)
+            if a[0] == "const":
+                return ("const",float(_unary_operators[type(node.op)](a[1])))
+            return emit(_unary_operators[type(node.op)],a)
+        if isinstance(node,ast.Call):
+            args = [visit(arg) for arg in node.args]
+            return emit(image_expression_functions[node.func.id][0],*args)
+        raise ValueError("unsupported syntax '{}' in image expression".format(type(node).__name__))
+    result = visit(tree)
+    return program, nreg[0], result
+
+class _slab_source(object):
+    """
+    Helper class: read planes [k0,k1) (along the last image axis) of an input image,
+    which is an image object or a filename. Files that ITK can read region by region
+    are read slab by slab; other files (e.g. compressed) are read once, completely.
+    """
+    def __init__(self,item,info):
+        self.img = item if hasattr(item,"GetSpacing") else None
+        self.filename = item if self.img is None else None
+        self.info = info
+        if self.filename is not None and not info["streamable"]:
+            self.img = itk.imread(self.filename)
+    def read(self,k0,k1):
+        if self.img is not None:
+            return itk.array_view_from_image(self.img)[k0:k1]
+        reader = itk.ImageFileReader.New(FileName=self.filename)
+        reader.UpdateOutputInformation()
+        ndim = len(self.info["size"])
+        region = itk.ImageRegion[ndim]()
+        region.SetIndex([0]*(ndim-1)+[k0])
+        region.SetSize(list(self.info["size"][:-1])+[k1-k0])
+        roi = itk.RegionOfInterestImageFilter.New(Input=reader.GetOutput(),RegionOfInterest=region)
+        roi.Update()
+        return itk.array_from_image(roi.GetOutput())
+
+def image_expression(expression, inputs, output_file=None, dtype=np.float32, slab=None, chunk=2**15):
+    """
+    Evaluate the voxel-wise `expression` (e.g. "(a+b)/(c+d)*2", see `parse_image_expression`)
+    with the images given in the dictionary `inputs`: name -> image object, image filename
+    or number. All images must have the same geometry; for files this is checked from the
+    headers, before any pixel data is read.
+    The expression is computed in float64, slab by slab (`slab` planes along the last image
+    axis at a time, by default about 4M voxels), and within a slab in chunks of `chunk`
+    voxels. Only the input slabs and a few chunk-sized buffers are allocated on top of
+    the output image, which has the geometry of the inputs and pixel type `dtype`.
+    """
+    tree,names = parse_image_expression(expression)
+    missing = names - set(inputs)
+    if missing:
+        raise ValueError("no image given for {} in image expression '{}'".format(", ".join(sorted(missing)),expression))
+    constants = dict((name,inputs[name]) for name in names if isinstance(inputs[name],(int,float,np.number)))
+    images = sorted(names - set(constants))
+    if not images:
+        raise ValueError("image expression '{}' does not use any image".format(expression))
+    infos = dict()
+    for name in images:
+        item = inputs[name]
+        if hasattr(item,"GetSpacing") and hasattr(item,"GetOrigin"):
+            infos[name] = _image_information(item)
+        elif isinstance(item,str):
+            infos[name] = _image_header(item)
+            if infos[name]["components"] != 1:
+                raise TypeError("ERROR: {} is not a scalar image".format(item))
+        else:
+            raise TypeError("ERROR: {} is not an ITK image object, a path to an existing image file or a number".format(item))
+        _check_geometry(infos[name],infos[images[0]])
+    info = infos[images[0]]
+    program, nreg, result = _compile_image_expression(tree,constants)
+    sources = dict((name,_slab_source(inputs[name],infos[name])) for name in images)
+    shape = tuple(info["size"][::-1])
+    nplane = int(np.prod(shape[1:]))
+    if slab is None:
+        slab = max(1,2**22//nplane)
+    np_output = np.empty(shape,dtype=dtype)
+    registers = np.empty((nreg,min(chunk,slab*nplane)))
+    with np.errstate(divide="ignore",invalid="ignore",over="ignore"):
+        for k0 in range(0,shape[0],slab):
+            k1 = min(k0+slab,shape[0])
+            np_slabs = dict((name,sources[name].read(k0,k1).reshape(-1)) for name in images)
+            np_out = np_output[k0:k1].reshape(-1)
+            for i0 in range(0,len(np_out),chunk):
+                i1 = min(i0+chunk,len(np_out))
+                n = i1-i0
+                operand = lambda o: np_slabs[o[1]][i0:i1] if o[0] == "input" else (registers[o[1],:n] if o[0] == "reg" else o[1])
+                for ufunc,operands,out in program:
+                    ufunc(*[operand(o) for o in operands],out=registers[out,:n],dtype=np.float64)
+                np_out[i0:i1] = operand(result)
+            logger.debug("image expression: planes {}-{} of {}".format(k0,k1,shape[0]))
+    img = _image_from_array(np_output,info)
+    return _image_output(img, output_file)
+
+#####################################################################################
+import unittest
+import os
+import shutil
+import tempfile
+from .logging_conf import LoggedTestCase
+
+class Test_ImageExpression(LoggedTestCase):
+    def test_parse(self):
+        logger.info('Test_ImageExpression test_parse')
+        tree,names = parse_image_expression("(a+b)/(c+d)*2 - sqrt(abs(a)) + maximum(a,1e-3)**2")
+        self.assertEqual(names,{"a","b","c","d"})
+        for bad in ("a+", "a.b", "a[0]", "open(a)", "sqrt(a,b)", "a if b else c", "a<b", "'a'+b", "lambda: a"):
+            with self.assertRaises(ValueError):
+                parse_image_expression(bad)
+        program,nreg,result = _compile_image_expression(parse_image_expression("((a+b)*(c+d))/((a-b)*(c-d))")[0])
+        self.assertEqual(len(program),7)
+        self.assertLessEqual(nreg,3)
+    def test_expression(self):
+        logger.info('Test_ImageExpression test_expression')
+        tmpdirpath = tempfile.mkdtemp()
+        spacing, origin = (2.,3.,4.), (-1.,-2.,-3.)
+        inputs, arrays = dict(), dict()
+        for i,name in enumerate("abcd"):
+            arrays[name] = np.random.uniform(1.,2.,(9,8,7)).astype(np.float32)
+            img = itk.image_from_array(arrays[name])
+            img.SetSpacing(spacing)
+            img.SetOrigin(origin)
+            if name == "d":
+                inputs[name] = img
+            else:
+                # uncompressed files are read slab by slab, compressed files at once
+                inputs[name] = os.path.join(tmpdirpath,f"{name}.mhd")
+                itk.imwrite(img,inputs[name],compression=(name=="c"))
+        inputs["k"] = 2.
+        a,b,c,d = [arrays[name].astype(np.float64) for name in "abcd"]
+        for expression,expected in (("(a+b)/(c+d)*k",(a+b)/(c+d)*2.),
+                                    ("-a**2+exp(-b)*minimum(c,d)",-a**2+np.exp(-b)*np.minimum(c,d)),
+                                    ("a",a)):
+            for slab,chunk in ((None,2**15),(2,50),(9,1)):
+                img = image_expression(expression,inputs,slab=slab,chunk=chunk)
+                self.assertTrue(type(img) == itk.Image[itk.F,3])
+                self.assertTrue(np.allclose(img.GetSpacing(),spacing))
+                self.assertTrue(np.allclose(img.GetOrigin(),origin))
+                self.assertTrue(np.allclose(itk.array_view_from_image(img),expected,rtol=1e-6))
+        with self.assertRaises(ValueError):
+            image_expression("a+e",inputs)
+        other = itk.image_from_array(np.ones((9,8,7),dtype=np.float32))
+        with self.assertRaises(TypeError):
+            image_expression("a+b",dict(a=inputs["a"],b=other))
+        output = os.path.join(tmpdirpath,"output.mhd")
+        image_expression("a*b",inputs,output_file=output)
+        self.assertTrue(np.allclose(itk.array_view_from_image(itk.imread(output)),a*b,rtol=1e-6))
+        shutil.rmtree(tmpdirpath)
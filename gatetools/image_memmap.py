@@ -0,0 +1,249 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+"""
+Out-of-core reductions (sum, product, min, max, mean, std, sem) of uncompressed
+MetaImage files (.mhd header with a .raw data file, or .mha with the data in the
+same file). The pixel data of the input files is memory-mapped slab by slab (a
+slab is a range of planes along the last image axis) and the output is written
+slab by slab, so that the memory use only depends on the slab size, not on the
+image size or on the number of images. This works for images of any dimension,
+e.g. 4D or very high resolution outputs that do not fit in RAM.
+"""
+
+import os
+import numpy as np
+import logging
+from .image_arithm import _check_geometry, running_statistics
+logger=logging.getLogger(__name__)
+
+_met_element_types = {
+    "MET_CHAR":"i1", "MET_UCHAR":"u1",
+    "MET_SHORT":"i2", "MET_USHORT":"u2",
+    "MET_INT":"i4", "MET_UINT":"u4",
+    "MET_LONG":"i4", "MET_ULONG":"u4",
+    "MET_LONG_LONG":"i8", "MET_ULONG_LONG":"u8",
+    "MET_FLOAT":"f4", "MET_DOUBLE":"f8",
+}
+
+def read_mhd_header(filename):
+    """
+    Read the header of a MetaImage file (.mhd or .mha).
+    Returns a dictionary with the header fields (as strings, in the order of the
+    file) and the number of bytes of the header (the offset of the pixel data
+    for .mha files with "ElementDataFile = LOCAL").
+    """
+    header = dict()
+    nbytes = 0
+    with open(filename,"rb") as f:
+        for line in f:
+            nbytes += len(line)
+            key,sep,value = line.decode("latin-1").partition("=")
+            if not sep:
+                continue
+            header[key.strip()] = value.strip()
+            if key.strip() == "ElementDataFile":
+                break
+    if "ElementDataFile" not in header or "DimSize" not in header:
+        raise ValueError("ERROR: {} is not a MetaImage header".format(filename))
+    return header, nbytes
+
+def _mhd_layout(filename):
+    """
+    Helper function: geometry (see `_image_information`), numpy dtype, shape and
+    location (data file and byte offset) of the pixel data of a MetaImage file.
+    Raises a ValueError for files that cannot be memory-mapped (compressed or
+    text data, or data split over several files).
+    """
+    header,nbytes = read_mhd_header(filename)
+    if header.get("CompressedData","False").lower() == "true":
+        raise ValueError("ERROR: {} is compressed and cannot be memory-mapped".format(filename))
+    if header.get("BinaryData","True").lower() != "true":
+        raise ValueError("ERROR: {} has no binary data".format(filename))
+    if header["ElementType"] not in _met_element_types:
+        raise ValueError("ERROR: {} has an unsupported element type {}".format(filename,header["ElementType"]))
+    size = tuple(int(v) for v in header["DimSize"].split())
+    ndim = len(size)
+    msb = header.get("BinaryDataByteOrderMSB",header.get("ElementByteOrderMSB","False")).lower() == "true"
+    dtype = np.dtype((">" if msb else "<")+_met_element_types[header["ElementType"]])
+    channels = int(header.get("ElementNumberOfChannels","1"))
+    shape = size[::-1]+((channels,) if channels > 1 else ())
+    datafile = header["ElementDataFile"]
+    if datafile == "LOCAL":
+        datafile, offset = filename, nbytes
+    elif datafile == "LIST" or "%" in datafile.split()[0]:
+        raise ValueError("ERROR: {} has its data in several files".format(filename))
+    else:
+        datafile, offset = os.path.join(os.path.dirname(os.path.abspath(filename)),datafile), 0
+    headersize = int(header.get("HeaderSize","0"))
+    if headersize > 0:
+        offset += headersize
+    elif headersize == -1:
+        offset = os.path.getsize(datafile)-int(np.prod(shape))*dtype.itemsize
+    origin = tuple(float(v) for v in header.get("Offset",header.get("Origin","0 "*ndim)).split())
+    spacing = tuple(float(v) for v in header.get("ElementSpacing","1 "*ndim).split())
+    direction = np.array([float(v) for v in header.get("TransformMatrix",
+                          " ".join(str(v) for v in np.eye(ndim).flat)).split()]).reshape(ndim,ndim).T
+    return dict(header=header,size=size,origin=origin,spacing=spacing,direction=direction,
+                dtype=dtype,shape=shape,datafile=datafile,offset=offset)
+
+def mhd_memmap(filename,k0=0,k1=None):
+    """
+    Memory-map (read only) the pixel data of an uncompressed MetaImage file, or
+    only planes [k0,k1) along the last image axis. The array has numpy (reversed)
+    axis order like `itk.array_view_from_image`, with an extra last axis for
+    multi-channel images.
+    """
+    layout = _mhd_layout(filename)
+    return _memmap_slab(layout,k0,k1)
+
+def _memmap_slab(layout,k0,k1=None):
+    shape = layout["shape"]
+    k1 = shape[0] if k1 is None else min(k1,shape[0])
+    plane = int(np.prod(shape[1:]))*layout["dtype"].itemsize
+    return np.memmap(layout["datafile"],dtype=layout["dtype"],mode="r",
+                     offset=layout["offset"]+k0*plane,shape=(k1-k0,)+tuple(shape[1:]))
+
+def _mhd_output_header(layout,dtype,output_file):
+    """
+    Helper function: header of the output file, copied from the header of the
+    first input (geometry, orientation, ...) with the given pixel type, uncompressed,
+    little endian and with the data in a .raw file next to the .mhd (or LOCAL for .mha).
+    """
+    header = dict(layout["header"])
+    for key in ("CompressedData","CompressedDataSize","HeaderSize","ElementByteOrderMSB","ElementDataFile"):
+        header.pop(key,None)
+    header["BinaryData"] = "True"
+    header["BinaryDataByteOrderMSB"] = "False"
+    header["CompressedData"] = "False"
+    header["ElementType"] = [met for met,code in _met_element_types.items() if np.dtype(code) == np.dtype(dtype).newbyteorder("<")][0]
+    if output_file.lower().endswith(".mha"):
+        header["ElementDataFile"] = "LOCAL"
+        return header, output_file
+    rawfile = os.path.splitext(output_file)[0]+".raw"
+    header["ElementDataFile"] = os.path.basename(rawfile)
+    return header, rawfile
+
+def image_reduce_memmap(operation, input_list, output_file, slab=None):
+    """
+    Out-of-core version of `image_sum`, `image_product`, `image_min`, `image_max`,
+    `image_mean`, `image_std` and `image_sem` for uncompressed MetaImage files
+    (.mhd/.raw or .mha), of any dimension:
+    * `operation` is one of "sum", "product", "min", "max", "mean", "std", "sem"
+    * `input_list` is a list of filenames; the geometry of all files is checked
+      from the headers, before any pixel data is read
+    * the output is written to `output_file` (.mhd, with a .raw data file, or .mha)
+    * the images are processed in slabs of `slab` planes along the last image axis
+      (by default about 4M voxels), the output file is written slab by slab.
+    The sums and statistics are computed in float64 (for float inputs); the output has
+    the pixel type of the inputs, or float64 for the mean, std and sem of integer images.
+    Returns the output filename.
+    """
+    reductions = ("sum","product","min","max","mean","std","sem")
+    if operation not in reductions:
+        raise ValueError("unknown operation '{}', choose from {}".format(operation,reductions))
+    if not input_list:
+        raise RuntimeError("got no images")
+    layouts = [_mhd_layout(filename) for filename in input_list]
+    for layout in layouts[1:]:
+        _check_geometry(layout,layouts[0])
+        if layout["shape"] != layouts[0]["shape"]:
+            raise TypeError("images have incompatible number of channels: {} versus {}".format(layouts[0]["shape"],layout["shape"]))
+    input_dtype = np.result_type(*[layout["dtype"] for layout in layouts]).newbyteorder("=")
+    floating = np.issubdtype(input_dtype,np.floating)
+    if operation in ("mean","std","sem"):
+        output_dtype = input_dtype if floating else np.dtype(np.float64)
+    else:
+        output_dtype = input_dtype
+    acc_dtype = np.float64 if floating else input_dtype
+    shape = layouts[0]["shape"]
+    nplane = int(np.prod(shape[1:]))
+    if slab is None:
+        slab = max(1,2**22//nplane)
+    header, datafile = _mhd_output_header(layouts[0],output_dtype,output_file)
+    ops = dict(sum=np.add,product=np.multiply,min=np.minimum,max=np.maximum)
+    with open(output_file,"w") as f:
+        for key,value in header.items():
+            f.write("{} = {}\n".format(key,value))
+    with open(datafile,"ab" if datafile == output_file else "wb") as fout:
+        for k0 in range(0,shape[0],slab):
+            k1 = min(k0+slab,shape[0])
+            if operation in ops:
+                acc = None
+                for layout in layouts:
+                    np_slab = _memmap_slab(layout,k0,k1)
+                    if acc is None:
+                        acc = np.array(np_slab,dtype=acc_dtype)
+                    else:
+                        ops[operation](acc,np_slab,out=acc,casting="unsafe")
+                    del np_slab
+            else:
+                stats = running_statistics()
+                for layout in layouts:
+                    np_slab = _memmap_slab(layout,k0,k1)
+                    stats.add(np_slab)
+                    del np_slab
+                acc = getattr(stats,operation) if len(layouts) > 1 else stats.mean
+            fout.write(np.ascontiguousarray(acc,dtype=output_dtype.newbyteorder("<")).tobytes())
+            logger.debug("{} of {} images: planes {}-{} of {}".format(operation,len(layouts),k0,k1,shape[0]))
+    return output_file
+
+#####################################################################################
+import unittest
+import shutil
+import tempfile
+import itk
+from .logging_conf import LoggedTestCase
+
+class Test_ImageMemmap(LoggedTestCase):
+    def test_reductions(self):
+        logger.info('Test_ImageMemmap test_reductions')
+        from .image_arithm import image_sum, image_product, image_min, image_max, image_mean, image_std, image_sem
+        tmpdirpath = tempfile.mkdtemp()
+        spacing, origin = (2.,3.,4.), (-1.,-2.,-3.)
+        filenames = list()
+        for i in range(5):
+            img = itk.image_from_array(np.random.uniform(0.5,2.,(9,8,7)).astype(np.float32))
+            img.SetSpacing(spacing)
+            img.SetOrigin(origin)
+            filenames.append(os.path.join(tmpdirpath,f"input{i}."+("mha" if i==2 else "mhd")))
+            itk.imwrite(img,filenames[-1])
+        self.assertEqual(mhd_memmap(filenames[0]).shape,(9,8,7))
+        self.assertTrue(np.array_equal(mhd_memmap(filenames[2],3,5),itk.array_view_from_image(itk.imread(filenames[2]))[3:5]))
+        functions = dict(sum=image_sum,product=image_product,min=image_min,max=image_max,
+                         mean=image_mean,std=image_std,sem=image_sem)
+        for operation,function in functions.items():
+            expected = itk.array_view_from_image(function(filenames))
+            for slab,ext in ((None,".mhd"),(2,".mha")):
+                output = os.path.join(tmpdirpath,operation+ext)
+                image_reduce_memmap(operation,filenames,output,slab=slab)
+                img = itk.imread(output)
+                self.assertTrue(type(img) == itk.Image[itk.F,3])
+                self.assertTrue(np.allclose(img.GetSpacing(),spacing))
+                self.assertTrue(np.allclose(img.GetOrigin(),origin))
+                self.assertTrue(np.allclose(itk.array_view_from_image(img),expected,rtol=1e-5))
+        # compressed data cannot be memory-mapped
+        itk.imwrite(itk.imread(filenames[0]),os.path.join(tmpdirpath,"compressed.mhd"),compression=True)
+        with self.assertRaises(ValueError):
+            image_reduce_memmap("sum",filenames+[os.path.join(tmpdirpath,"compressed.mhd")],os.path.join(tmpdirpath,"out.mhd"))
+        shutil.rmtree(tmpdirpath)
+    def test_4D(self):
+        logger.info('Test_ImageMemmap test_4D')
+        tmpdirpath = tempfile.mkdtemp()
+        arrays, filenames = list(), list()
+        for i in range(3):
+            arrays.append((np.arange(3*4*5*6)%7+i).reshape(6,5,4,3).astype(np.uint16))
+            filenames.append(os.path.join(tmpdirpath,f"input{i}.mhd"))
+            itk.imwrite(itk.image_from_array(arrays[-1]),filenames[-1])
+        output = os.path.join(tmpdirpath,"sum.mhd")
+        image_reduce_memmap("sum",filenames,output,slab=4)
+        img = itk.imread(output)
+        self.assertEqual(img.GetImageDimension(),4)
+        self.assertTrue(np.array_equal(itk.array_view_from_image(img),np.sum(arrays,axis=0)))
+        image_reduce_memmap("mean",filenames,output,slab=4)
+        self.assertTrue(np.allclose(mhd_memmap(output),np.mean(arrays,axis=0)))
+        shutil.rmtree(tmpdirpath)
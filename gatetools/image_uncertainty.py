@@ -21,12 +21,20 @@ method as explained for example in [Chetty2006]
 # -----------------------------------------------------------------------------
 
 
+import os
+import csv
+import json
+import time
 import itk
 import gatetools as gt
 from functools import reduce
 import operator
 import numpy as np
 import numpy.testing as npt
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from .image_arithm import _image_stream_sum, _image_from_array, _image_header, _check_geometry, image_accumulator
+from .stat_file import completed_output_dirs
 import logging
 logger=logging.getLogger(__name__)
 
@@ -58,36 +66,66 @@ def relative_uncertainty(x, sq_x, N, sigma_flag, threshold=0):
     return u
 
 
-def relative_uncertainty_by_slice(x, sigma_flag, threshold=0, sq_x=[], N=0):
-    i=0
-    means = []
-    nb = []
-    uncertainty = np.copy(x)
-    uncertainty.fill(0.0)
-    use_square = False
+def relative_uncertainty_by_slice(x, sigma_flag, threshold=0, sq_x=[], N=0, axis=0):
+    """
+    Relative uncertainty (see `relative_uncertainty` and `relative_uncertainty_Poisson`)
+    with a threshold per slice: for each slice, only the pixels with a value larger than
+    threshold*max(slice) are considered. The slices are indexed by `axis` (an int or a
+    tuple of ints, e.g. (0,1) for the energy windows and heads of a 4D projection
+    image); all other axes are reduced, with whole-array operations.
+    Returns the uncertainty array, the mean uncertainty of the considered pixels per
+    slice (1.0 for slices without any such pixel) and the number of considered pixels
+    per slice, as (nested) lists with the shape of the slice axes.
+    """
+    axes = (axis,) if np.isscalar(axis) else tuple(axis)
+    axes = tuple(a % x.ndim for a in axes)
+    other = tuple(a for a in range(x.ndim) if a not in axes)
+    t = np.max(x, axis=other, keepdims=True)*threshold
     if len(sq_x)>0:
-        use_square = True
+        uncertainty = relative_uncertainty(x, sq_x, N, sigma_flag, t)
     else:
-        sq_x = x
-
-    for s, sq in zip(x, sq_x):
-        t = np.max(s)*threshold
-        if use_square:
-            u = relative_uncertainty(s, sq, N, sigma_flag, t)
-        else:
-            u = relative_uncertainty_Poisson(s, sigma_flag, t)
-        n = len(np.where(s > t)[0])
-        if n==0:
-            mean = 1.0
-        else:
-            mean = u[np.where(s > t)].sum()
-            mean = mean/n
-        means.append(mean)
-        nb.append(n)
-        uncertainty[i] = u
-        i = i + 1
-
-    return uncertainty, means, nb
+        uncertainty = relative_uncertainty_Poisson(x, sigma_flag, t)
+    uncertainty = uncertainty.astype(x.dtype, copy=False)
+    mask = x > t
+    nb = np.count_nonzero(mask, axis=other)
+    sums = np.add.reduce(uncertainty, axis=other, where=mask)
+    means = np.divide(sums, nb, out=np.ones(nb.shape), where=nb > 0)
+    return uncertainty, means.tolist(), nb.tolist()
+
+
+def _output_dtype(input_dtype):
+    """
+    The uncertainty is computed in float64; the output image gets the pixel type of the
+    input images if that is a floating point type (e.g. float32 for Gate dose images).
+    """
+    return input_dtype if np.issubdtype(input_dtype,np.floating) else np.float64
+
+
+def _stream_sums(img_list, img_squared_list, prefetch=0, accumulator=None, N=0):
+    """
+    Sum and sum of squares of the partial outputs, accumulated in float64. The
+    images (filenames or image objects) are read one by one and released after
+    they have been added, so the memory use does not depend on the number of files.
+    With `prefetch`>0 the next `prefetch` files are read in background threads.
+    With `accumulator` (the filename of an `image_accumulator` manifest) the images,
+    and the N events, are added to the sums of a previous merge (only the files that
+    are not yet included), and the accumulator is saved.
+    Returns the sums, the geometry, the output dtype and the total number of events.
+    """
+    if accumulator is not None:
+        acc = image_accumulator(accumulator)
+        acc.add_files(img_list, img_squared_list, events=N)
+        if acc.squared_sum is None:
+            raise ValueError("the accumulator {} has no squared sums".format(accumulator))
+        acc.save()
+        return acc.sum, acc.squared_sum, acc.info, _output_dtype(acc.input_dtype), acc.events
+    np_sum, n, info, input_dtype = _image_stream_sum(img_list, prefetch=prefetch)
+    np_sq_sum, nsq, sqinfo, sq_dtype = _image_stream_sum(img_squared_list, prefetch=prefetch)
+    if n != nsq:
+        logger.warning(f"got {n} images and {nsq} squared images")
+    if not np.allclose(info["size"],sqinfo["size"]):
+        raise TypeError("images and squared images have incompatible size: {} versus {}".format(info["size"],sqinfo["size"]))
+    return np_sum, np_sq_sum, info, _output_dtype(input_dtype), N
 
 
 def check_N(N):
@@ -96,41 +134,42 @@ def check_N(N):
         raise RuntimeError('ERROR: N  must be positive')
 
 
-def image_uncertainty(img_list=[], img_squared_list=[], N=0, sigma_flag=False, threshold=0):
+def image_uncertainty(img_list=[], img_squared_list=[], N=0, sigma_flag=False, threshold=0, prefetch=0, accumulator=None):
+    """
+    Relative uncertainty image of the sum of the images in `img_list`, with the sum of
+    the squared images in `img_squared_list`, for N events in total [Chetty 2006].
+    With `accumulator` (the filename of an `image_accumulator` manifest), the images and
+    the N events extend the sums of a previous merge, and the uncertainty is computed
+    for all images and events in the accumulator.
+    """
     check_N(N)
 
     # Get the sums
-    img_sum = gt.image_sum(img_list)
-    img_sq_sum = gt.image_sum(img_squared_list)
-
-    # View as np
-    np_sum = itk.array_view_from_image(img_sum)
-    np_sq_sum = itk.array_view_from_image(img_sq_sum)
+    np_sum, np_sq_sum, info, dtype, N = _stream_sums(img_list, img_squared_list, prefetch, accumulator, N)
 
     # Compute relative uncertainty [Chetty 2006]
     t = np.max(np_sum)*threshold
     uncertainty = relative_uncertainty(np_sum, np_sq_sum, N, t)
 
     # create and return itk image
-    img_uncertainty = itk.image_from_array(uncertainty)
-    img_uncertainty.CopyInformation(img_sum)
-    return img_uncertainty
-
-def image_uncertainty_per_region(img_list=[], img_squared_list=[], img_label=None, N=0, sigma_flag=False, threshold=0):
+    return _image_from_array(uncertainty.astype(dtype), info)
+
+def image_uncertainty_per_region(img_list=[], img_squared_list=[], img_label=None, N=0, sigma_flag=False, threshold=0, prefetch=0, accumulator=None, output_file=None):
+    """
+    Relative uncertainty of the sum of the images in every region (label) of the
+    label image `img_label`, as an array indexed by label. With `output_file` the
+    uncertainty of every label is also written to that text file, one
+    "label<TAB>uncertainty" line per label.
+    """
     check_N(N)
 
     # Check label image
     if img_label is None:
-        image_uncertainty(img_list, img_squared_list, N, sigma_flag, threshold)
+        image_uncertainty(img_list, img_squared_list, N, sigma_flag, threshold, prefetch, accumulator)
         return
 
     # Get the sums
-    img_sum = gt.image_sum(img_list)
-    img_sq_sum = gt.image_sum(img_squared_list)
-
-    # View as np
-    np_sum = itk.array_view_from_image(img_sum)
-    np_sq_sum = itk.array_view_from_image(img_sq_sum)
+    np_sum, np_sq_sum, info, dtype, N = _stream_sums(img_list, img_squared_list, prefetch, accumulator, N)
     np_label = itk.array_from_image(img_label).astype(int)
 
     # Group values by label
@@ -142,41 +181,143 @@ def image_uncertainty_per_region(img_list=[], img_squared_list=[], img_label=Non
     t = np.max(np_sum_by_label)*threshold
     uncertainty = relative_uncertainty(np_sum_by_label, np_sq_sum_by_label, N, t)
 
-    # create a text file to save uncertainty by region
-    with open('uncertainty_by_region.txt', 'w') as f:
-        for i, value in enumerate(uncertainty):
-            f.write(f"{i}\t{value}\n")
+    # save uncertainty by region
+    if output_file is not None:
+        with open(output_file, 'w') as f:
+            for i, value in enumerate(uncertainty):
+                f.write(f"{i}\t{value}\n")
     return uncertainty
 
-def image_uncertainty_by_slice(img_list=[], img_squared_list=[], N=0, sigma_flag=False, threshold=0):
+class _SharedSums:
+    """
+    Context manager that copies the (flattened) sum and sum of squares into
+    shared memory, so that worker processes can access them without pickling.
+    Worker processes get the sums back with `_attach_shared_sums(spec)`.
+    """
+    def __init__(self,np_sum,np_sq_sum):
+        self.shape = (2,np_sum.size)
+        self.np_sum,self.np_sq_sum = np_sum,np_sq_sum
+    def __enter__(self):
+        self.shm = shared_memory.SharedMemory(create=True,size=max(8*self.shape[0]*self.shape[1],1))
+        sums = np.ndarray(self.shape,dtype=np.float64,buffer=self.shm.buf)
+        sums[0] = self.np_sum.ravel()
+        sums[1] = self.np_sq_sum.ravel()
+        del self.np_sum,self.np_sq_sum,sums
+        self.spec = (self.shm.name,self.shape)
+        return self
+    def __exit__(self,*args):
+        self.shm.close()
+        self.shm.unlink()
+
+def _attach_shared_sums(spec):
+    name,shape = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape,dtype=np.float64,buffer=shm.buf)
+
+def _sums_by_label(label_map, np_sum, np_sq_sum):
+    """
+    Helper function: sum, sum of squares and number of voxels for every label
+    of `label_map` (an image filename, image object or array with the same number
+    of voxels as the sums), with one `bincount` pass per quantity.
+    """
+    if isinstance(label_map, str):
+        label_map = itk.imread(label_map)
+    if not isinstance(label_map, np.ndarray):
+        label_map = itk.array_view_from_image(label_map)
+    np_label = label_map.ravel().astype(np.intp, copy=False)
+    if np_label.size != np_sum.size:
+        raise TypeError("the label map has {} voxels, the images {}".format(np_label.size, np_sum.size))
+    if np_label.size > 0 and np_label.min() < 0:
+        raise ValueError("label maps must have non-negative labels, found {}".format(np_label.min()))
+    voxels = np.bincount(np_label)
+    sums = np.bincount(np_label, weights=np_sum.ravel(), minlength=len(voxels))
+    sq_sums = np.bincount(np_label, weights=np_sq_sum.ravel(), minlength=len(voxels))
+    return sums, sq_sums, voxels
+
+def _sums_by_label_shared(label_map, spec):
+    shm, sums = _attach_shared_sums(spec)
+    try:
+        return _sums_by_label(label_map, sums[0], sums[1])
+    finally:
+        del sums
+        shm.close()
+
+def image_uncertainty_by_labels(img_list=[], img_squared_list=[], label_maps=[], N=0, sigma_flag=False, threshold=0, workers=1, prefetch=0, accumulator=None):
+    """
+    Uncertainty by region for any number of label maps (e.g. several atlases or
+    segmentations of the same patient), with the images and squared images summed once.
+    * `label_maps` is a dictionary name -> label map, or a list of label maps (then
+      named by their filename, or "label_map_<i>" for image objects); a label map is
+      an image filename or an image object with the same geometry as the dose images
+    * the sum, sum of squares and number of voxels of every region are computed with
+      `bincount`, and the relative uncertainty (or sigma, with `sigma_flag`) of the
+      region sums as in `image_uncertainty_per_region`; regions with a sum below
+      `threshold` times the largest region sum of the label map get uncertainty 1
+    * with `workers`>1 the label maps are processed by a pool of worker processes,
+      which read the label map files themselves and share the sums (in shared memory)
+    * `prefetch` and `accumulator` are as in `image_uncertainty`
+    Returns a table: a list with one dictionary per (label map, label) with at least
+    one voxel, with the keys "label_map", "label", "voxels", "sum" and "uncertainty".
+    See `write_uncertainty_table` to save it.
+    """
+    check_N(N)
+    if not isinstance(label_maps, dict):
+        label_maps = {(m if isinstance(m, str) else "label_map_{}".format(i)): m for i, m in enumerate(label_maps)}
+    if len(label_maps) == 0:
+        raise ValueError("no label map given")
+
+    # Get the sums, once for all label maps
+    np_sum, np_sq_sum, info, dtype, N = _stream_sums(img_list, img_squared_list, prefetch, accumulator, N)
+    for m in label_maps.values():
+        _check_geometry(_image_header(m) if isinstance(m, str) else m, info)
+
+    # Group values by label, for every label map
+    if workers > 1 and len(label_maps) > 1:
+        with _SharedSums(np_sum, np_sq_sum) as shared, ProcessPoolExecutor(min(workers, len(label_maps))) as pool:
+            del np_sum, np_sq_sum
+            futures = [pool.submit(_sums_by_label_shared, m if isinstance(m, str) else itk.array_from_image(m), shared.spec)
+                       for m in label_maps.values()]
+            results = [f.result() for f in futures]
+    else:
+        results = [_sums_by_label(m, np_sum, np_sq_sum) for m in label_maps.values()]
+
+    # Compute relative uncertainty [Chetty 2006] of the region sums
+    table = []
+    for name, (sums, sq_sums, voxels) in zip(label_maps, results):
+        uncertainty = relative_uncertainty(sums, sq_sums, N, sigma_flag, np.max(sums)*threshold)
+        for label in np.flatnonzero(voxels):
+            table.append(dict(label_map=name, label=int(label), voxels=int(voxels[label]),
+                              sum=float(sums[label]), uncertainty=float(uncertainty[label])))
+    return table
+
+def write_uncertainty_table(table, filename):
+    """
+    Write the table of `image_uncertainty_by_labels` to a CSV file (if `filename`
+    ends with ".csv") or to a tab separated text file otherwise, with a header line.
+    """
+    with open(filename, "w", newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=["label_map", "label", "voxels", "sum", "uncertainty"],
+                                delimiter="," if filename.endswith(".csv") else "\t")
+        writer.writeheader()
+        writer.writerows(table)
+
+def image_uncertainty_by_slice(img_list=[], img_squared_list=[], N=0, sigma_flag=False, threshold=0, prefetch=0, axis=0, accumulator=None):
     check_N(N)
 
     # Get the sums
-    img_sum = gt.image_sum(img_list)
-    img_sq_sum = gt.image_sum(img_squared_list)
-
-    # View as np
-    np_sum = itk.array_view_from_image(img_sum)
-    np_sq_sum = itk.array_view_from_image(img_sq_sum)
+    np_sum, np_sq_sum, info, dtype, N = _stream_sums(img_list, img_squared_list, prefetch, accumulator, N)
 
     # compute uncertainty
-    uncertainty, means, nb = relative_uncertainty_by_slice(np_sum, sigma_flag, threshold, np_sq_sum, N)
+    uncertainty, means, nb = relative_uncertainty_by_slice(np_sum, sigma_flag, threshold, np_sq_sum, N, axis)
 
     # create and return itk image
-    img_uncertainty = itk.image_from_array(uncertainty)
-    img_uncertainty.CopyInformation(img_sum)
+    img_uncertainty = _image_from_array(uncertainty.astype(dtype), info)
     return img_uncertainty, means, nb
 
 
-def image_uncertainty_Poisson(img_list=[], sigma_flag=False, threshold=0):
-    # Get the sums
-    img_sum = gt.image_sum(img_list)
-
-    # View as np
-    np_sum = itk.array_view_from_image(img_sum)
-
-    # Convert to float
-    np_sum = np_sum.astype(np.float64)
+def image_uncertainty_Poisson(img_list=[], sigma_flag=False, threshold=0, prefetch=0):
+    # Get the sum (float64)
+    np_sum, n, info, input_dtype = _image_stream_sum(img_list, prefetch=prefetch)
 
     # Get stddev (variance is the mean)
     sigma_flag = np.sqrt(np_sum)
@@ -189,32 +330,138 @@ def image_uncertainty_Poisson(img_list=[], sigma_flag=False, threshold=0):
     uncertainty = uncertainty.astype(np.float32)
 
     # create and return itk image
-    img_uncertainty = itk.image_from_array(uncertainty)
-    img_uncertainty.CopyInformation(img_sum)
-    return img_uncertainty
+    return _image_from_array(uncertainty, info)
 
 
-def image_uncertainty_Poisson_by_slice(img_list=[], sigma_flag=False, threshold=0):
-    # Get the sums
-    img_sum = gt.image_sum(img_list)
-
-    # View as np
-    np_sum = itk.array_view_from_image(img_sum)
-
-    # Convert to float
-    np_sum = np_sum.astype(np.float64)
+def image_uncertainty_Poisson_by_slice(img_list=[], sigma_flag=False, threshold=0, prefetch=0, axis=0):
+    # Get the sum (float64)
+    np_sum, n, info, input_dtype = _image_stream_sum(img_list, prefetch=prefetch)
 
     # compute uncertainty
-    uncertainty, means, nb = relative_uncertainty_by_slice(np_sum, sigma_flag, threshold)
+    uncertainty, means, nb = relative_uncertainty_by_slice(np_sum, sigma_flag, threshold, axis=axis)
 
     # np is double, convert to float32
     uncertainty = uncertainty.astype(np.float32)
 
     # create and return itk image
-    img_uncertainty = itk.image_from_array(uncertainty)
-    img_uncertainty.CopyInformation(img_sum)
+    img_uncertainty = _image_from_array(uncertainty, info)
     return img_uncertainty, means, nb
 
+def _squared_filename(filename):
+    base,ext = os.path.splitext(filename)
+    return base+"-Squared"+ext
+
+def completed_output_pairs(rundir, filename, settle=10.):
+    """
+    Find the (dose, squared dose) file pairs `output*/<filename>` and
+    `output*/<filename without extension>-Squared<extension>` in the Gate run
+    directory `rundir` that are complete: both files exist, and none of the files
+    in the output directory has been modified in the last `settle` seconds (Gate
+    writes the images at the end of the job), see `completed_output_dirs`.
+    Returns a list of (dose filename, squared dose filename, number of events or None),
+    sorted by output directory.
+    """
+    pairs = list()
+    for outputdir,events in completed_output_dirs(rundir,settle,stat_file=False):
+        dose = os.path.join(outputdir,filename)
+        squared = _squared_filename(dose)
+        if os.path.isfile(dose) and os.path.isfile(squared):
+            pairs.append((os.path.abspath(dose),os.path.abspath(squared),events))
+    return pairs
+
+class uncertainty_watcher(object):
+    """
+    Follow the relative statistical uncertainty of a running Gate job array.
+    The (dose, squared dose) pairs of the finished jobs in `rundir` (see
+    `completed_output_pairs`) are added to an `image_accumulator` which is
+    persisted in `state_dir` (by default `<rundir>/uncertainty_watch`), so that every
+    partial output is read only once, also when the watcher is restarted.
+    * `filename` is the name of the dose image in the output directories, e.g. "dose-Edep.mhd"
+    * the number of events of a job is read from the stat file in its output directory,
+      or is `nevents` (events per job) if there is none
+    * the mean relative uncertainty is reported for all voxels with a nonzero dose, and
+      for the voxels with a dose larger than `threshold` times the maximum dose
+    * when the latter is at most `target`, the target is reached, and if `stop_file`
+      is given, a stop signal file is written, e.g. for the job scripts to check
+      before they start the simulation.
+    """
+    def __init__(self, rundir, filename, state_dir=None, nevents=0, threshold=0.1, target=None, stop_file=None, settle=10.):
+        self.rundir = rundir
+        self.filename = filename
+        self.state_dir = state_dir if state_dir is not None else os.path.join(rundir,"uncertainty_watch")
+        self.nevents = nevents
+        self.threshold = threshold
+        self.target = target
+        self.stop_file = stop_file
+        self.settle = settle
+        # running sums of a previous watch of the same run, if any
+        self.accumulator = image_accumulator(os.path.join(self.state_dir,os.path.splitext(filename)[0]+".json"))
+        if self.accumulator.n > 0:
+            logger.info("resuming uncertainty watch of {} with {} outputs".format(self.rundir,self.accumulator.n))
+    def update(self):
+        """
+        Add the outputs that were completed since the last update, save the state
+        (see `image_accumulator`) and return the current report (see `report`).
+        """
+        acc = self.accumulator
+        new_pairs = [p for p in completed_output_pairs(self.rundir,self.filename,self.settle) if not acc.included(p[0])]
+        for dose,squared,events in new_pairs:
+            acc.add(dose, squared, self.nevents if events is None else events)
+        if new_pairs:
+            logger.info("added {} outputs, {} in total".format(len(new_pairs),acc.n))
+            os.makedirs(self.state_dir,exist_ok=True)
+            acc.save()
+        return self.report()
+    def report(self):
+        """
+        Current state: number of outputs ("n") and events ("events"), mean relative
+        uncertainty of the voxels with nonzero dose ("mean_uncertainty") and of the
+        voxels above the threshold ("mean_uncertainty_threshold"), and whether the
+        target is reached ("target_reached").
+        """
+        acc = self.accumulator
+        report = dict(n=acc.n,events=acc.events,mean_uncertainty=np.nan,
+                      mean_uncertainty_threshold=np.nan,target_reached=False)
+        if acc.sum is None or acc.events < 2:
+            return report
+        uncertainty = relative_uncertainty(acc.sum, acc.squared_sum, acc.events, False)
+        nonzero = acc.sum > 0
+        region = acc.sum > self.threshold*np.max(acc.sum)
+        if np.any(nonzero):
+            report["mean_uncertainty"] = float(np.mean(uncertainty[nonzero]))
+        if np.any(region):
+            report["mean_uncertainty_threshold"] = float(np.mean(uncertainty[region]))
+        report["target_reached"] = self.target is not None and report["mean_uncertainty_threshold"] <= self.target
+        return report
+    def uncertainty_image(self):
+        """
+        The current relative uncertainty image (float32).
+        """
+        acc = self.accumulator
+        uncertainty = relative_uncertainty(acc.sum, acc.squared_sum, acc.events, False)
+        return _image_from_array(uncertainty.astype(np.float32), acc.info)
+    def watch(self, interval=60., max_updates=None, callback=None):
+        """
+        Update every `interval` seconds, until the target is reached (the stop file is
+        then written) or after `max_updates` updates. `callback` is called with every report.
+        Returns the last report.
+        """
+        nupdates = 0
+        while True:
+            report = self.update()
+            nupdates += 1
+            if callback is not None:
+                callback(report)
+            if report["target_reached"]:
+                if self.stop_file is not None:
+                    with open(self.stop_file,"w") as f:
+                        json.dump(report,f,indent=1)
+                    logger.info("target uncertainty {} reached, wrote {}".format(self.target,self.stop_file))
+                return report
+            if max_updates is not None and nupdates >= max_updates:
+                return report
+            time.sleep(interval)
+
 #####################################################################################
 import unittest
 import hashlib
@@ -267,6 +514,70 @@ class Test_Uncertainty(LoggedTestCase):
             new_hash = hashlib.sha256(bytesNew).hexdigest()
             self.assertTrue("0e1f8e0f0d7d7d3921c726dc33409345e6d9b8bfcc53b797d67f8b48997fa1a5" == new_hash)
         shutil.rmtree(tmpdirpath)
+    def test_uncertainty_watcher(self):
+        np.random.seed(7)
+        rundir = tempfile.mkdtemp()
+        edep, sq_edep = np.zeros((5,6,7)), np.zeros((5,6,7))
+        def write_output(i, events):
+            nonlocal edep, sq_edep
+            a = np.random.exponential(1.,(5,6,7)).astype(np.float32)
+            sq = (a*a*np.random.uniform(0.1,0.5,a.shape)).astype(np.float32)
+            edep += a
+            sq_edep += sq
+            outputdir = os.path.join(rundir,f"output.{i}")
+            os.makedirs(outputdir)
+            itk.imwrite(itk.image_from_array(a),os.path.join(outputdir,"dose-Edep.mhd"))
+            itk.imwrite(itk.image_from_array(sq),os.path.join(outputdir,"dose-Edep-Squared.mhd"))
+            if events is not None:
+                with open(os.path.join(outputdir,"stat.txt"),"w") as f:
+                    f.write(f"# NumberOfRun    = 1\n# NumberOfEvents = {events}\n")
+        for i in range(3):
+            write_output(i, 100)
+        # an unfinished job
+        os.makedirs(os.path.join(rundir,"output.99"))
+        itk.imwrite(itk.image_from_array(np.ones((5,6,7),dtype=np.float32)),os.path.join(rundir,"output.99","dose-Edep.mhd"))
+        watcher = uncertainty_watcher(rundir, "dose-Edep.mhd", nevents=50, threshold=0.2, settle=0.)
+        report = watcher.update()
+        self.assertEqual((report["n"],report["events"]),(3,300))
+        expected = relative_uncertainty(edep, sq_edep, 300, False)
+        npt.assert_allclose(report["mean_uncertainty"],np.mean(expected[edep>0]))
+        npt.assert_allclose(report["mean_uncertainty_threshold"],np.mean(expected[edep>0.2*np.max(edep)]))
+        self.assertFalse(report["target_reached"])
+        # two more jobs (one without stat file), and a new watcher that resumes from the saved sums
+        write_output(3, 100)
+        write_output(4, None)
+        stop_file = os.path.join(rundir,"STOP")
+        watcher = uncertainty_watcher(rundir, "dose-Edep.mhd", nevents=50, threshold=0.2, settle=0., target=1e6, stop_file=stop_file)
+        self.assertEqual(watcher.accumulator.n,3)
+        report = watcher.watch(interval=0., max_updates=3)
+        self.assertEqual((report["n"],report["events"]),(5,450))
+        self.assertTrue(report["target_reached"])
+        self.assertTrue(os.path.isfile(stop_file))
+        npt.assert_allclose(watcher.accumulator.sum,edep,rtol=1e-6)
+        npt.assert_allclose(itk.array_view_from_image(watcher.uncertainty_image()),
+                            relative_uncertainty(edep, sq_edep, 450, False),rtol=1e-4)
+        shutil.rmtree(rundir)
+    def test_relative_uncertainty_by_slice_axes(self):
+        # 4D projections (energy windows, heads, y, x): one table for all windows and heads
+        np.random.seed(3)
+        x = np.random.exponential(1.,(3,2,20,30))
+        x[2,1] = 0.
+        sq_x = x*x*np.random.uniform(0.5,1.5,x.shape)
+        u, means, nb = relative_uncertainty_by_slice(x, False, 0.2, sq_x, 100, axis=(0,1))
+        self.assertEqual(np.array(means).shape,(3,2))
+        self.assertEqual(u.shape,x.shape)
+        for i in range(3):
+            for j in range(2):
+                s = x[i,j]
+                t = np.max(s)*0.2
+                us = relative_uncertainty(s, sq_x[i,j], 100, False, t)
+                npt.assert_allclose(u[i,j], us)
+                self.assertEqual(nb[i][j], np.count_nonzero(s > t))
+                npt.assert_almost_equal(means[i][j], np.mean(us[s > t]) if nb[i][j] else 1.0)
+        # the slice axis can also be the last one
+        u, means, nb = relative_uncertainty_by_slice(x, True, 0.2, axis=-1)
+        self.assertEqual(len(means),30)
+        self.assertEqual(nb[5], np.count_nonzero(x[...,5] > 0.2*np.max(x[...,5])))
     def test_image_uncertainty_Poisson(self):
         x = np.arange(0, 1, 0.01)
         y = np.arange(0, 1, 0.01)
@@ -316,5 +627,82 @@ class Test_Uncertainty(LoggedTestCase):
         simage = itk.image_from_array(np.float64(npsImage))
         simages = [simage]
         limage = itk.image_from_array(np.float64(pattern_array))
-        uncertainty = image_uncertainty_per_region(images, simages, limage, N=1000000000000)
+        tmpdirpath = tempfile.mkdtemp()
+        output_file = os.path.join(tmpdirpath, "uncertainty_by_region.txt")
+        uncertainty = image_uncertainty_per_region(images, simages, limage, N=1000000000000, output_file=output_file)
         self.assertTrue(np.allclose(uncertainty, np.array([0.00103301, 0.00103302, 0.00103302, 0.00103302, 0.00103302, 0.00103301, 0.00103301, 0.00103301, 0.00103301])))
+        table = np.loadtxt(output_file)
+        self.assertTrue(np.array_equal(table[:,0], np.arange(9)))
+        self.assertTrue(np.allclose(table[:,1], uncertainty))
+        shutil.rmtree(tmpdirpath)
+    def test_image_uncertainty_by_labels(self):
+        np.random.seed(3)
+        tmpdirpath = tempfile.mkdtemp()
+        edep = np.random.exponential(1.,(3,6,7,8))
+        sq_edep = edep*edep*np.random.uniform(0.1,0.5,edep.shape)
+        images = [itk.image_from_array(np.float32(a)) for a in edep]
+        simages = [itk.image_from_array(np.float32(a)) for a in sq_edep]
+        labels = [np.random.randint(0,k,(6,7,8)) for k in (2,5,9)]
+        labels[1][labels[1]==3] = 0 # label 3 is not in the table
+        label_file = os.path.join(tmpdirpath,"atlas.mha")
+        itk.imwrite(itk.image_from_array(np.uint8(labels[2])),label_file)
+        label_maps = {"a":itk.image_from_array(np.uint16(labels[0])),"b":itk.image_from_array(np.float32(labels[1])),"c":label_file}
+        table = image_uncertainty_by_labels(images, simages, label_maps, N=1000)
+        self.assertEqual([(r["label_map"],r["label"]) for r in table],
+                         [("a",0),("a",1),("b",0),("b",1),("b",2),("b",4)]+[("c",i) for i in range(9)])
+        for name,np_label in zip("abc",labels):
+            rows = [r for r in table if r["label_map"]==name]
+            self.assertEqual(sum(r["voxels"] for r in rows),6*7*8)
+            self.assertAlmostEqual(sum(r["sum"] for r in rows),np.sum(np.float32(edep)),delta=1e-3)
+            # same values as the uncertainty of the region sums of one label map
+            sums = np.bincount(np_label.ravel(), weights=np.float32(edep).sum(axis=0, dtype=np.float64).ravel())
+            sq_sums = np.bincount(np_label.ravel(), weights=np.float32(sq_edep).sum(axis=0, dtype=np.float64).ravel())
+            expected = relative_uncertainty(sums, sq_sums, 1000, 0.)
+            self.assertTrue(np.allclose([r["uncertainty"] for r in rows],expected[[r["label"] for r in rows]]))
+        # the label maps processed in worker processes give the same table
+        self.assertEqual(image_uncertainty_by_labels(images, simages, label_maps, N=1000, workers=2),table)
+        # a list of label maps is named by the filenames
+        table = image_uncertainty_by_labels(images, simages, [label_file, label_maps["a"]], N=1000, threshold=0.5, sigma_flag=True)
+        self.assertEqual({r["label_map"] for r in table},{label_file,"label_map_1"})
+        for ext in (".csv",".txt"):
+            filename = os.path.join(tmpdirpath,"uncertainty"+ext)
+            write_uncertainty_table(table,filename)
+            with open(filename) as f:
+                rows = list(csv.DictReader(f,delimiter="," if ext==".csv" else "\t"))
+            self.assertEqual(len(rows),len(table))
+            self.assertAlmostEqual(float(rows[-1]["uncertainty"]),table[-1]["uncertainty"])
+        # label maps must have the geometry of the images
+        with self.assertRaises(TypeError):
+            image_uncertainty_by_labels(images, simages, [itk.image_from_array(np.uint8(labels[0][1:]))], N=1000)
+        shutil.rmtree(tmpdirpath)
+    def test_image_uncertainty_stream(self):
+        # many partial outputs on disk: the sums are accumulated in float64, one file at a time
+        np.random.seed(42)
+        tmpdirpath = tempfile.mkdtemp()
+        filenames, sfilenames = [], []
+        edep, sq_edep = np.zeros((6,7,8)), np.zeros((6,7,8))
+        for i in range(12):
+            a = np.random.exponential(1.,(6,7,8)).astype(np.float32)
+            sq = (a*a*np.random.uniform(0.1,0.5,a.shape)).astype(np.float32)
+            edep += a
+            sq_edep += sq
+            for x,name,names in ((a,"edep",filenames),(sq,"edep-Squared",sfilenames)):
+                img = itk.image_from_array(x)
+                img.SetSpacing((2.,3.,4.))
+                names.append(os.path.join(tmpdirpath,f"output_{i}/{name}.mha"))
+                os.makedirs(os.path.dirname(names[-1]),exist_ok=True)
+                itk.imwrite(img,names[-1])
+        uncertainty = image_uncertainty(filenames, sfilenames, N=1000)
+        self.assertEqual(type(uncertainty),itk.Image[itk.F,3])
+        self.assertTrue(np.allclose(uncertainty.GetSpacing(),(2.,3.,4.)))
+        expected = relative_uncertainty(edep, sq_edep, 1000, False)
+        self.assertTrue(np.allclose(itk.array_view_from_image(uncertainty),expected,rtol=1e-5))
+        # reading the files ahead in background threads gives the same result
+        prefetched = image_uncertainty(filenames, sfilenames, N=1000, prefetch=3)
+        self.assertTrue(np.array_equal(itk.array_view_from_image(prefetched),itk.array_view_from_image(uncertainty)))
+        # merge in two batches with an accumulator: the first 6 outputs, then all of them (the new ones have 500 events)
+        sidecar = os.path.join(tmpdirpath,"merged.json")
+        image_uncertainty(filenames[:6], sfilenames[:6], N=500, accumulator=sidecar)
+        extended = image_uncertainty(filenames, sfilenames, N=500, accumulator=sidecar)
+        self.assertTrue(np.allclose(itk.array_view_from_image(extended),expected,rtol=1e-5))
+        shutil.rmtree(tmpdirpath)
@@ -0,0 +1,982 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+"""
+Merge the partial outputs of a Gate job array (the output* directories of a
+run directory, see gate_split_and_run), in one Python process: the partial
+files are found once, grouped by output name, and every group is reduced with
+one read per partial file and one write per merged file. This replaces the
+pairwise merges of gate_power_merge.sh.
+"""
+
+import os
+import re
+import glob
+import json
+import time
+import shutil
+import filecmp
+import tempfile
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import itk
+import numpy as np
+import logging
+from .image_arithm import _image_information, _image_from_array, _check_geometry
+from .image_uncertainty import image_uncertainty
+from .merge_root import merge_root
+from .stat_file import read_stat_file, merge_stat_files, write_stat_file, find_stat_file, completed_output_dirs
+logger=logging.getLogger(__name__)
+
+merge_extensions = (".hdr",".mhd",".mha",".root",".txt")
+
+def find_partial_outputs(rundir):
+    """
+    Find the output directories (output*, directories or links) of the Gate run
+    directory `rundir`, and the partial output files in them (hdr, mhd, mha, root
+    and txt files, at any depth).
+    Returns the sorted list of output directories and a dictionary with, for every
+    output filename, the sorted list of partial files with this name.
+    """
+    outputdirs = sorted(d for d in glob.glob(os.path.join(rundir,"output*")) if os.path.isdir(d))
+    outputs = dict()
+    for outputdir in outputdirs:
+        for name,path in _job_outputs(outputdir):
+            outputs.setdefault(name,[]).append(path)
+    return outputdirs, {name:sorted(outputs[name]) for name in sorted(outputs)}
+
+def _job_outputs(outputdir):
+    """
+    Helper function: (name, path) of the output files of one job.
+    """
+    outputs = list()
+    for root,dirs,files in os.walk(outputdir,followlinks=True):
+        for f in files:
+            if os.path.splitext(f)[1] in merge_extensions:
+                outputs.append((f,os.path.join(root,f)))
+    return outputs
+
+_resol_re = re.compile(r"Resol\s*=\s*\((.+)\)\s*$", re.MULTILINE)
+
+def output_file_type(filename):
+    """
+    Type of a Gate output file, which determines how the partial files are merged:
+    * "interfile" or "analyze" for .hdr images, "image" for mhd/mha images, "root"
+    * for .txt files: "stat" (SimulationStatisticActor), "dose" (energydose values),
+      "txt_image" (ASCII integral value or profile of an image actor),
+      "dose_by_regions" (DoseActor by regions) or "txt" for any other text file.
+    Returns None for other files.
+    """
+    ext = os.path.splitext(filename)[1]
+    if ext == ".hdr":
+        with open(filename,errors="replace") as f:
+            return "interfile" if "!INTERFILE :=" in f.read() else "analyze"
+    if ext in (".mhd",".mha"):
+        return "image"
+    if ext == ".root":
+        return "root"
+    if ext != ".txt":
+        return None
+    with open(filename,errors="replace") as f:
+        text = f.read()
+    if "NumberOfEvent" in text:
+        return "stat"
+    if "energydose" in text:
+        return "dose"
+    m = _resol_re.search(text)
+    if m:
+        resol = [r.strip() for r in m.group(1).split(",")]
+        if resol.count("1") >= 2:
+            return "txt_image"
+    if "vol(mm3)" in text:
+        return "dose_by_regions"
+    return "txt"
+
+def read_interfile_header(filename):
+    """
+    Read the keys of an Interfile header (lines "!key := value"), with the
+    keys in lower case and without the leading "!".
+    """
+    keys = dict()
+    with open(filename,errors="replace") as f:
+        for line in f:
+            if ":=" in line:
+                key,value = line.split(":=",1)
+                keys[key.strip().lstrip("!").strip().lower()] = value.strip()
+    return keys
+
+def _interfile_data(filename):
+    """
+    Helper function: the name of the data file and the numpy type of an Interfile image.
+    """
+    keys = read_interfile_header(filename)
+    number_format = keys.get("number format","float").lower()
+    nbytes = int(keys.get("number of bytes per pixel",4))
+    kind = "f" if "float" in number_format else "u" if "unsigned" in number_format else "i"
+    byteorder = ">" if keys.get("imagedata byte order","littleendian").lower() == "bigendian" else "<"
+    datafile = os.path.join(os.path.dirname(filename),keys["name of data file"])
+    return datafile, np.dtype(byteorder+kind+str(nbytes))
+
+def _merge_root(partials,merged):
+    if len(partials) == 1:
+        shutil.copy(partials[0],merged)
+    else:
+        merge_root(partials,merged)
+
+def _merge_stat(partials,merged):
+    if len(partials) == 1:
+        shutil.copy(partials[0],merged)
+    else:
+        write_stat_file(merge_stat_files(partials)[0],merged)
+
+def _merge_dose(partials,merged):
+    # lines "# energydose <name> <value>", summed by name
+    values = dict()
+    for partial in partials:
+        with open(partial) as f:
+            for line in f:
+                words = line.split()
+                if len(words) == 4 and words[0] == "#":
+                    values[words[2]] = values.get(words[2],0.)+float(words[3])
+    with open(merged,"w") as f:
+        for name,value in values.items():
+            f.write("# energydose {} {}\n".format(name,repr(value)))
+
+def _read_txt_image(filename):
+    """
+    Helper function: header lines (the leading lines starting with "#") and
+    values of an ASCII image, with the number of values on every line.
+    """
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    nheader = 0
+    while nheader < len(lines) and lines[nheader].startswith("#"):
+        nheader += 1
+    words = [line.split() for line in lines[nheader:]]
+    return lines[:nheader], np.array([float(w) for line in words for w in line]), [len(line) for line in words]
+
+_read_semaphore = None
+
+def _init_read_limit(semaphore):
+    global _read_semaphore
+    _read_semaphore = semaphore
+
+@contextlib.contextmanager
+def _read_slot():
+    """
+    Helper function: in the worker processes of `power_merge`, wait until one
+    of the `max_reads` concurrent reads is free (nothing to wait for otherwise).
+    """
+    if _read_semaphore is None:
+        yield
+    else:
+        with _read_semaphore:
+            yield
+
+def _read_image_data(filename):
+    img = itk.imread(filename)
+    return itk.array_from_image(img), dict(info=_image_information(img),dtype=itk.array_view_from_image(img).dtype)
+
+def _read_interfile_data(filename):
+    datafile,dtype = _interfile_data(filename)
+    return np.fromfile(datafile,dtype=dtype), dict(header=filename,datafile=os.path.basename(datafile),dtype=dtype)
+
+def _read_txt_image_data(filename):
+    header,values,layout = _read_txt_image(filename)
+    return values, dict(header=header,layout=layout)
+
+def _write_image_sum(np_sum,meta,merged):
+    itk.imwrite(_image_from_array(np_sum.astype(meta["dtype"]),meta["info"]),merged)
+
+def _write_interfile_sum(np_sum,meta,merged):
+    # the header of the first partial is copied, with the data file in the same directory
+    np_sum.astype(meta["dtype"]).tofile(os.path.join(os.path.dirname(merged),meta["datafile"]))
+    with open(meta["header"],errors="replace") as f:
+        header = f.read()
+    header = re.sub(r"(name of data file\s*:=).*", lambda m: m.group(1)+" "+meta["datafile"], header)
+    with open(merged,"w") as f:
+        f.write(header)
+
+def _write_txt_image_sum(np_sum,meta,merged):
+    values = iter(np_sum)
+    with open(merged,"w") as f:
+        for line in meta["header"]:
+            f.write(line+"\n")
+        for n in meta["layout"]:
+            f.write(" ".join(repr(float(next(values))) for i in range(n))+"\n")
+
+# outputs that are merged by summing their values: function that reads the values
+# of one partial file, and function that writes the sum
+summed_outputs = {"image":(_read_image_data,_write_image_sum),
+                  "analyze":(_read_image_data,_write_image_sum),
+                  "interfile":(_read_interfile_data,_write_interfile_sum),
+                  "txt_image":(_read_txt_image_data,_write_txt_image_sum)}
+
+def _add_partial_sums(a,b):
+    """
+    Helper function: add the partial sum `b` to `a`, both (float64 values, information),
+    after checking that they are compatible.
+    """
+    if a[0].shape != b[0].shape:
+        raise TypeError("partial outputs with incompatible sizes: {} versus {} values".format(a[0].size,b[0].size))
+    if "info" in a[1]:
+        _check_geometry(b[1]["info"],a[1]["info"])
+    np.add(a[0],b[0],out=a[0])
+    return a
+
+def _read_partial_sum(kind,partials):
+    """
+    Helper function: sum (in float64) of the partial files of a summed output (see
+    `summed_outputs`), reading one file at a time. Returns the sum and the
+    information needed to write it (geometry, pixel type, header ...).
+    """
+    read = summed_outputs[kind][0]
+    result = None
+    for partial in partials:
+        with _read_slot():
+            values,meta = read(partial)
+        if result is None:
+            result = (values.astype(np.float64),meta)
+        else:
+            result = _add_partial_sums(result,(values,meta))
+    return result
+
+def _write_partial_sum(kind,result,merged):
+    summed_outputs[kind][1](result[0],result[1],merged)
+
+def _merge_summed(kind):
+    def merge(partials,merged):
+        _write_partial_sum(kind,_read_partial_sum(kind,partials),merged)
+    return merge
+
+dose_by_regions_columns = ("id","vol","edep","std_edep","sq_edep","dose","std_dose","sq_dose","n_hits","n_event_hits")
+
+def read_dose_by_regions(partials):
+    """
+    Read DoseByRegions tables (DoseActor by regions: a header line, then one line
+    per region with the columns of `dose_by_regions_columns`), all at once.
+    Returns the header line and the lines of the first table, and the values of
+    all tables as a float64 array of shape (number of tables, regions, columns).
+    """
+    header, rows, bodies = None, None, []
+    for partial in partials:
+        with open(partial) as f:
+            lines = f.read().splitlines()
+        if header is None:
+            header, rows = lines[0], [line.split() for line in lines[1:] if line.strip()]
+        bodies.append(" ".join(lines[1:]).split())
+    shape = (len(rows),len(rows[0]) if rows else 0)
+    for partial,body in zip(partials,bodies):
+        if len(body) != shape[0]*shape[1]:
+            raise TypeError("the DoseByRegions table {} has {} values instead of {} regions x {} columns".format(
+                partial,len(body),*shape))
+    values = np.array([w for body in bodies for w in body],dtype=np.float64).reshape((len(partials),)+shape)
+    if shape[1] < len(dose_by_regions_columns):
+        raise TypeError("DoseByRegions tables have {} columns instead of {}".format(shape[1],len(dose_by_regions_columns)))
+    return header, rows, values
+
+def _number_of_primaries(values):
+    """
+    Helper function: number of primaries of every DoseByRegions table, recovered
+    from the relative uncertainty (std), the sum and the sum of squares of the edep
+    or dose of the first region for which it is defined (edep first, then dose).
+    The relative uncertainty of a sum x of N values with sum of squares sq is
+    std = sqrt((sq/N-(x/N)^2)/(N-1))/(x/N), hence N = x^2 (std^2-1) / ((std x)^2-sq).
+    """
+    n = np.zeros(values.shape[:2]+(2,))
+    for i,(x,std,sq) in enumerate(((2,3,4),(5,6,7))):
+        x,std,sq = values[...,x],values[...,std],values[...,sq]
+        denominator = (std*x)**2-sq
+        valid = (x != 0) & (sq != 0) & (denominator != 0)
+        np.divide(x**2*(std**2-1),denominator,out=n[...,i],where=valid)
+    # for every table, the first region and quantity with a non zero number of primaries
+    n = np.rint(n).reshape(len(values),-1)
+    first = np.argmax(n != 0,axis=1)
+    return n[np.arange(len(n)),first]
+
+def merge_dose_by_regions(partials,merged=None):
+    """
+    Merge DoseByRegions tables: the edep, dose, squared edep and dose, and the numbers
+    of hits are summed, the number of primaries of every table is recovered from its
+    uncertainties (see `_number_of_primaries`), and the relative uncertainties of the
+    sums are computed with the total number of primaries (1 if the sum is 0).
+    The merged table is written to `merged` (if given) in the same format: the header
+    line, then one line per region, with the id and volume of the first table.
+    Returns the merged values, as an array of shape (regions, columns), and the total
+    number of primaries.
+    """
+    header, rows, values = read_dose_by_regions(partials)
+    N = np.sum(_number_of_primaries(values))
+    result = np.sum(values,axis=0)
+    result[:,:2] = values[0,:,:2]
+    for x,std,sq in ((2,3,4),(5,6,7)):
+        valid = (result[:,x] != 0) & (result[:,sq] != 0)
+        variance = np.zeros(len(result))
+        if N > 1:
+            variance = (result[:,sq]/N-(result[:,x]/N)**2)/(N-1)
+        u = np.ones(len(result))
+        np.divide(np.sqrt(np.maximum(variance,0.)),result[:,x]/N,out=u,where=valid & (N > 1))
+        result[:,std] = u
+    if merged is not None:
+        with open(merged,"w") as f:
+            f.write(header+"\n")
+            for row,r in zip(rows,result):
+                words = row[:2]+[str(int(v)) if c.startswith("n_") else repr(float(v))
+                                 for c,v in zip(dose_by_regions_columns[2:],r[2:len(dose_by_regions_columns)])]
+                f.write(" ".join(words+row[len(dose_by_regions_columns):])+"\n")
+    return result, int(N)
+
+def _merge_txt(partials,merged):
+    # identical files are copied, different files are concatenated
+    if all(filecmp.cmp(partials[0],partial,shallow=False) for partial in partials[1:]):
+        shutil.copy(partials[0],merged)
+    else:
+        with open(merged,"wb") as f:
+            for partial in partials:
+                with open(partial,"rb") as p:
+                    shutil.copyfileobj(p,f)
+
+output_mergers = {"root":_merge_root, "stat":_merge_stat, "dose":_merge_dose,
+                  "dose_by_regions":merge_dose_by_regions, "txt":_merge_txt}
+output_mergers.update({kind:_merge_summed(kind) for kind in summed_outputs})
+
+def merge_outputs(partials,merged):
+    """
+    Merge the partial files `partials` of one Gate output into the file `merged`,
+    according to the type of the first partial file (see `output_file_type`).
+    Returns the type of the output.
+    """
+    kind = output_file_type(partials[0])
+    if kind is None:
+        raise TypeError("unknown type of Gate output {}".format(partials[0]))
+    output_mergers[kind](partials,merged)
+    return kind
+
+def _merge_family(partials,merged):
+    with _read_slot():
+        return merge_outputs(partials,merged)
+
+def _sum_block(kind,partials,tmpfile):
+    """
+    Helper function: sum the block of partial files `partials` of a summed output
+    (see `summed_outputs`) in a worker process, and save the float64 sum to the
+    .npy file `tmpfile`. Returns the information needed to write the sum.
+    """
+    values,meta = _read_partial_sum(kind,partials)
+    np.save(tmpfile,values)
+    return meta
+
+def _write_block_sums(kind,blocks,merged):
+    """
+    Helper function: add the block sums `blocks` (list of (.npy file, information),
+    see `_sum_block`) one at a time, write the total to `merged` and remove the
+    .npy files.
+    """
+    result = None
+    for tmpfile,meta in blocks:
+        values = np.load(tmpfile,mmap_mode="r")
+        if result is None:
+            result = (np.array(values),meta)
+        else:
+            result = _add_partial_sums(result,(values,meta))
+        del values
+        os.remove(tmpfile)
+    _write_partial_sum(kind,result,merged)
+
+def _merge_in_pool(families,workers,max_reads=None):
+    """
+    Helper function: merge the outputs `families` (dictionary name -> (partials, merged))
+    in a pool of `workers` processes. The outputs are merged independently of each
+    other. The partial files of a summed output (see `summed_outputs`) are split in
+    (at most) `workers` contiguous blocks; every block is summed in one worker
+    process and its float64 sum is saved to a temporary .npy file, then one task
+    adds the block sums and writes the merged file. The sums never go through the
+    main process. At most `max_reads` (by default `workers`) tasks read partial
+    files at the same time, so that a shared file system is not flooded with
+    requests; the other outputs are read one per task.
+    Returns a dictionary name -> type of the output, or the exception raised while merging.
+    """
+    ctx = multiprocessing.get_context()
+    semaphore = ctx.BoundedSemaphore(max_reads or workers)
+    results = dict()
+    pending = dict()    # future -> (name, kind of task, block index)
+    blocks = dict()     # name -> list of (.npy file, information) of the block sums
+    remaining = dict()  # name -> number of block sums being computed
+    with tempfile.TemporaryDirectory(prefix="power_merge") as tmpdir, \
+         ProcessPoolExecutor(workers,mp_context=ctx,initializer=_init_read_limit,initargs=(semaphore,)) as pool:
+        for iname,(name,(partials,merged)) in enumerate(families.items()):
+            kind = output_file_type(partials[0])
+            if kind in summed_outputs:
+                results[name] = kind
+                nblocks = min(workers,len(partials))
+                bounds = [len(partials)*k//nblocks for k in range(nblocks+1)]
+                blocks[name] = [None]*nblocks
+                remaining[name] = nblocks
+                for k in range(nblocks):
+                    tmpfile = os.path.join(tmpdir,"{}_{}.npy".format(iname,k))
+                    future = pool.submit(_sum_block,kind,partials[bounds[k]:bounds[k+1]],tmpfile)
+                    pending[future] = (name,"sum",k)
+                    blocks[name][k] = (tmpfile,None)
+            else:
+                pending[pool.submit(_merge_family,partials,merged)] = (name,"merge",None)
+        while pending:
+            done,_ = wait(pending,return_when=FIRST_COMPLETED)
+            for future in done:
+                name,task,k = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    results[name] = e
+                    continue
+                if task == "merge":
+                    results[name] = result
+                elif task == "sum" and not isinstance(results[name],Exception):
+                    blocks[name][k] = (blocks[name][k][0],result)
+                    remaining[name] -= 1
+                    if remaining[name] == 0:
+                        future = pool.submit(_write_block_sums,results[name],blocks[name],families[name][1])
+                        pending[future] = (name,"write",None)
+    return results
+
+def _merge_uncertainty(outputdir,merged):
+    """
+    Helper function: compute the merged uncertainty image "XXX-Uncertainty.mhd"
+    from the merged "XXX.mhd" and "XXX-Squared.mhd" and the number of events of
+    the merged stat file. Returns False if one of them is missing.
+    """
+    summed = merged.replace("-Uncertainty","")
+    squared = merged.replace("-Uncertainty","-Squared")
+    for filename in (summed,squared):
+        if not os.path.isfile(filename):
+            logger.warning("{} does not exist, no uncertainty computed".format(filename))
+            return False
+    events = find_stat_file(outputdir)[1]
+    if not events:
+        logger.warning("no merged stat file (SimulationStatisticActor) in {}, no uncertainty computed".format(outputdir))
+        return False
+    itk.imwrite(image_uncertainty([summed],[squared],events),merged)
+    return True
+
+def _is_uncertainty_output(name):
+    return "-Uncertainty" in name and os.path.splitext(name)[1] in (".mhd",".mha")
+
+def _copy_run_files(rundir,outputdir):
+    # the params.txt and run.log files and the mac directory of the run
+    for f in ("params.txt","run.log"):
+        if os.path.isfile(os.path.join(rundir,f)):
+            shutil.copy(os.path.join(rundir,f),os.path.join(outputdir,f))
+    if os.path.isdir(os.path.join(rundir,"mac")):
+        shutil.copytree(os.path.join(rundir,"mac"),os.path.join(outputdir,"mac"),dirs_exist_ok=True)
+
+def default_merge_directory(rundir):
+    """
+    Name of the directory of the merged outputs of `rundir`: "results.XYZ" for
+    a run directory "run.XYZ", "results" otherwise (in the current directory).
+    """
+    rundir = rundir.rstrip("/") or "/"
+    ext = os.path.splitext(os.path.basename(rundir))[1]
+    return "results"+ext if rundir != "." and ext else "results"
+
+def power_merge(rundir,outputdir=None,force=False,workers=1,max_reads=None):
+    """
+    Merge all partial outputs of the Gate run directory `rundir` into `outputdir`
+    (by default see `default_merge_directory`).
+    * outputs that are missing in some output directories are skipped with a
+      warning, unless `force` is True
+    * uncertainty images ("XXX-Uncertainty.mhd/mha") are not summed but computed
+      from the merged "XXX" and "XXX-Squared" images and the merged number of events
+    * the params.txt and run.log files and the mac directory of the run are copied
+    * with `workers`>1 the outputs are merged in parallel by a pool of processes,
+      the partial images and other summed outputs by blocks, with at most
+      `max_reads` (by default `workers`) processes reading files at the same time
+    Returns a dictionary with, for every merged output, the merged filename, and
+    the number of warnings.
+    """
+    outputdirs,outputs = find_partial_outputs(rundir)
+    if len(outputdirs) == 0:
+        raise ValueError("no output directory found in {}".format(rundir))
+    logger.info("found {} partial output dirs".format(len(outputdirs)))
+    if outputdir is None:
+        outputdir = default_merge_directory(rundir)
+    os.makedirs(outputdir,exist_ok=True)
+    merged_outputs = dict()
+    warnings = 0
+    families = dict()
+    uncertainties = list()
+    for name,partials in outputs.items():
+        if len(partials) != len(outputdirs):
+            logger.warning("{}: {} files for {} output dirs".format(name,len(partials),len(outputdirs)))
+            warnings += 1
+            if not force:
+                continue
+        merged = os.path.join(outputdir,name)
+        if _is_uncertainty_output(name):
+            uncertainties.append((name,merged))
+        else:
+            families[name] = (partials,merged)
+    if workers > 1 and len(families) > 0:
+        results = _merge_in_pool(families,workers,max_reads)
+    else:
+        results = dict()
+        for name,(partials,merged) in families.items():
+            try:
+                results[name] = merge_outputs(partials,merged)
+            except Exception as e:
+                results[name] = e
+    for name,(partials,merged) in families.items():
+        if isinstance(results[name],Exception):
+            logger.warning("error while merging {}: {}".format(name,results[name]))
+            warnings += 1
+        else:
+            logger.info("merged {} {} files into {} ({})".format(len(partials),name,merged,results[name]))
+            merged_outputs[name] = merged
+    for name,merged in uncertainties:
+        if _merge_uncertainty(outputdir,merged):
+            merged_outputs[name] = merged
+        else:
+            warnings += 1
+    _copy_run_files(rundir,outputdir)
+    logger.info("there were {} warning(s)".format(warnings))
+    return merged_outputs, warnings
+
+def _meta_to_json(meta):
+    meta = dict(meta)
+    if "dtype" in meta:
+        meta["dtype"] = np.dtype(meta["dtype"]).str
+    if "info" in meta:
+        info = meta["info"]
+        meta["info"] = dict(size=[int(v) for v in info["size"]],origin=[float(v) for v in info["origin"]],
+                            spacing=[float(v) for v in info["spacing"]],direction=np.asarray(info["direction"]).tolist())
+    return meta
+
+def _meta_from_json(meta):
+    meta = dict(meta)
+    if "dtype" in meta:
+        meta["dtype"] = np.dtype(meta["dtype"])
+    if "info" in meta:
+        info = dict(meta["info"])
+        info["direction"] = np.array(info["direction"])
+        for key in ("size","origin","spacing"):
+            info[key] = tuple(info[key])
+        meta["info"] = info
+    return meta
+
+class power_merge_watcher(object):
+    """
+    Merge the outputs of a running Gate job array as the jobs finish, so that the
+    merged outputs are available at any time and only a final flush is needed at
+    the end of the run (see `power_merge` for the merge of a finished run):
+    * the output directories of the finished jobs (see `completed_output_dirs`) are
+      merged once into the merged outputs in `outputdir` (by default see
+      `default_merge_directory`), by `update()`
+    * images and other summed outputs (see `summed_outputs`) are kept as running sums in
+      float64, in .npz files in `state_dir` (by default `<rundir>/power_merge_watch`),
+      stat, dose, DoseByRegions and root files are merged with the merged file of the
+      previous update, other text files are merged again from all their partial files,
+      and the uncertainty images are computed from the merged sums
+    * the merged jobs, and for every output its type and merged partial files, are
+      recorded in the manifest `state_dir/manifest.json`; the files of an update are
+      written to temporary files and moved into place after the manifest is saved, so
+      that a watcher started again on the same run, also after an interrupted update,
+      resumes from it without merging any job twice
+    * `watch()` updates regularly until all jobs are merged, and `flush()` completes
+      the merge (run files, check of missing outputs).
+    """
+    def __init__(self, rundir, outputdir=None, state_dir=None, settle=10.):
+        self.rundir = rundir
+        self.outputdir = outputdir if outputdir is not None else default_merge_directory(rundir)
+        self.state_dir = state_dir if state_dir is not None else os.path.join(rundir,"power_merge_watch")
+        self.settle = settle
+        self.manifest = os.path.join(self.state_dir,"manifest.json")
+        self.jobs = list()
+        self.outputs = dict()
+        if os.path.isfile(self.manifest):
+            with open(self.manifest) as f:
+                manifest = json.load(f)
+            self.jobs, self.outputs = manifest["jobs"], manifest["outputs"]
+            logger.info("resuming merge of {} with {} jobs".format(self.rundir,len(self.jobs)))
+            if manifest.get("staged"):
+                logger.info("completing the interrupted update of {}".format(self.rundir))
+                self._commit(manifest["staged"],sorted(self.outputs))
+    def _state_filename(self, name):
+        return os.path.join(self.state_dir,name+".npz")
+    def _merged_filename(self, name):
+        return os.path.join(self.outputdir,name)
+    def _add(self, name, partials, output, staged):
+        """
+        Merge the new partial files of one output with its merged output of the
+        previous update, into temporary files that are added to `staged` (list of
+        (temporary file, file)) and only replace the state and merged files in
+        `_commit`. Returns the new manifest entry of the output.
+        """
+        if output is None:
+            output = dict(kind=output_file_type(partials[0]),files=list())
+        output = dict(output)
+        kind = output["kind"]
+        merged = self._merged_filename(name)
+        if kind in summed_outputs:
+            # the running sum is staged, the merged image is written from it in `_commit`
+            result = _read_partial_sum(kind,partials)
+            if output["files"]:
+                with np.load(self._state_filename(name)) as arrays:
+                    result = _add_partial_sums((arrays["sum"],_meta_from_json(output["meta"])),result)
+            tmp = self._state_filename(name)+".tmp"
+            with open(tmp,"wb") as f:
+                np.savez(f,sum=result[0])
+            staged.append((tmp,self._state_filename(name)))
+            output["meta"] = _meta_to_json(result[1])
+        else:
+            if kind == "txt":
+                partials = output["files"]+partials
+            elif output["files"]:
+                partials = [merged]+partials
+            # merged into a temporary file with the same extension
+            tmp = os.path.join(self.outputdir,".tmp."+name)
+            output_mergers[kind](partials,tmp)
+            staged.append((tmp,merged))
+        output["files"] = output["files"]+[p for p in partials if p != merged and p not in output["files"]]
+        return output
+    def _save_manifest(self, staged=()):
+        with open(self.manifest+".tmp","w") as f:
+            json.dump(dict(version=1,jobs=self.jobs,outputs=self.outputs,staged=list(staged)),f,indent=1)
+        os.replace(self.manifest+".tmp",self.manifest)
+    def _commit(self, staged, names):
+        """
+        Move the staged files of an update (see `_add`) into place, then write the
+        merged summed outputs `names` from their running sums and compute the
+        uncertainty images. The manifest with the staged files is saved before, so
+        that an interrupted commit is completed by the next watcher of the run.
+        """
+        for tmp,filename in staged:
+            if os.path.isfile(tmp):
+                os.replace(tmp,filename)
+        for name in names:
+            output = self.outputs[name]
+            if output["kind"] in summed_outputs:
+                with np.load(self._state_filename(name)) as arrays:
+                    _write_partial_sum(output["kind"],(arrays["sum"],_meta_from_json(output["meta"])),self._merged_filename(name))
+        for name in names:
+            if self.outputs[name]["kind"] == "uncertainty":
+                _merge_uncertainty(self.outputdir,self._merged_filename(name))
+        self._save_manifest()
+    def update(self):
+        """
+        Merge the outputs of the jobs that finished since the last update and return
+        a report (see `report`). All new state and merged files are first written to
+        temporary files, then the manifest is saved, then the files are moved into
+        place (see `_commit`): an update that is interrupted before the manifest is
+        saved leaves the previous state, and one that is interrupted after is
+        completed by the next watcher of the run, so no job is merged twice.
+        """
+        new_jobs = [d for d,events in completed_output_dirs(self.rundir,self.settle,skip=set(self.jobs))]
+        if new_jobs:
+            os.makedirs(self.state_dir,exist_ok=True)
+            os.makedirs(self.outputdir,exist_ok=True)
+            partials = dict()
+            for outputdir in new_jobs:
+                for name,path in _job_outputs(outputdir):
+                    partials.setdefault(name,[]).append(path)
+            outputs = dict(self.outputs)
+            staged = list()
+            for name in sorted(partials):
+                if _is_uncertainty_output(name):
+                    files = outputs.get(name,{}).get("files",[])+sorted(partials[name])
+                    outputs[name] = dict(kind="uncertainty",files=files)
+                else:
+                    outputs[name] = self._add(name,sorted(partials[name]),outputs.get(name),staged)
+            self.jobs = self.jobs+[os.path.realpath(d) for d in new_jobs]
+            self.outputs = outputs
+            self._save_manifest(staged)
+            self._commit(staged,sorted(partials))
+            logger.info("merged {} jobs, {} in total".format(len(new_jobs),len(self.jobs)))
+        return self.report(len(new_jobs))
+    def report(self, new_jobs=0):
+        """
+        Current state: number of merged jobs ("jobs"), of jobs merged by the last
+        update ("new_jobs"), of output directories in the run ("outputdirs") and of
+        merged outputs ("outputs").
+        """
+        outputdirs = [d for d in glob.glob(os.path.join(self.rundir,"output*")) if os.path.isdir(d)]
+        return dict(jobs=len(self.jobs),new_jobs=new_jobs,outputdirs=len(outputdirs),outputs=len(self.outputs))
+    def flush(self):
+        """
+        Final step of the merge, when all jobs are merged: copy the params.txt, run.log
+        and mac directory of the run, and warn about the outputs that are missing for
+        some of the merged jobs. Returns the merged filenames and the number of warnings,
+        as `power_merge`.
+        """
+        os.makedirs(self.outputdir,exist_ok=True)
+        warnings = 0
+        merged_outputs = dict()
+        for name,output in sorted(self.outputs.items()):
+            if output["kind"] == "uncertainty" and not os.path.isfile(self._merged_filename(name)):
+                logger.warning("{}: no uncertainty computed".format(name))
+                warnings += 1
+                continue
+            if len(output["files"]) != len(self.jobs):
+                logger.warning("{}: {} files for {} jobs".format(name,len(output["files"]),len(self.jobs)))
+                warnings += 1
+            merged_outputs[name] = self._merged_filename(name)
+        _copy_run_files(self.rundir,self.outputdir)
+        logger.info("there were {} warning(s)".format(warnings))
+        return merged_outputs, warnings
+    def watch(self, interval=60., njobs=None, max_updates=None, callback=None):
+        """
+        Update every `interval` seconds until `njobs` jobs are merged (by default,
+        until the jobs of all output directories of the run are merged) or after
+        `max_updates` updates. `callback` is called with every report. Returns the
+        last report; `flush()` completes the merge.
+        """
+        nupdates = 0
+        while True:
+            report = self.update()
+            nupdates += 1
+            if callback is not None:
+                callback(report)
+            if report["jobs"] > 0 and report["jobs"] >= (report["outputdirs"] if njobs is None else njobs):
+                break
+            if max_updates is not None and nupdates >= max_updates:
+                break
+            time.sleep(interval)
+        return report
+
+#####################################################################################
+import unittest
+import unittest.mock
+from .logging_conf import LoggedTestCase
+from .stat_file import _write_job_stat_file
+
+def _make_test_run(rundir,n):
+    """
+    Create a Gate run directory with `n` output directories and some outputs of
+    every type; returns the expected merged dose, squared dose and projection.
+    """
+    edep, sq_edep, counts = np.zeros((4,5,6)), np.zeros((4,5,6)), np.zeros((6,7),dtype=np.uint16)
+    for i in range(n):
+        outputdir = os.path.join(rundir,"output.{}".format(i))
+        os.makedirs(outputdir)
+        a = np.random.exponential(1.,(4,5,6)).astype(np.float32)
+        edep += a
+        sq_edep += a*a
+        c = np.random.randint(0,100,(6,7)).astype(np.uint16)
+        counts += c
+        itk.imwrite(itk.image_from_array(a),os.path.join(outputdir,"dose-Edep.mhd"))
+        itk.imwrite(itk.image_from_array(a*a),os.path.join(outputdir,"dose-Edep-Squared.mhd"))
+        itk.imwrite(itk.image_from_array(a),os.path.join(outputdir,"dose-Edep-Uncertainty.mhd"))
+        itk.imwrite(itk.image_from_array(a),os.path.join(outputdir,"analyze.hdr"))
+        c.tofile(os.path.join(outputdir,"projection.sin"))
+        with open(os.path.join(outputdir,"projection.hdr"),"w") as f:
+            f.write("!INTERFILE :=\n!name of data file := projection.sin\n!matrix size [1] := 7\n"
+                    "!matrix size [2] := 6\n!number format := UNSIGNED INTEGER\n"
+                    "!number of bytes per pixel := 2\n!number of projections := 1\n")
+        _write_job_stat_file(os.path.join(outputdir,"stat.txt"),1000*(i+1),10.*(i+1),
+                         "Mon Mar 02 10:00:0{} 2026".format(i),"Mon Mar 02 10:01:0{} 2026".format(i))
+        with open(os.path.join(outputdir,"dose.txt"),"w") as f:
+            f.write("# energydose total {}\n# energydose spine {}\n".format(1.5*i,0.25))
+        with open(os.path.join(outputdir,"profile.txt"),"w") as f:
+            f.write("#####\n# Resol = (1,1,3)\n#####\n1.5\n2.\n{}\n".format(i))
+        with open(os.path.join(outputdir,"params.txt"),"w") as f:
+            f.write("same text\n")
+    # the last output dir has one more file
+    with open(os.path.join(outputdir,"extra.txt"),"w") as f:
+        f.write("only once\n")
+    os.makedirs(os.path.join(rundir,"mac"))
+    with open(os.path.join(rundir,"mac","main.mac"),"w") as f:
+        f.write("/run/beamOn 1000\n")
+    return edep, sq_edep, counts
+
+class Test_PowerMerge(LoggedTestCase):
+    def test_power_merge(self):
+        logger.info('Test_PowerMerge test_power_merge')
+        np.random.seed(7)
+        tmpdirpath = tempfile.mkdtemp()
+        edep, sq_edep, counts = _make_test_run(os.path.join(tmpdirpath,"run.abc"),3)
+        cwd = os.getcwd()
+        os.chdir(tmpdirpath)
+        try:
+            merged,warnings = power_merge("run.abc")
+        finally:
+            os.chdir(cwd)
+        resultdir = os.path.join(tmpdirpath,"results.abc")
+        self.assertEqual(warnings,1)
+        self.assertEqual(sorted(merged),["analyze.hdr","dose-Edep-Squared.mhd","dose-Edep-Uncertainty.mhd","dose-Edep.mhd",
+                                         "dose.txt","params.txt","profile.txt","projection.hdr","stat.txt"])
+        self.assertTrue(os.path.isfile(os.path.join(resultdir,"mac","main.mac")))
+        dose = itk.imread(os.path.join(resultdir,"dose-Edep.mhd"))
+        self.assertEqual(type(dose),itk.Image[itk.F,3])
+        self.assertTrue(np.allclose(itk.array_view_from_image(dose),edep,rtol=1e-6))
+        self.assertTrue(np.allclose(itk.array_view_from_image(itk.imread(os.path.join(resultdir,"analyze.hdr"))),edep,rtol=1e-6))
+        uncertainty = image_uncertainty([os.path.join(resultdir,"dose-Edep.mhd")],[os.path.join(resultdir,"dose-Edep-Squared.mhd")],6000)
+        self.assertTrue(np.allclose(itk.array_view_from_image(itk.imread(os.path.join(resultdir,"dose-Edep-Uncertainty.mhd"))),
+                                    itk.array_view_from_image(uncertainty)))
+        self.assertTrue(np.array_equal(np.fromfile(os.path.join(resultdir,"projection.sin"),dtype=np.uint16),counts.ravel()))
+        self.assertEqual(output_file_type(os.path.join(resultdir,"projection.hdr")),"interfile")
+        keys = read_stat_file(os.path.join(resultdir,"stat.txt"))
+        self.assertEqual(int(keys["NumberOfEvents"]),6000)
+        self.assertEqual(int(keys["NumberOfMergedJobs"]),3)
+        self.assertEqual(float(keys["MaxElapsedTime"]),31.)
+        with open(os.path.join(resultdir,"dose.txt")) as f:
+            self.assertEqual(f.read(),"# energydose total 4.5\n# energydose spine 0.75\n")
+        header,values,layout = _read_txt_image(os.path.join(resultdir,"profile.txt"))
+        self.assertEqual(len(header),3)
+        self.assertTrue(np.allclose(values,[4.5,6.,3.]))
+        with open(os.path.join(resultdir,"params.txt")) as f:
+            self.assertEqual(f.read(),"same text\n")
+        shutil.rmtree(tmpdirpath)
+    def test_power_merge_workers(self):
+        logger.info('Test_PowerMerge test_power_merge_workers')
+        np.random.seed(8)
+        tmpdirpath = tempfile.mkdtemp()
+        rundir = os.path.join(tmpdirpath,"run.abc")
+        edep, sq_edep, counts = _make_test_run(rundir,7)
+        serial = os.path.join(tmpdirpath,"serial")
+        merged,warnings = power_merge(rundir,serial,force=True)
+        # 3 blocks of 2, 2 and 3 files are summed in the worker processes, then the 3 block sums are added
+        parallel = os.path.join(tmpdirpath,"parallel")
+        pmerged,pwarnings = power_merge(rundir,parallel,force=True,workers=3,max_reads=2)
+        self.assertEqual((warnings,pwarnings),(1,1))
+        self.assertEqual(sorted(merged),sorted(pmerged))
+        self.assertIn("extra.txt",pmerged)
+        for name in merged:
+            if output_file_type(merged[name]) in ("image","analyze"):
+                self.assertTrue(np.allclose(itk.array_view_from_image(itk.imread(merged[name])),
+                                            itk.array_view_from_image(itk.imread(pmerged[name])),rtol=1e-6))
+            else:
+                self.assertTrue(filecmp.cmp(merged[name],pmerged[name],shallow=False),name)
+        self.assertTrue(np.array_equal(np.fromfile(os.path.join(parallel,"projection.sin"),dtype=np.uint16),counts.ravel()))
+        # an error in one output does not stop the others
+        with open(os.path.join(rundir,"output.3","profile.txt"),"a") as f:
+            f.write("4.\n")
+        pmerged,pwarnings = power_merge(rundir,parallel,workers=2)
+        self.assertEqual(pwarnings,2)
+        self.assertNotIn("profile.txt",pmerged)
+        self.assertIn("dose-Edep.mhd",pmerged)
+        shutil.rmtree(tmpdirpath)
+    def test_power_merge_watcher(self):
+        logger.info('Test_PowerMerge test_power_merge_watcher')
+        np.random.seed(10)
+        tmpdirpath = tempfile.mkdtemp()
+        rundir = os.path.join(tmpdirpath,"run.abc")
+        _make_test_run(rundir,4)
+        reference,warnings = power_merge(rundir,os.path.join(tmpdirpath,"reference"),force=True)
+        # jobs 2 and 3 are still running: no stat file yet
+        for i in (2,3):
+            os.rename(os.path.join(rundir,"output.{}".format(i),"stat.txt"),os.path.join(rundir,"stat{}.tmp".format(i)))
+        outputdir = os.path.join(tmpdirpath,"merged")
+        watcher = power_merge_watcher(rundir,outputdir,settle=0.)
+        report = watcher.update()
+        self.assertEqual((report["jobs"],report["new_jobs"],report["outputdirs"]),(2,2,4))
+        self.assertEqual(watcher.update()["new_jobs"],0)
+        self.assertEqual(read_stat_file(os.path.join(outputdir,"stat.txt"))["NumberOfEvents"],"3000")
+        partial = itk.array_from_image(itk.imread(os.path.join(outputdir,"dose-Edep.mhd")))
+        # the other jobs finish, the watcher is restarted from its manifest
+        for i in (2,3):
+            os.rename(os.path.join(rundir,"stat{}.tmp".format(i)),os.path.join(rundir,"output.{}".format(i),"stat.txt"))
+        watcher = power_merge_watcher(rundir,outputdir,settle=0.)
+        self.assertEqual(len(watcher.jobs),2)
+        reports = list()
+        report = watcher.watch(interval=0.,max_updates=5,callback=reports.append)
+        self.assertEqual(len(reports),1)
+        self.assertEqual((report["jobs"],report["new_jobs"]),(4,2))
+        merged,warnings = watcher.flush()
+        self.assertEqual(warnings,1)
+        self._assert_same_outputs(reference,merged)
+        self.assertFalse(np.allclose(partial,itk.array_view_from_image(itk.imread(merged["dose-Edep.mhd"]))))
+        with open(os.path.join(rundir,"power_merge_watch","manifest.json")) as f:
+            manifest = json.load(f)
+        self.assertEqual(len(manifest["jobs"]),4)
+        self.assertEqual(manifest["outputs"]["projection.hdr"]["kind"],"interfile")
+        self.assertEqual(len(manifest["outputs"]["dose-Edep.mhd"]["files"]),4)
+        shutil.rmtree(tmpdirpath)
+    def test_power_merge_watcher_interrupted(self):
+        logger.info('Test_PowerMerge test_power_merge_watcher_interrupted')
+        def interrupt(*args):
+            raise KeyboardInterrupt()
+        # an update interrupted while merging the stat files, or after its manifest is saved
+        for patch in (unittest.mock.patch.dict(output_mergers,{"stat":interrupt}),
+                      unittest.mock.patch.object(power_merge_watcher,"_commit",interrupt)):
+            np.random.seed(11)
+            tmpdirpath = tempfile.mkdtemp()
+            rundir = os.path.join(tmpdirpath,"run.abc")
+            _make_test_run(rundir,3)
+            reference,warnings = power_merge(rundir,os.path.join(tmpdirpath,"reference"),force=True)
+            os.rename(os.path.join(rundir,"output.2","stat.txt"),os.path.join(rundir,"stat2.tmp"))
+            outputdir = os.path.join(tmpdirpath,"merged")
+            self.assertEqual(power_merge_watcher(rundir,outputdir,settle=0.).update()["jobs"],2)
+            os.rename(os.path.join(rundir,"stat2.tmp"),os.path.join(rundir,"output.2","stat.txt"))
+            with patch, self.assertRaises(KeyboardInterrupt):
+                power_merge_watcher(rundir,outputdir,settle=0.).update()
+            # the next watcher merges the last job exactly once
+            watcher = power_merge_watcher(rundir,outputdir,settle=0.)
+            watcher.update()
+            self.assertEqual(len(watcher.jobs),3)
+            merged,warnings = watcher.flush()
+            self.assertEqual(warnings,1)
+            self._assert_same_outputs(reference,merged)
+            self.assertEqual([f for f in os.listdir(outputdir) if f.startswith(".tmp.")],[])
+            shutil.rmtree(tmpdirpath)
+    def _assert_same_outputs(self,reference,merged):
+        self.assertEqual(sorted(merged),sorted(reference))
+        for name in reference:
+            if output_file_type(reference[name]) in ("image","analyze"):
+                self.assertTrue(np.allclose(itk.array_view_from_image(itk.imread(reference[name])),
+                                            itk.array_view_from_image(itk.imread(merged[name])),rtol=1e-6),name)
+            else:
+                self.assertTrue(filecmp.cmp(reference[name],merged[name],shallow=False),name)
+    def test_merge_dose_by_regions(self):
+        logger.info('Test_PowerMerge test_merge_dose_by_regions')
+        np.random.seed(9)
+        tmpdirpath = tempfile.mkdtemp()
+        partials = list()
+        edep, sq_edep = np.zeros(5), np.zeros(5)
+        for i,N in enumerate((1000,2500,4000)):
+            partials.append(os.path.join(tmpdirpath,"dbr{}.txt".format(i)))
+            e = np.random.uniform(1.,2.,5)
+            e[0] = 0. if i == 0 else e[0] # no edep in the first region of the first job
+            sq = e*e/N*np.random.uniform(2.,5.,5)
+            edep += e
+            sq_edep += sq
+            std = np.ones(5)
+            np.divide(np.sqrt((sq/N-(e/N)**2)/(N-1)),e/N,out=std,where=e>0)
+            with open(partials[-1],"w") as f:
+                f.write("#id vol(mm3) edep(MeV) std_edep sq_edep dose(Gy) std_dose sq_dose n_hits n_event_hits\n")
+                for r,(er,stdr,sqr) in enumerate(zip(e.tolist(),std.tolist(),sq.tolist())):
+                    f.write("{} 8.5 {!r} {!r} {!r} {!r} {!r} {!r} {} 2\n".format(r,er,stdr,sqr,2*er,stdr,4*sqr,10*r+i))
+        values = read_dose_by_regions(partials)[2]
+        self.assertEqual(values.shape,(3,5,10))
+        self.assertTrue(np.allclose(_number_of_primaries(values),[1000,2500,4000]))
+        merged = os.path.join(tmpdirpath,"dbr.txt")
+        self.assertEqual(output_file_type(partials[0]),"dose_by_regions")
+        merge_outputs(partials,merged)
+        result = np.loadtxt(merged)
+        self.assertTrue(np.allclose(result[:,0],range(5)))
+        self.assertTrue(np.allclose(result[:,1],8.5))
+        self.assertTrue(np.allclose(result[:,2],edep))
+        self.assertTrue(np.allclose(result[:,7],4*sq_edep))
+        self.assertTrue(np.allclose(result[:,8],[30*r+3 for r in range(5)]))
+        self.assertTrue(np.allclose(result[:,9],6))
+        std = np.sqrt((sq_edep/7500-(edep/7500)**2)/7499)/(edep/7500)
+        self.assertTrue(np.allclose(result[:,3],std))
+        self.assertTrue(np.allclose(result[:,6],std))
+        with open(merged) as f:
+            self.assertTrue(f.readline().startswith("#id vol(mm3)"))
+        shutil.rmtree(tmpdirpath)
+    def test_output_file_type(self):
+        logger.info('Test_PowerMerge test_output_file_type')
+        tmpdirpath = tempfile.mkdtemp()
+        for name,text,kind in (("a.txt","#id vol(mm3) edep(MeV)\n","dose_by_regions"),
+                               ("b.txt","# Resol = (10,1,3)\n1\n","txt"),
+                               ("c.txt","# Resol = (1,1,1)\n1\n","txt_image"),
+                               ("d.mac","/run/beamOn 10\n",None)):
+            with open(os.path.join(tmpdirpath,name),"w") as f:
+                f.write(text)
+            self.assertEqual(output_file_type(os.path.join(tmpdirpath,name)),kind)
+        self.assertEqual(default_merge_directory("run.x8Yz/"),"results.x8Yz")
+        self.assertEqual(default_merge_directory("."),"results")
+        self.assertEqual(default_merge_directory("myrun"),"results")
+        shutil.rmtree(tmpdirpath)
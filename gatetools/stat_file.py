@@ -0,0 +1,277 @@
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+"""
+Read and merge the stat files of the SimulationStatisticActor of the jobs
+of a Gate job array ("# NumberOfEvents = 1000" lines), in a single pass over
+all files, and compute the throughput of every job.
+"""
+
+import os
+import re
+import glob
+import time
+import datetime
+import numpy as np
+import logging
+logger=logging.getLogger(__name__)
+
+stat_line_re = re.compile(r'''^#\s+([a-zA-Z]+)\s+=\s(.*)$''')
+
+# keys of a merged stat file, in this order
+merged_stat_keys = ['NumberOfRun', 'NumberOfEvents', 'NumberOfTracks', 'NumberOfSteps', 'NumberOfGeometricalSteps',
+                    'NumberOfPhysicalSteps', 'ElapsedTimeWoInit', 'ElapsedTime', 'StartDate', 'EndDate',
+                    'NumberOfMergedJobs', 'MeanPPS', 'MeanElapsedTime', 'MinElapsedTime', 'MaxElapsedTime']
+
+stat_date_format = "%a %b %d %H:%M:%S %Y"
+
+def read_stat_file(filename):
+    """
+    Read the keys and values (as strings) of a stat file, or of a merged stat file.
+    """
+    keys = dict()
+    with open(filename) as f:
+        for line in f:
+            match = stat_line_re.match(line)
+            if match is not None:
+                keys[match.group(1)] = match.group(2).strip()
+    return keys
+
+def find_stat_file(outputdir,max_size=2**20):
+    """
+    Find the stat file of the Gate output directory `outputdir`: the first *.txt
+    file (by name) with a NumberOfEvents key. Text files larger than `max_size`
+    bytes (e.g. ASCII dose outputs) are not read.
+    Returns the filename, the number of events and the keys (see `read_stat_file`),
+    or (None, None, None) if there is no stat file.
+    """
+    for filename in sorted(glob.glob(os.path.join(outputdir,"*.txt"))):
+        if os.path.getsize(filename) > max_size:
+            continue
+        keys = read_stat_file(filename)
+        if "NumberOfEvents" in keys:
+            return filename, int(keys["NumberOfEvents"]), keys
+    return None, None, None
+
+def completed_output_dirs(rundir,settle=10.,stat_file=True,skip=()):
+    """
+    Output directories of the finished jobs of the Gate run directory `rundir`: none of
+    the files of the output directory has been modified in the last `settle` seconds
+    and, if `stat_file` is True, the stat file of the job (see `find_stat_file`) has
+    been written, with the end date. The directories in `skip` (real paths, e.g. the
+    jobs that are already merged) are not checked.
+    Returns a list of (output directory, number of events or None), sorted by directory.
+    """
+    completed = list()
+    now = time.time()
+    for outputdir in sorted(glob.glob(os.path.join(rundir,"output*"))):
+        if not os.path.isdir(outputdir) or os.path.realpath(outputdir) in skip:
+            continue
+        mtimes = [os.path.getmtime(os.path.join(root,f)) for root,dirs,files in os.walk(outputdir,followlinks=True) for f in files]
+        if any(now-mtime < settle for mtime in mtimes):
+            continue
+        filename,events,keys = find_stat_file(outputdir)
+        if stat_file and (filename is None or "EndDate" not in keys):
+            continue
+        completed.append((outputdir,events))
+    return completed
+
+def _sum_values(values):
+    # integers if all values are integers (e.g. the number of events), floats otherwise
+    try:
+        return str(sum(int(v) for v in values))
+    except ValueError:
+        return str(sum(float(v) for v in values))
+
+def merge_stat_files(paths):
+    """
+    Merge the stat files `paths` (stat files of jobs and/or merged stat files) in a
+    single pass: all files are read once and the merged values are computed in one
+    reduction (clustertools/mergeStatFile.py merges two files with this function):
+    * the numbers of runs, events, tracks and steps, and the elapsed times are summed
+    * StartDate is the earliest start and EndDate the latest end
+    * NumberOfMergedJobs is the number of jobs (merged stat files count for their jobs)
+    * MeanPPS is the number of events per second of elapsed time, MeanElapsedTime the
+      mean elapsed time per job, Min/MaxElapsedTime the shortest and longest job
+    * Speedup is the summed elapsed time divided by the time between the first start
+      and the last end.
+    Returns the merged keys (a dictionary of strings, see `format_stat_keys`) and the
+    list of jobs: one dictionary per file with the "filename", the number of "events",
+    the "elapsed" time, the throughput "pps" (events per second), the "start" and "end"
+    dates and the number of "jobs" (more than one for merged stat files).
+    """
+    if len(paths) == 0:
+        raise ValueError("no stat file to merge")
+    stats = [read_stat_file(path) for path in paths]
+    keys = dict()
+    for key in merged_stat_keys[:8]:
+        values = [s[key] for s in stats if key in s]
+        if len(values) != len(stats):
+            raise ValueError("{} is missing in {} stat file(s)".format(key,len(stats)-len(values)))
+        keys[key] = _sum_values(values)
+    starts = [datetime.datetime.strptime(s["StartDate"],stat_date_format) for s in stats]
+    ends = [datetime.datetime.strptime(s["EndDate"],stat_date_format) for s in stats]
+    keys["StartDate"] = min(starts).strftime(stat_date_format)
+    keys["EndDate"] = max(ends).strftime(stat_date_format)
+    jobs = [int(s.get("NumberOfMergedJobs",1)) for s in stats]
+    keys["NumberOfMergedJobs"] = str(sum(jobs))
+    elapsed = float(keys["ElapsedTime"])
+    keys["MeanPPS"] = str(int(keys["NumberOfEvents"])/elapsed) if elapsed > 0 else "0"
+    keys["MeanElapsedTime"] = str(elapsed/sum(jobs))
+    keys["MinElapsedTime"] = str(min(float(s.get("MinElapsedTime",s["ElapsedTime"])) for s in stats))
+    keys["MaxElapsedTime"] = str(max(float(s.get("MaxElapsedTime",s["ElapsedTime"])) for s in stats))
+    duration = (max(ends)-min(starts)).total_seconds()
+    if duration > 0:
+        keys["Speedup"] = str(elapsed/duration)
+    job_list = list()
+    for path,s,start,end,n in zip(paths,stats,starts,ends,jobs):
+        events,seconds = int(s["NumberOfEvents"]),float(s["ElapsedTime"])
+        job_list.append(dict(filename=path,events=events,elapsed=seconds,pps=events/seconds if seconds > 0 else 0.,
+                             start=start,end=end,jobs=n))
+    return keys, job_list
+
+def format_stat_keys(keys):
+    """
+    Text of a merged stat file, with the keys of `merged_stat_keys` (and "Speedup").
+    """
+    output = "\n".join("# %s = %s" % (key,keys[key]) for key in merged_stat_keys)
+    if "Speedup" in keys:
+        output += "\n# Speedup = %s" % keys["Speedup"]
+    return output
+
+def write_stat_file(keys,filename):
+    """
+    Write the merged keys of `merge_stat_files` to a stat file.
+    """
+    with open(filename,"w") as f:
+        f.write(format_stat_keys(keys))
+
+def job_statistics(jobs,straggler_factor=2.):
+    """
+    Throughput statistics of the jobs returned by `merge_stat_files`. Merged stat
+    files only give the summed elapsed time of their jobs, so they are left out of
+    the distributions and of the stragglers:
+    * "jobs": the number of jobs (stat files of single jobs)
+    * "merged_jobs": the number of jobs in merged stat files, not in the statistics
+    * the distribution of the number of events per second of the jobs: "pps_min",
+      "pps_p05", "pps_p25", "pps_median", "pps_p75", "pps_p95", "pps_max", "pps_mean"
+      and "pps_std"
+    * the "elapsed_min", "elapsed_median" and "elapsed_max" time of the jobs
+    * "stragglers": the jobs that took more than `straggler_factor` times the median
+      elapsed time, slowest first
+    """
+    merged_jobs = sum(job["jobs"] for job in jobs if job["jobs"] > 1)
+    jobs = [job for job in jobs if job["jobs"] == 1]
+    if len(jobs) == 0:
+        raise ValueError("no stat file of a single job")
+    pps = np.array([job["pps"] for job in jobs],dtype=float)
+    elapsed = np.array([job["elapsed"] for job in jobs],dtype=float)
+    stats = dict(jobs=len(jobs),merged_jobs=merged_jobs)
+    for name,q in (("min",0),("p05",5),("p25",25),("median",50),("p75",75),("p95",95),("max",100)):
+        stats["pps_"+name] = float(np.percentile(pps,q))
+    stats["pps_mean"] = float(np.mean(pps))
+    stats["pps_std"] = float(np.std(pps))
+    stats["elapsed_min"] = float(np.min(elapsed))
+    stats["elapsed_median"] = float(np.median(elapsed))
+    stats["elapsed_max"] = float(np.max(elapsed))
+    stragglers = [job for job in jobs if job["elapsed"] > straggler_factor*stats["elapsed_median"]]
+    stats["stragglers"] = sorted(stragglers,key=lambda job: job["elapsed"],reverse=True)
+    return stats
+
+#####################################################################################
+import unittest
+import unittest.mock
+import os
+import sys
+import shutil
+import tempfile
+from .logging_conf import LoggedTestCase
+
+def _write_job_stat_file(filename,events,elapsed,start,end):
+    with open(filename,"w") as f:
+        f.write("# NumberOfRun    = 1\n# NumberOfEvents = {}\n# NumberOfTracks = {}\n# NumberOfSteps  = 10\n"
+                "# NumberOfGeometricalSteps = 4\n# NumberOfPhysicalSteps    = 6\n# ElapsedTimeWoInit = {}\n"
+                "# ElapsedTime    = {}\n# StartDate      = {}\n# EndDate        = {}\n".format(
+                    events,2*events,elapsed,elapsed+1.,start,end))
+
+class Test_StatFile(LoggedTestCase):
+    def test_merge_stat_files(self):
+        logger.info('Test_StatFile test_merge_stat_files')
+        from .clustertools import mergeStatFile
+        tmpdirpath = tempfile.mkdtemp()
+        paths = list()
+        for i in range(7):
+            paths.append(os.path.join(tmpdirpath,"stat{}.txt".format(i)))
+            elapsed = 10.5*(i+1) if i != 4 else 400.25
+            _write_job_stat_file(paths[-1],1000*(i+1),elapsed,"Mon Mar  2 10:00:0{} 2026".format(i),
+                                 "Mon Mar  2 1{}:01:0{} 2026".format(i,i))
+        keys,jobs = merge_stat_files(paths)
+        self.assertEqual(format_stat_keys(keys),"\n".join((
+            "# NumberOfRun = 7", "# NumberOfEvents = 28000", "# NumberOfTracks = 56000", "# NumberOfSteps = 70",
+            "# NumberOfGeometricalSteps = 28", "# NumberOfPhysicalSteps = 42", "# ElapsedTimeWoInit = 641.75",
+            "# ElapsedTime = 648.75", "# StartDate = Mon Mar 02 10:00:00 2026", "# EndDate = Mon Mar 02 16:01:06 2026",
+            "# NumberOfMergedJobs = 7", "# MeanPPS = 43.15992292870906", "# MeanElapsedTime = 92.67857142857143",
+            "# MinElapsedTime = 11.5", "# MaxElapsedTime = 401.25", "# Speedup = 0.029943229022431458")))
+        # same result as merging the files two by two with mergeStatFile.py
+        merged = os.path.join(tmpdirpath,"pairwise.txt")
+        shutil.copy(paths[0],merged)
+        for path in paths[1:]:
+            with unittest.mock.patch.object(sys,"argv",["mergeStatFile.py","-i",merged,"-j",path,"-o",merged]):
+                mergeStatFile.main()
+        with open(merged) as f:
+            self.assertEqual(f.read(),format_stat_keys(keys))
+        self.assertEqual(keys["NumberOfEvents"],"28000")
+        self.assertEqual(keys["NumberOfMergedJobs"],"7")
+        self.assertEqual(keys["StartDate"],"Mon Mar 02 10:00:00 2026")
+        self.assertEqual(keys["EndDate"],"Mon Mar 02 16:01:06 2026")
+        # merged stat files count for all their jobs
+        merged = os.path.join(tmpdirpath,"merged.txt")
+        write_stat_file(merge_stat_files(paths[:4])[0],merged)
+        keys2,jobs2 = merge_stat_files([merged]+paths[4:])
+        self.assertEqual(keys2,keys)
+        self.assertEqual([job["jobs"] for job in jobs2],[4,1,1,1])
+        # the jobs of merged stat files are not in the throughput statistics
+        stats2 = job_statistics(jobs2)
+        self.assertEqual((stats2["jobs"],stats2["merged_jobs"]),(3,4))
+        self.assertEqual([job["filename"] for job in stats2["stragglers"]],[paths[4]])
+        with self.assertRaises(ValueError):
+            job_statistics(jobs2[:1])
+        # throughput
+        self.assertEqual(len(jobs),7)
+        self.assertAlmostEqual(jobs[1]["pps"],2000/22.)
+        stats = job_statistics(jobs)
+        self.assertEqual((stats["jobs"],stats["merged_jobs"]),(7,0))
+        self.assertAlmostEqual(stats["pps_max"],max(job["pps"] for job in jobs))
+        self.assertAlmostEqual(stats["elapsed_median"],43.)
+        self.assertEqual([job["filename"] for job in stats["stragglers"]],[paths[4]])
+        with self.assertRaises(ValueError):
+            merge_stat_files([])
+        shutil.rmtree(tmpdirpath)
+    def test_completed_output_dirs(self):
+        logger.info('Test_StatFile test_completed_output_dirs')
+        rundir = tempfile.mkdtemp()
+        for i in range(4):
+            os.makedirs(os.path.join(rundir,"output.{}".format(i)))
+        # a large text output is not read, the stat file is found after it
+        with open(os.path.join(rundir,"output.0","dose.txt"),"w") as f:
+            f.write("# NumberOfEvents = 1\n"+"0.5\n"*300000)
+        _write_job_stat_file(os.path.join(rundir,"output.0","stat.txt"),100,1.,"Mon Mar  2 10:00:00 2026","Mon Mar  2 10:01:00 2026")
+        _write_job_stat_file(os.path.join(rundir,"output.1","stat.txt"),200,1.,"Mon Mar  2 10:00:00 2026","Mon Mar  2 10:01:00 2026")
+        # a stat file without end date, and no stat file
+        with open(os.path.join(rundir,"output.2","stat.txt"),"w") as f:
+            f.write("# NumberOfRun    = 1\n# NumberOfEvents = 300\n")
+        self.assertEqual(find_stat_file(os.path.join(rundir,"output.0"))[:2],
+                         (os.path.join(rundir,"output.0","stat.txt"),100))
+        self.assertEqual(find_stat_file(os.path.join(rundir,"output.0"),max_size=2**21)[1],1)
+        self.assertEqual(find_stat_file(os.path.join(rundir,"output.3")),(None,None,None))
+        self.assertEqual(completed_output_dirs(rundir,settle=0.),
+                         [(os.path.join(rundir,"output.0"),100),(os.path.join(rundir,"output.1"),200)])
+        self.assertEqual([events for d,events in completed_output_dirs(rundir,settle=0.,stat_file=False)],[100,200,300,None])
+        self.assertEqual(completed_output_dirs(rundir,settle=0.,skip={os.path.realpath(os.path.join(rundir,"output.0"))}),
+                         [(os.path.join(rundir,"output.1"),200)])
+        self.assertEqual(completed_output_dirs(rundir,settle=1000.),[])
+        shutil.rmtree(rundir)